@@ -5,19 +5,30 @@ from routes.users import router as users_router  # Import users router
 from routes.books import router as books_router  # Import books router
 from routes.genres import router as genres_router  # Import genres router
 from routes.borrow import router as borrow_router  # Import genres router
+from routes.dashboard import router as dashboard_router  # Import dashboard router
+from routes.cache import router as cache_router  # Import cache stats router
+from routes.exports import router as exports_router  # Import exports router
+from routes.metrics import router as metrics_router  # Import metrics router
+from routes.availability import router as availability_router  # Import live availability router
+from routes.health import router as health_router  # Import health probes router
+from routes.covers import router as covers_router  # Import cover images router
+from metrics import RequestMetricsMiddleware
+from lifecycle import lifespan
 
-app = FastAPI()
+# The lifespan handler connects and warms up before the server accepts connections
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(RequestMetricsMiddleware)
 
 # Register the users and books routers
 app.include_router(users_router, prefix="/api")
 app.include_router(books_router, prefix="/api")  
 app.include_router(genres_router, prefix="/api")
 app.include_router(borrow_router, prefix="/api")# Register the books routes here
-
-@app.on_event("startup")
-async def startup():
-    await connect_db()
-
-@app.on_event("shutdown")
-async def shutdown():
-    await disconnect_db()
+app.include_router(dashboard_router, prefix="/api")
+app.include_router(cache_router, prefix="/api")
+app.include_router(exports_router, prefix="/api")
+app.include_router(availability_router, prefix="/api")
+app.include_router(covers_router, prefix="/api")
+# Served at the root, where Prometheus and the orchestrator's probes look by default
+app.include_router(metrics_router)
+app.include_router(health_router)
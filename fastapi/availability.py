@@ -0,0 +1,170 @@
+"""Live book availability, pushed to clients as it changes.
+
+A trigger on books (migration 10) sends every stock change as a NOTIFY on
+AVAILABILITY_CHANNEL when its transaction commits, whichever process or
+statement made it. Each app process keeps one dedicated connection LISTENing
+on that channel and hands every payload to the local subscribers. The payload
+is framed once and the same bytes are queued for all of them, so a
+notification costs one deque append per subscriber.
+
+A subscriber that falls more than AVAILABILITY_MAX_PENDING messages behind has
+its backlog replaced by a single reset message, and so does everyone when the
+listening connection is lost. A reset means changes may have been missed and
+the client should fetch /api/books again. When the process drains for shutdown
+every stream is ended, so clients reconnect to another process.
+
+The same connection keeps the catalog cache of the process in step with writes
+made by the other processes: each availability payload drops the cached
+entries of the books it lists, and a notification on CATALOG_CHANNEL
+(migration 13), or a lost connection, drops the whole catalog cache.
+"""
+from collections import deque
+from typing import List, Optional
+import asyncio
+import json
+import logging
+import os
+import asyncpg
+from database import DATABASE_URL, DB_CONNECT_TIMEOUT, invalidate_catalog_cache, invalidate_notified_availability
+from metrics import availability_notifications, availability_overflows
+from migrations import AVAILABILITY_CHANNEL, CATALOG_CHANNEL
+
+# Most subscribers served by one process; further requests are refused
+AVAILABILITY_MAX_SUBSCRIBERS = int(os.environ.get("AVAILABILITY_MAX_SUBSCRIBERS", 10000))
+# Messages queued for one subscriber before it is sent a reset instead
+AVAILABILITY_MAX_PENDING = int(os.environ.get("AVAILABILITY_MAX_PENDING", 100))
+# Seconds between keep-alives, which also check that the listening connection is still up
+AVAILABILITY_HEARTBEAT_SECONDS = float(os.environ.get("AVAILABILITY_HEARTBEAT_SECONDS", 15))
+# Seconds to wait before reconnecting after the listening connection was lost
+AVAILABILITY_RECONNECT_SECONDS = float(os.environ.get("AVAILABILITY_RECONNECT_SECONDS", 2))
+
+logger = logging.getLogger("uvicorn.error")
+
+
+class Message:
+    """A notification payload together with its Server-Sent Events frame."""
+
+    __slots__ = ("data", "frame")
+
+    def __init__(self, data: Optional[str], frame: bytes):
+        self.data = data  # JSON text sent over WebSockets; None for keep-alives
+        self.frame = frame
+
+    @classmethod
+    def event(cls, data: str):
+        return cls(data, b"data: " + data.encode() + b"\n\n")
+
+
+RESET = Message.event(json.dumps({"type": "reset"}))
+# Ends the stream it is delivered to
+CLOSE = Message(None, b"")
+# An SSE comment line, ignored by EventSource but enough to keep proxies from closing the stream
+HEARTBEAT = Message(None, b": ping\n\n")
+
+
+class Subscriber:
+    __slots__ = ("pending", "ready")
+
+    def __init__(self):
+        self.pending = deque()
+        self.ready = asyncio.Event()
+
+    # Wait for at least one message and take everything queued so far
+    async def receive(self) -> List[Message]:
+        await self.ready.wait()
+        self.ready.clear()
+        messages = list(self.pending)
+        self.pending.clear()
+        return messages
+
+
+class Broadcaster:
+    def __init__(self, max_subscribers: int, max_pending: int):
+        self.max_subscribers = max_subscribers
+        self.max_pending = max_pending
+        self.subscribers = set()
+        self.closed = False
+
+    def is_accepting(self) -> bool:
+        return not self.closed and len(self.subscribers) < self.max_subscribers
+
+    def subscribe(self) -> Subscriber:
+        subscriber = Subscriber()
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        self.subscribers.discard(subscriber)
+
+    def publish(self, message: Message):
+        for subscriber in self.subscribers:
+            pending = subscriber.pending
+            if len(pending) >= self.max_pending:
+                if pending[0] is not RESET:
+                    availability_overflows.inc()
+                pending.clear()
+                pending.append(RESET)
+            else:
+                pending.append(message)
+            subscriber.ready.set()
+
+    async def heartbeat(self):
+        self.publish(HEARTBEAT)
+
+    # End every stream and refuse new ones; safe to call from a signal handler
+    def close(self):
+        self.closed = True
+        for subscriber in self.subscribers:
+            subscriber.pending.append(CLOSE)
+            subscriber.ready.set()
+
+
+broadcaster = Broadcaster(AVAILABILITY_MAX_SUBSCRIBERS, AVAILABILITY_MAX_PENDING)
+
+
+def on_notification(connection, pid, channel, payload):
+    availability_notifications.inc()
+    invalidate_notified_availability(json.loads(payload))
+    broadcaster.publish(Message.event(payload))
+
+
+def on_catalog_change(connection, pid, channel, payload):
+    invalidate_catalog_cache()
+
+
+# Keep a connection to the primary LISTENing on AVAILABILITY_CHANNEL and CATALOG_CHANNEL, reconnecting whenever it is lost
+# Runs until cancelled; the pool is not used because a listening connection can never be handed back
+async def listen_for_availability():
+    # asyncpg takes a plain postgresql:// URL, without the driver that databases needs
+    dsn = DATABASE_URL.replace("postgresql+asyncpg://", "postgresql://", 1)
+    reconnecting = False
+    while True:
+        connection = None
+        try:
+            connection = await asyncpg.connect(dsn, timeout=DB_CONNECT_TIMEOUT)
+            lost = asyncio.Event()
+            connection.add_termination_listener(lambda _: lost.set())
+            await connection.add_listener(AVAILABILITY_CHANNEL, on_notification)
+            await connection.add_listener(CATALOG_CHANNEL, on_catalog_change)
+            # Changes made while nobody was listening are gone, so everyone reloads; the first
+            # connection is made right after startup filled the cache, which is kept
+            if reconnecting:
+                invalidate_catalog_cache()
+            reconnecting = True
+            broadcaster.publish(RESET)
+            logger.info(f"Listening for availability changes on {AVAILABILITY_CHANNEL}")
+            while not lost.is_set():
+                try:
+                    await asyncio.wait_for(lost.wait(), AVAILABILITY_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    # A connection dropped by the network may not report it until it is used
+                    await connection.fetchval("SELECT 1", timeout=DB_CONNECT_TIMEOUT)
+            logger.warning("Availability listener connection lost")
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Availability listener failed")
+        finally:
+            if connection is not None and not connection.is_closed():
+                await connection.close()
+        await asyncio.sleep(AVAILABILITY_RECONNECT_SECONDS)
@@ -0,0 +1,54 @@
+"""Periodic jobs and listeners run inside the app process.
+
+Each job runs in its own task, started with the app and cancelled on shutdown.
+A failing run is logged and retried at the next interval.
+"""
+import asyncio
+import logging
+import os
+from availability import AVAILABILITY_HEARTBEAT_SECONDS, broadcaster, listen_for_availability
+from database import refresh_most_borrowed_boards, refresh_user_overdue_counts
+from metrics import METRICS_DIR, METRICS_FLUSH_SECONDS, flush_metrics
+
+logger = logging.getLogger("uvicorn.error")
+
+# Seconds between refreshes of the per-user overdue counts
+OVERDUE_REFRESH_SECONDS = float(os.environ.get("OVERDUE_REFRESH_SECONDS", 60))
+
+# Seconds between reloads of the most-borrowed leaderboards
+MOST_BORROWED_REFRESH_SECONDS = float(os.environ.get("MOST_BORROWED_REFRESH_SECONDS", 30))
+
+background_tasks = []
+
+
+async def run_periodically(name: str, interval: float, job):
+    while True:
+        try:
+            await job()
+        except Exception:
+            logger.exception(f"Background job {name} failed")
+        await asyncio.sleep(interval)
+
+
+def start_background_tasks():
+    background_tasks.append(asyncio.create_task(
+        run_periodically("refresh-overdue-counts", OVERDUE_REFRESH_SECONDS, refresh_user_overdue_counts)
+    ))
+    background_tasks.append(asyncio.create_task(
+        run_periodically("refresh-most-borrowed", MOST_BORROWED_REFRESH_SECONDS, refresh_most_borrowed_boards)
+    ))
+    background_tasks.append(asyncio.create_task(listen_for_availability()))
+    background_tasks.append(asyncio.create_task(
+        run_periodically("availability-heartbeat", AVAILABILITY_HEARTBEAT_SECONDS, broadcaster.heartbeat)
+    ))
+    if METRICS_DIR is not None:
+        background_tasks.append(asyncio.create_task(
+            run_periodically("flush-metrics", METRICS_FLUSH_SECONDS, flush_metrics)
+        ))
+
+
+async def stop_background_tasks():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
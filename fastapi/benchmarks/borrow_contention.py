@@ -0,0 +1,82 @@
+"""Measure borrow throughput when many clients check out the same title.
+
+Run from the fastapi directory against a database that has the app schema:
+
+    python -m benchmarks.borrow_contention --clients 200 --stock 100
+
+The benchmark creates a throwaway user and book, fires concurrent borrows at
+the book with the legacy three-step path and with the atomic borrow_book
+statement, and reports borrows per second and how many copies were oversold.
+"""
+import argparse
+import asyncio
+import time
+from database import *
+
+
+# Legacy create_borrow path: check stock, insert, then decrement without checking the result
+# Stock is read straight from the books row, as the legacy path did before the catalog cache existed
+async def legacy_borrow(user_id: int, book_id: int, borrow_quantity: int):
+    book = await database.fetch_one(
+        "SELECT available_quantity FROM books WHERE book_id = :book_id", {"book_id": book_id}
+    )
+    if book["available_quantity"] >= borrow_quantity:
+        result = await insert_borrow(user_id, book_id, borrow_quantity)
+        await update_book_quantity_on_borrow(book_id, borrow_quantity)
+        return result
+    return None
+
+
+async def run_case(name: str, borrow, user_id: int, clients: int, stock: int):
+    book = await insert_book(f"bench-{name}-{time.time()}", stock, None, None, None)
+    book_id = book["book_id"]
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(borrow(user_id, book_id, 1) for _ in range(clients)))
+    elapsed = time.perf_counter() - started
+
+    granted = sum(1 for result in results if result is not None)
+    borrowed = await database.fetch_one(
+        "SELECT COALESCE(SUM(borrow_quantity), 0) FROM borrow WHERE book_id = :book_id", {"book_id": book_id}
+    )
+    print(
+        f"{name:>8}: {clients / elapsed:8.1f} requests/s, {granted} granted, "
+        f"{max(borrowed[0] - stock, 0)} oversold ({elapsed * 1000:.1f} ms total)"
+    )
+
+    await delete_book_borrows(book_id)
+    await delete_book(book_id)
+
+
+# Delete every borrow of the benchmark book, taking them back off the rollups and user counters
+async def delete_book_borrows(book_id: int):
+    query = """
+    WITH deleted AS (
+        DELETE FROM borrow WHERE book_id = :book_id RETURNING *
+    ), """ + rollup_remove_cte("deleted") + """
+    SELECT * FROM deleted
+    """
+    rows = await database.fetch_all(query, {"book_id": book_id})
+    adjust_most_borrowed(rows, -1)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=200, help="concurrent borrow requests")
+    parser.add_argument("--stock", type=int, default=100, help="copies of the contended title")
+    args = parser.parse_args()
+
+    await connect_db()
+    try:
+        user = await insert_user(f"bench-{time.time()}", "bench", f"bench-{time.time()}@example.com")
+        try:
+            await run_case("legacy", legacy_borrow, user["user_id"], args.clients, args.stock)
+            await run_case("atomic", borrow_book, user["user_id"], args.clients, args.stock)
+        finally:
+            await delete_user(user["user_id"])
+    finally:
+        await disconnect_db()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,241 @@
+"""Drive a running API with concurrent clients and report latency per endpoint.
+
+Every route in routes/ gets its own timed run: --concurrency clients send
+requests back to back for --duration seconds. Request parameters come from a
+seeded random generator, so two runs against the same seeded database send the
+same requests. Results (throughput, mean and p50/p95/p99 latency, errors) are
+written as JSON together with the run configuration. Pass --compare with an
+earlier result file to print the change per endpoint.
+
+Seed the database with benchmarks/seed.py, start the app, then from the fastapi
+directory:
+
+    python -m benchmarks.load_test --base-url http://localhost:8000 --output results.json
+    python -m benchmarks.load_test --compare results.json --output results-after.json
+"""
+import argparse
+import asyncio
+import json
+import platform
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+import httpx
+from benchmarks.seed import SEED_PASSWORD
+
+
+# Nearest-rank percentile of an already sorted list
+def percentile(sorted_values: list, fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+class Sample:
+    """Ids picked from the seeded database, used to build request parameters."""
+
+    def __init__(self, rng: random.Random, book_ids: list, user_ids: list, borrow_ids: list, emails: list):
+        self.rng = rng
+        self.book_ids = book_ids
+        self.user_ids = user_ids
+        self.borrow_ids = borrow_ids
+        self.emails = emails
+
+    def book_id(self):
+        return self.rng.choice(self.book_ids)
+
+    def user_id(self):
+        return self.rng.choice(self.user_ids)
+
+    def borrow_id(self):
+        return self.rng.choice(self.borrow_ids)
+
+
+# Each endpoint is (name, coroutine that sends one request and returns the response)
+def build_endpoints(sample: Sample):
+    def get(path_factory, **params):
+        return lambda client: client.get(path_factory(), params=params or None)
+
+    # Borrow one copy and return it right away so stock does not run out during the run.
+    # The bulk endpoint is used because it reports the new borrow_id.
+    async def borrow_and_return(client):
+        response = await client.post(
+            "/api/borrows/bulk",
+            json={"items": [{"user_id": sample.user_id(), "book_id": sample.book_id(), "borrow_quantity": 1}]},
+        )
+        if response.status_code == 200:
+            borrow_id = response.json()[0].get("borrow_id")
+            if borrow_id:
+                return await client.put(f"/api/borrows/{borrow_id}", json={"return_date": datetime.now().isoformat()})
+        return response
+
+    async def login(client):
+        return await client.post(
+            "/api/users/login", json={"email": sample.rng.choice(sample.emails), "password_hash": SEED_PASSWORD}
+        )
+
+    return [
+        ("GET /api/books", get(lambda: "/api/books")),
+        ("GET /api/books?genre_id", get(lambda: "/api/books", genre_id=1)),
+        ("GET /api/books/{book_id}", get(lambda: f"/api/books/{sample.book_id()}")),
+        ("GET /api/books/unique_count", get(lambda: "/api/books/unique_count")),
+        ("GET /api/books/total-count", get(lambda: "/api/books/total-count")),
+        ("GET /api/books/available-count", get(lambda: "/api/books/available-count")),
+        ("GET /api/books/most-borrowed", get(lambda: "/api/books/most-borrowed", window="7d")),
+        ("GET /api/books/genres/count", get(lambda: "/api/books/genres/count")),
+        ("GET /api/genres", get(lambda: "/api/genres")),
+        ("GET /api/genres-with-books", get(lambda: "/api/genres-with-books")),
+        ("GET /api/users", get(lambda: "/api/users")),
+        ("GET /api/users/{user_id}", get(lambda: f"/api/users/{sample.user_id()}")),
+        ("GET /api/users/count", get(lambda: "/api/users/count")),
+        ("GET /api/users_with_borrow_count", get(lambda: "/api/users_with_borrow_count")),
+        ("POST /api/users/login", login),
+        ("GET /api/borrows", get(lambda: "/api/borrows")),
+        ("GET /api/borrows?not_returned", get(lambda: "/api/borrows", not_returned="true")),
+        ("GET /api/borrows/overdue", get(lambda: "/api/borrows/overdue")),
+        ("GET /api/borrows/overdue/users", get(lambda: "/api/borrows/overdue/users")),
+        ("GET /api/borrows/{borrow_id}", get(lambda: f"/api/borrows/{sample.borrow_id()}")),
+        ("GET /api/borrows/user/{user_id}", get(lambda: f"/api/borrows/user/{sample.user_id()}")),
+        ("GET /api/borrows/count", get(lambda: "/api/borrows/count")),
+        ("GET /api/borrows/weekly-stats", get(lambda: "/api/borrows/weekly-stats")),
+        ("GET /api/borrows/stats", get(lambda: "/api/borrows/stats", granularity="week")),
+        ("POST /api/borrows/bulk + PUT", borrow_and_return),
+        ("GET /api/dashboard/summary", get(lambda: "/api/dashboard/summary")),
+        ("GET /api/cache/stats", get(lambda: "/api/cache/stats")),
+        ("GET /api/exports/books", get(lambda: "/api/exports/books")),
+        ("GET /api/exports/users", get(lambda: "/api/exports/users")),
+        ("GET /api/exports/borrows?not_returned", get(lambda: "/api/exports/borrows", not_returned="true")),
+    ]
+
+
+async def load_sample(client: httpx.AsyncClient, rng: random.Random):
+    books = (await client.get("/api/books", params={"limit": 1000})).json()
+    users = (await client.get("/api/users", params={"limit": 1000})).json()
+    borrows = (await client.get("/api/borrows", params={"limit": 1000})).json()
+    return Sample(
+        rng,
+        [book["book_id"] for book in books],
+        [user["user_id"] for user in users],
+        [borrow["borrow_id"] for borrow in borrows],
+        [user["email"] for user in users],
+    )
+
+
+async def run_endpoint(client: httpx.AsyncClient, send, concurrency: int, duration: float):
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+
+    async def worker():
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                response = await send(client)
+                # 404 is an expected answer for some random ids, not a failure of the endpoint
+                if response.status_code >= 400 and response.status_code != 404:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput_rps": len(latencies) / elapsed,
+        "mean_ms": sum(latencies) / len(latencies) * 1000 if latencies else 0.0,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_comparison(results: dict, previous: dict):
+    before = {endpoint["name"]: endpoint for endpoint in previous["endpoints"]}
+    print(f"{'endpoint':<36} {'rps':>9} {'change':>8} {'p99 ms':>9} {'change':>8}", file=sys.stderr)
+    for endpoint in results["endpoints"]:
+        old = before.get(endpoint["name"])
+        if old is None:
+            continue
+        rps_change = (endpoint["throughput_rps"] / old["throughput_rps"] - 1) * 100 if old["throughput_rps"] else 0
+        p99_change = (endpoint["p99_ms"] / old["p99_ms"] - 1) * 100 if old["p99_ms"] else 0
+        print(
+            f"{endpoint['name']:<36} {endpoint['throughput_rps']:9.1f} {rps_change:+7.1f}% "
+            f"{endpoint['p99_ms']:9.1f} {p99_change:+7.1f}%",
+            file=sys.stderr,
+        )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--concurrency", type=int, default=32, help="concurrent clients per endpoint")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per endpoint")
+    parser.add_argument("--warmup", type=float, default=2.0, help="unmeasured seconds per endpoint before timing")
+    parser.add_argument("--seed", type=int, default=42, help="seed for request parameters")
+    parser.add_argument("--only", help="run only endpoints whose name contains this text")
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    parser.add_argument("--compare", help="earlier JSON results to compare against")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.base_url, limits=limits, timeout=60.0) as client:
+        sample = await load_sample(client, rng)
+        results = {
+            "meta": {
+                "started_at": datetime.now(timezone.utc).isoformat(),
+                "git_commit": git_commit(),
+                "python": platform.python_version(),
+                "base_url": args.base_url,
+                "concurrency": args.concurrency,
+                "duration_s": args.duration,
+                "warmup_s": args.warmup,
+                "seed": args.seed,
+            },
+            "endpoints": [],
+        }
+        for name, send in build_endpoints(sample):
+            if args.only and args.only not in name:
+                continue
+            if args.warmup:
+                await run_endpoint(client, send, args.concurrency, args.warmup)
+            stats = await run_endpoint(client, send, args.concurrency, args.duration)
+            results["endpoints"].append({"name": name, **stats})
+            print(
+                f"{name:<36} {stats['throughput_rps']:9.1f} req/s  p50 {stats['p50_ms']:7.1f} ms  "
+                f"p95 {stats['p95_ms']:7.1f} ms  p99 {stats['p99_ms']:7.1f} ms  errors {stats['errors']}",
+                file=sys.stderr,
+            )
+
+    if args.compare:
+        with open(args.compare) as previous_file:
+            print_comparison(results, json.load(previous_file))
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
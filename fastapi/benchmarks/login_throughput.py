@@ -0,0 +1,58 @@
+"""Measure password verification throughput at several scrypt cost settings.
+
+For each cost, N concurrent logins are verified through the credential thread
+pool while a probe task measures how late the event loop wakes up, which shows
+that hashing does not stall other requests. No database is needed. Run from
+the fastapi directory:
+
+    python -m benchmarks.login_throughput --logins 64 --costs 14 15 16
+"""
+import argparse
+import asyncio
+import time
+import credentials
+
+
+async def loop_lag_probe(stop: asyncio.Event, lags: list, interval: float = 0.005):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - started - interval)
+
+
+async def run_cost(log_n: int, logins: int):
+    stored = credentials.hash_password_sync("correct horse battery staple", n=2 ** log_n)
+    stop = asyncio.Event()
+    lags = []
+    probe = asyncio.create_task(loop_lag_probe(stop, lags))
+
+    started = time.perf_counter()
+    results = await asyncio.gather(
+        *(credentials.verify_password("correct horse battery staple", stored) for _ in range(logins))
+    )
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await probe
+
+    assert all(results)
+    memory_mib = 128 * 2 ** log_n * credentials.PASSWORD_HASH_R / 2 ** 20
+    print(
+        f"n=2^{log_n:<2} ({memory_mib:5.0f} MiB/hash): {logins / elapsed:7.1f} logins/s, "
+        f"{elapsed / logins * credentials.PASSWORD_HASH_WORKERS * 1000:6.1f} ms/hash, "
+        f"max loop lag {max(lags, default=0) * 1000:.1f} ms"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--logins", type=int, default=64, help="concurrent logins per cost setting")
+    parser.add_argument("--costs", type=int, nargs="+", default=[14, 15, 16], help="scrypt log2(n) values")
+    args = parser.parse_args()
+
+    print(f"{credentials.PASSWORD_HASH_WORKERS} hashing threads")
+    for log_n in args.costs:
+        await run_cost(log_n, args.logins)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
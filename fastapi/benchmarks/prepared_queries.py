@@ -0,0 +1,87 @@
+"""Compare the databases-library path with the prepared asyncpg path for the hot lookups.
+
+Needs a database with some books, users and borrows. Run from the fastapi directory:
+
+    python -m benchmarks.prepared_queries --calls 20000 --concurrency 8
+"""
+import argparse
+import asyncio
+import time
+from database import *
+
+
+# The previous get_book / get_user / get_borrow implementations, without the catalog cache
+async def text_get_book(book_id: int):
+    query = """
+    SELECT b.book_id, b.book_name, b.book_quantity, b.available_quantity, b.book_description, b.book_pic, b.genre_id, g.genre_name
+    FROM books b
+    LEFT JOIN genre g ON b.genre_id = g.genre_id
+    WHERE b.book_id = :book_id
+    """
+    return await database.fetch_one(query=query, values={"book_id": book_id})
+
+
+async def text_get_user(user_id: int):
+    return await database.fetch_one("SELECT * FROM users WHERE user_id = :user_id", values={"user_id": user_id})
+
+
+async def text_get_borrow(borrow_id: int):
+    query = """
+    SELECT b.borrow_id, b.user_id, u.username, b.book_id, bk.book_name, b.borrow_quantity, b.borrow_date, b.return_date
+    FROM borrow b
+    JOIN users u ON b.user_id = u.user_id
+    JOIN books bk ON b.book_id = bk.book_id
+    WHERE borrow_id = :borrow_id
+    """
+    return await database.fetch_one(query=query, values={"borrow_id": borrow_id})
+
+
+async def prepared_get_book(book_id: int):
+    return await GET_BOOK.fetchrow(database, book_id)
+
+
+async def prepared_get_user(user_id: int):
+    return await GET_USER.fetchrow(database, user_id)
+
+
+async def prepared_get_borrow(borrow_id: int):
+    return await GET_BORROW.fetchrow(database, borrow_id)
+
+
+async def measure(name: str, call, ids: list, calls: int, concurrency: int):
+    async def worker(offset: int):
+        for i in range(offset, calls, concurrency):
+            await call(ids[i % len(ids)])
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(offset) for offset in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    print(f"{name:>18}: {calls / elapsed:9,.0f} calls/s ({elapsed / calls * 1e6:6.1f} us/call)")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--calls", type=int, default=20000, help="calls per function and path")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent callers")
+    args = parser.parse_args()
+
+    await connect_db()
+    try:
+        cases = [
+            ("book", "SELECT book_id FROM books LIMIT 1000", text_get_book, prepared_get_book),
+            ("user", "SELECT user_id FROM users LIMIT 1000", text_get_user, prepared_get_user),
+            ("borrow", "SELECT borrow_id FROM borrow LIMIT 1000", text_get_borrow, prepared_get_borrow),
+        ]
+        for name, id_query, text_call, prepared_call in cases:
+            ids = [row[0] for row in await database.fetch_all(id_query)]
+            if not ids:
+                print(f"no {name} rows, skipping")
+                continue
+            await measure(f"get_{name} text", text_call, ids, args.calls, args.concurrency)
+            await measure(f"get_{name} prepared", prepared_call, ids, args.calls, args.concurrency)
+    finally:
+        await disconnect_db()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
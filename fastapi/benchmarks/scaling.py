@@ -0,0 +1,161 @@
+"""Measure cold start, throughput and shutdown of serve.py by worker count.
+
+For each worker count the launcher is started on a free port. Cold start is
+reported twice: until /health/ready first answers 200, and until every worker
+has logged that it is ready. The selected endpoints are then driven as in
+benchmarks.load_test, and finally the launcher is sent SIGTERM and timed until
+it exits. The JSON result lists every run, and a summary table with the
+throughput relative to one worker is printed to stderr.
+
+Seed the database with benchmarks/seed.py, stop any running app, then from the
+fastapi directory:
+
+    python -m benchmarks.scaling --workers 1 2 4 8 --output scaling.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import signal
+import socket
+import sys
+import time
+from datetime import datetime, timezone
+import httpx
+from benchmarks.load_test import build_endpoints, git_commit, load_sample, run_endpoint
+
+# Endpoints driven at each worker count unless --only is given
+DEFAULT_ENDPOINTS = ["GET /api/books/{book_id}", "GET /api/books?genre_id", "GET /api/users_with_borrow_count"]
+
+
+def free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+async def wait_until_ready(client: httpx.AsyncClient, process, timeout: float):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if process.returncode is not None:
+            raise RuntimeError(f"serve.py exited with {process.returncode} during startup")
+        try:
+            if (await client.get("/health/ready")).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(0.05)
+    raise RuntimeError(f"serve.py was not ready after {timeout:.0f}s")
+
+
+async def measure(workers: int, args, names: list):
+    port = free_port()
+    started = time.perf_counter()
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, "serve.py", "--workers", str(workers), "--host", "127.0.0.1", "--port", str(port),
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE,
+    )
+    ready_times = []
+    all_ready = asyncio.Event()
+
+    # Every worker logs "Ready in ..." at the end of its lifespan startup
+    async def read_log():
+        async for line in process.stderr:
+            if b"Ready in" in line:
+                ready_times.append(time.perf_counter() - started)
+                if len(ready_times) == workers:
+                    all_ready.set()
+
+    reader = asyncio.create_task(read_log())
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=60.0) as client:
+            await wait_until_ready(client, process, args.startup_timeout)
+            first_ready = time.perf_counter() - started
+            await asyncio.wait_for(all_ready.wait(), args.startup_timeout)
+
+            sample = await load_sample(client, random.Random(args.seed))
+            endpoints = []
+            for name, send in build_endpoints(sample):
+                if name not in names:
+                    continue
+                if args.warmup:
+                    await run_endpoint(client, send, args.concurrency, args.warmup)
+                stats = await run_endpoint(client, send, args.concurrency, args.duration)
+                endpoints.append({"name": name, **stats})
+    finally:
+        stopping = time.perf_counter()
+        if process.returncode is None:
+            process.send_signal(signal.SIGTERM)
+        await process.wait()
+        shutdown = time.perf_counter() - stopping
+        reader.cancel()
+
+    return {
+        "workers": workers,
+        "first_ready_s": first_ready,
+        "all_ready_s": ready_times[-1],
+        "shutdown_s": shutdown,
+        "endpoints": endpoints,
+    }
+
+
+def print_summary(runs: list):
+    baseline = {endpoint["name"]: endpoint["throughput_rps"] for endpoint in runs[0]["endpoints"]}
+    print(f"{'workers':>7} {'ready s':>8} {'all s':>7} {'stop s':>7}  endpoint", file=sys.stderr)
+    for run in runs:
+        for endpoint in run["endpoints"]:
+            base = baseline.get(endpoint["name"])
+            speedup = endpoint["throughput_rps"] / base if base else 0
+            print(
+                f"{run['workers']:7d} {run['first_ready_s']:8.2f} {run['all_ready_s']:7.2f} {run['shutdown_s']:7.2f}  "
+                f"{endpoint['name']:<36} {endpoint['throughput_rps']:9.1f} req/s  x{speedup:.2f}  "
+                f"p99 {endpoint['p99_ms']:7.1f} ms",
+                file=sys.stderr,
+            )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="worker counts to measure")
+    parser.add_argument("--concurrency", type=int, default=64, help="concurrent clients per endpoint")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per endpoint")
+    parser.add_argument("--warmup", type=float, default=2.0, help="unmeasured seconds per endpoint before timing")
+    parser.add_argument("--startup-timeout", type=float, default=120.0, help="seconds to wait for the workers")
+    parser.add_argument("--seed", type=int, default=42, help="seed for request parameters")
+    parser.add_argument("--only", nargs="+", default=DEFAULT_ENDPOINTS, help="endpoint names, as in load_test")
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    results = {
+        "meta": {
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+            "concurrency": args.concurrency,
+            "duration_s": args.duration,
+            "warmup_s": args.warmup,
+            "seed": args.seed,
+        },
+        "runs": [],
+    }
+    for workers in args.workers:
+        run = await measure(workers, args, args.only)
+        results["runs"].append(run)
+        print(f"{workers} workers: ready in {run['first_ready_s']:.2f}s, all in {run['all_ready_s']:.2f}s, "
+              f"stopped in {run['shutdown_s']:.2f}s", file=sys.stderr)
+    print_summary(results["runs"])
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,151 @@
+"""Seed a local database with synthetic, reproducible library data.
+
+Genres, users, books and borrows are generated from a fixed random seed with a
+Zipf-like skew (a few popular titles, genres and heavy borrowers) and loaded
+with COPY in chunks, so even tens of millions of borrows use little memory.
+Run from the fastapi directory against a scratch database:
+
+    python -m benchmarks.seed --reset --borrows 1000000
+
+--reset empties the books, genre, users and borrow tables first.
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import time
+from datetime import datetime, timedelta
+
+# Seeding scans and rewrites whole tables, so it is not subject to the API's statement timeout
+os.environ.setdefault("DB_STATEMENT_TIMEOUT_MS", "0")
+
+from credentials import hash_password_sync
+from database import *
+from migrations import LOAN_PERIOD_DAYS
+
+COPY_CHUNK_ROWS = 50000
+
+# Every seeded user logs in with this password (see benchmarks/load_test.py)
+SEED_PASSWORD = "benchmark-password"
+
+
+# Cumulative Zipf weights for choosing among count items, the first being the most popular
+def zipf_cum_weights(count: int, exponent: float):
+    return list(itertools.accumulate(1 / (rank ** exponent) for rank in range(1, count + 1)))
+
+
+async def copy_rows(table: str, columns: list, rows):
+    async with database.connection() as connection:
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= COPY_CHUNK_ROWS:
+                await connection.raw_connection.copy_records_to_table(table, records=chunk, columns=columns)
+                chunk = []
+        if chunk:
+            await connection.raw_connection.copy_records_to_table(table, records=chunk, columns=columns)
+
+
+async def fetch_ids(query: str):
+    return [row[0] for row in await database.fetch_all(query)]
+
+
+def generate_borrows(rng: random.Random, user_ids: list, book_ids: list, count: int, days: int, skew: float):
+    user_weights = zipf_cum_weights(len(user_ids), skew)
+    book_weights = zipf_cum_weights(len(book_ids), skew)
+    now = datetime.now().replace(microsecond=0)
+    for _ in range(count):
+        borrow_date = now - timedelta(seconds=rng.randrange(days * 86400))
+        return_date = borrow_date + timedelta(days=rng.randint(1, 30))
+        # About 10% of borrows are still out, and none can be returned in the future
+        if return_date > now or rng.random() < 0.1:
+            return_date = None
+        yield (
+            rng.choices(user_ids, cum_weights=user_weights)[0],
+            rng.choices(book_ids, cum_weights=book_weights)[0],
+            rng.choice((1, 1, 1, 2)),
+            borrow_date,
+            return_date,
+            borrow_date + timedelta(days=LOAN_PERIOD_DAYS),
+        )
+
+
+async def seed(args):
+    rng = random.Random(args.seed)
+    if args.reset:
+        await database.execute("TRUNCATE borrow, books, users, genre RESTART IDENTITY CASCADE")
+
+    started = time.perf_counter()
+    await copy_rows(
+        "genre", ["genre_name", "genre_description"],
+        ((f"Genre {i}", f"Synthetic genre number {i}") for i in range(args.genres)),
+    )
+    genre_ids = await fetch_ids("SELECT genre_id FROM genre ORDER BY genre_id")
+    genre_weights = zipf_cum_weights(len(genre_ids), args.skew)
+
+    # One real scrypt hash shared by every user keeps seeding fast while logins stay realistic
+    password_hash = hash_password_sync(SEED_PASSWORD)
+    run_tag = f"{args.seed}-{int(time.time())}"
+    await copy_rows(
+        "users", ["username", "password_hash", "email"],
+        ((f"user{i}", password_hash, f"user{i}-{run_tag}@example.com") for i in range(args.users)),
+    )
+    user_ids = await fetch_ids("SELECT user_id FROM users ORDER BY user_id")
+
+    await copy_rows(
+        "books", ["book_name", "book_quantity", "available_quantity", "book_description", "book_pic", "genre_id"],
+        (
+            (f"Book {i}", 0, 0, f"Synthetic book number {i}", None, rng.choices(genre_ids, cum_weights=genre_weights)[0])
+            for i in range(args.books)
+        ),
+    )
+    book_ids = await fetch_ids("SELECT book_id FROM books ORDER BY book_id")
+    print(f"seeded {len(genre_ids)} genres, {len(user_ids)} users, {len(book_ids)} books "
+          f"in {time.perf_counter() - started:.1f}s")
+
+    started = time.perf_counter()
+    await copy_rows(
+        "borrow", ["user_id", "book_id", "borrow_quantity", "borrow_date", "return_date", "due_date"],
+        generate_borrows(rng, user_ids, book_ids, args.borrows, args.days, args.skew),
+    )
+    print(f"seeded {args.borrows} borrows in {time.perf_counter() - started:.1f}s")
+
+    # Size each title's stock so every outstanding borrow fits, with a few copies left on the shelf
+    await database.execute("UPDATE books SET book_quantity = 1 + mod(book_id, 5), available_quantity = 1 + mod(book_id, 5)")
+    await database.execute("""
+    UPDATE books bk
+    SET book_quantity = bk.book_quantity + o.outstanding
+    FROM (
+        SELECT book_id, SUM(borrow_quantity) AS outstanding FROM borrow WHERE return_date IS NULL GROUP BY book_id
+    ) o
+    WHERE bk.book_id = o.book_id
+    """)
+    await backfill_borrow_rollup()
+    await repair_user_borrow_counts()
+    await refresh_user_overdue_counts()
+    await database.execute("ANALYZE")
+    invalidate_catalog_lists()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--genres", type=int, default=20)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--books", type=int, default=50000)
+    parser.add_argument("--borrows", type=int, default=10000, help="for example 10000, 1000000 or 10000000")
+    parser.add_argument("--days", type=int, default=365, help="spread borrow dates over this many past days")
+    parser.add_argument("--skew", type=float, default=1.1, help="Zipf exponent for genre, user and book popularity")
+    parser.add_argument("--seed", type=int, default=42, help="random seed; the same seed gives the same data")
+    parser.add_argument("--reset", action="store_true", help="empty the library tables first")
+    args = parser.parse_args()
+
+    await connect_db()
+    try:
+        await seed(args)
+    finally:
+        await disconnect_db()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
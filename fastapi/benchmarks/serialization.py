@@ -0,0 +1,70 @@
+"""Compare rows per second of the default and the fast list serialization paths.
+
+No database is needed; rows are synthesized in memory. Run from the fastapi
+directory:
+
+    python -m benchmarks.serialization --rows 100000
+"""
+import argparse
+import json
+import time
+from datetime import datetime, timedelta
+from typing import List
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+from fast_json import encode_rows
+from routes.borrow import Borrow
+
+
+def make_rows(count: int):
+    started = datetime(2024, 1, 1)
+    return [
+        {
+            "borrow_id": i,
+            "user_id": i % 5000,
+            "username": f"user{i % 5000}",
+            "book_id": i % 20000,
+            "book_name": f"Book number {i % 20000}",
+            "borrow_quantity": 1 + i % 3,
+            "borrow_date": started + timedelta(minutes=i),
+            "return_date": None if i % 4 else started + timedelta(days=1, minutes=i),
+        }
+        for i in range(count)
+    ]
+
+
+# What FastAPI does for response_model=List[Borrow]: validate, run jsonable_encoder, then json.dumps
+def default_path(rows):
+    validated = TypeAdapter(List[Borrow]).validate_python(rows)
+    return json.dumps(jsonable_encoder(validated)).encode()
+
+
+def fast_path(rows):
+    return encode_rows(rows, Borrow)
+
+
+def measure(name: str, encode, rows, repeat: int):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        body = encode(rows)
+        best = min(best, time.perf_counter() - started)
+    print(f"{name:>8}: {len(rows) / best:12,.0f} rows/s ({best * 1000:.1f} ms, {len(body):,} bytes)")
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100000, help="rows per response")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per path; the best run is reported")
+    args = parser.parse_args()
+
+    rows = make_rows(args.rows)
+    assert json.loads(default_path(rows[:100])) == json.loads(fast_path(rows[:100])), "paths disagree"
+    default = measure("default", default_path, rows, args.repeat)
+    fast = measure("fast", fast_path, rows, args.repeat)
+    print(f"speedup: {default / fast:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
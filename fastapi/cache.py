@@ -0,0 +1,310 @@
+from collections import Counter, OrderedDict
+from typing import Any, Awaitable, Callable, Hashable
+import asyncio
+import hashlib
+import os
+import sys
+import time
+
+# Settings for the in-process catalog cache
+CATALOG_CACHE_TTL_SECONDS = 60.0
+CATALOG_CACHE_MAX_ENTRIES = 10000
+CATALOG_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+# Seconds a finished aggregate read is handed to later identical reads (0 only shares in-flight reads)
+READ_COALESCE_TTL_SECONDS = float(os.environ.get("READ_COALESCE_TTL_SECONDS", 0))
+READ_COALESCE_MAX_ENTRIES = 1000
+
+
+# Rough estimate of the memory held by a cached value
+def estimate_size(value: Any) -> int:
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(estimate_size(k) + estimate_size(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(estimate_size(item) for item in value)
+    return size
+
+
+# Strong ETag derived from the bytes of a response body
+def content_etag(body: bytes) -> str:
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+# Mark the exception of a shared load as retrieved, for loads whose callers were all cancelled
+def _retrieve_exception(task: asyncio.Task):
+    if not task.cancelled():
+        task.exception()
+
+
+class SingleFlight:
+    """Share one in-flight load between concurrent callers asking for the same key.
+
+    The first caller for a key starts the load; callers arriving before it
+    finishes wait for that load instead of starting their own, and all of
+    them get its result or its exception. With a ttl the result is also
+    handed to callers arriving up to ttl seconds after it finished.
+    """
+
+    def __init__(self, name: str, ttl: float = 0.0, max_entries: int = READ_COALESCE_MAX_ENTRIES):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._in_flight = {}  # key -> task running the load
+        self._recent = OrderedDict()  # key -> (expires_at, value)
+        # Bumped by clear() so loads started before it do not fill _recent
+        self._generation = 0
+        self.executions = 0
+        self.coalesced = 0
+        self.reused = 0
+
+    async def run(self, key: Hashable, loader: Callable[[], Awaitable[Any]]):
+        if self.ttl > 0:
+            entry = self._recent.get(key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self.reused += 1
+                    return entry[1]
+                del self._recent[key]
+        task = self._in_flight.get(key)
+        if task is None:
+            self.executions += 1
+            # The loader is called here, not in the task, so whatever it does before its first await happens now
+            task = asyncio.ensure_future(self._load(key, loader(), self._generation))
+            task.add_done_callback(_retrieve_exception)
+            self._in_flight[key] = task
+        else:
+            self.coalesced += 1
+        # Shielded so a caller that goes away does not cancel the load for the others
+        return await asyncio.shield(task)
+
+    async def _load(self, key: Hashable, load: Awaitable[Any], generation: int):
+        try:
+            value = await load
+        finally:
+            if self._in_flight.get(key) is asyncio.current_task():
+                del self._in_flight[key]
+        if self.ttl > 0 and generation == self._generation:
+            self._recent.pop(key, None)
+            self._recent[key] = (time.monotonic() + self.ttl, value)
+            while len(self._recent) > self.max_entries:
+                self._recent.popitem(last=False)
+        return value
+
+    # Make later callers for the matching keys start fresh loads; loads already running still finish for their callers
+    def forget(self, predicate: Callable[[Hashable], bool]):
+        for key in [k for k in self._in_flight if predicate(k)]:
+            del self._in_flight[key]
+        for key in [k for k in self._recent if predicate(k)]:
+            del self._recent[key]
+
+    # Make later callers start fresh loads; loads already running still finish for their callers
+    def clear(self):
+        self._generation += 1
+        self._in_flight.clear()
+        self._recent.clear()
+
+    def stats(self):
+        return {
+            "name": self.name,
+            "ttl_seconds": self.ttl,
+            "in_flight": len(self._in_flight),
+            "recent": len(self._recent),
+            "executions": self.executions,
+            "coalesced": self.coalesced,
+            "reused": self.reused,
+        }
+
+
+class TTLCache:
+    """In-process LRU cache whose entries expire after a fixed TTL.
+
+    The cache is bounded both by entry count and by the estimated size of
+    the stored values; the least recently used entries are evicted first.
+    Concurrent misses on the same key share a single load.
+
+    Invalidations only affect the keys they match. While loads are running,
+    each invalidation is also logged, and a load does not store its result if
+    an invalidation logged after it started matches it; later misses on a
+    matching key start a fresh load instead of joining one that started before.
+    """
+
+    def __init__(self, name: str, ttl: float, max_entries: int, max_bytes: int):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (expires_at, size, value)
+        self._bytes = 0
+        # Bumped by clear() so no load that started before it stores its result
+        self._generation = 0
+        # Invalidations made while loads were running, as (sequence, predicate on key and value)
+        self._invalidated = []
+        self._sequence = 0
+        self._loading = Counter()  # sequence at which a running load started -> loads
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._flights = SingleFlight(name)
+
+    def get(self, key: Hashable):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return False, None
+        expires_at, _, value = entry
+        if expires_at <= time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return False, None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return True, value
+
+    def set(self, key: Hashable, value: Any):
+        size = estimate_size(value)
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + self.ttl, size, value)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    async def get_or_load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]):
+        found, value = self.get(key)
+        if found:
+            return value
+        return await self._flights.run(key, lambda: self._start_load(key, loader))
+
+    # Called by the flight as soon as it is created, so the load is registered before any later invalidation
+    def _start_load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]):
+        started = self._sequence
+        self._loading[started] += 1
+        return self._load(key, loader, self._generation, started)
+
+    async def _load(self, key: Hashable, loader: Callable[[], Awaitable[Any]], generation: int, started: int):
+        try:
+            value = await loader()
+            # Results that are missing or were invalidated while loading are not cached
+            if value is not None and generation == self._generation and not self._invalidated_since(started, key, value):
+                self.set(key, value)
+            return value
+        finally:
+            self._finish_load(started)
+
+    def _invalidated_since(self, started: int, key: Hashable, value: Any) -> bool:
+        return any(sequence > started and predicate(key, value) for sequence, predicate in self._invalidated)
+
+    # Forget logged invalidations that no running load started before
+    def _finish_load(self, started: int):
+        self._loading[started] -= 1
+        if not self._loading[started]:
+            del self._loading[started]
+        if not self._loading:
+            self._invalidated.clear()
+        else:
+            oldest = min(self._loading)
+            self._invalidated = [entry for entry in self._invalidated if entry[0] > oldest]
+
+    def _log_invalidation(self, predicate: Callable[[Hashable, Any], bool]):
+        if self._loading:
+            self._sequence += 1
+            self._invalidated.append((self._sequence, predicate))
+
+    def invalidate(self, key: Hashable):
+        self._log_invalidation(lambda k, _: k == key)
+        self._flights.forget(lambda k: k == key)
+        if key in self._entries:
+            self._remove(key)
+            self.invalidations += 1
+
+    # Drop every entry whose key and value match the predicate
+    # The predicate is also asked about keys still loading, with a value of None, and must
+    # answer True when such a key may match
+    def invalidate_where(self, predicate: Callable[[Hashable, Any], bool]):
+        self._log_invalidation(predicate)
+        self._flights.forget(lambda k: predicate(k, None))
+        for key in [k for k, (_, _, v) in self._entries.items() if predicate(k, v)]:
+            self._remove(key)
+            self.invalidations += 1
+
+    def clear(self):
+        self._generation += 1
+        self._flights.clear()
+        self._entries.clear()
+        self._bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "name": self.name,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "coalesced": self._flights.coalesced,
+        }
+
+    def _remove(self, key: Hashable):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+
+class TopK:
+    """The highest-ranked items of a leaderboard, held in memory.
+
+    The board is loaded in full from the database with replace() and nudged
+    in between with adjust() as local writes change the scores of items
+    already on it. Items that are not on the board are picked up by the
+    next reload.
+    """
+
+    def __init__(self, name: str, capacity: int):
+        self.name = name
+        self.capacity = capacity
+        self.loaded_at = None
+        self._items = {}  # item id -> row dict with a "score" tuple used for ordering
+        self._ranked = []
+
+    def replace(self, rows: list, key: str, score: Callable[[dict], tuple]):
+        self._items = {row[key]: {**row, "score": score(row)} for row in rows[:self.capacity]}
+        self._rank()
+        self.loaded_at = time.monotonic()
+
+    # Apply changes to the fields of an item on the board, then recompute its score
+    def adjust(self, item: Hashable, deltas: dict, score: Callable[[dict], tuple]):
+        row = self._items.get(item)
+        if row is None:
+            return
+        for field, delta in deltas.items():
+            row[field] += delta
+        row["score"] = score(row)
+        self._rank()
+
+    def discard(self, item: Hashable):
+        if self._items.pop(item, None) is not None:
+            self._rank()
+
+    def top(self, limit: int):
+        return self._ranked[:limit]
+
+    def _rank(self):
+        self._ranked = sorted(self._items.values(), key=lambda row: row["score"], reverse=True)
+
+
+# Cache for book, genre and catalog-list lookups
+catalog_cache = TTLCache("catalog", CATALOG_CACHE_TTL_SECONDS, CATALOG_CACHE_MAX_ENTRIES, CATALOG_CACHE_MAX_BYTES)
+
+# Shared in-flight aggregate reads (counts and reports) that are not worth caching for long
+read_coalescer = SingleFlight("reads", READ_COALESCE_TTL_SECONDS)
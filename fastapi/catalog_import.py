@@ -0,0 +1,195 @@
+"""Streaming bulk import of books from CSV or NDJSON.
+
+Rows are read and validated one at a time and loaded with COPY in fixed-size
+chunks, so memory stays bounded no matter how large the file is. Rows that
+fail validation, or that the database rejects, are reported back instead of
+aborting the load.
+
+CSV files need a header row. Columns (or NDJSON keys) are book_name,
+book_quantity, book_description, book_pic and either genre (a genre name) or
+genre_id. Run from the fastapi directory:
+
+    python catalog_import.py books.csv
+    python catalog_import.py books.ndjson --chunk-size 10000
+"""
+import argparse
+import asyncio
+import codecs
+import csv
+import json
+import logging
+import time
+from typing import IO, Iterator, Optional
+import asyncpg
+from fastapi.concurrency import run_in_threadpool
+from database import *
+
+logger = logging.getLogger("uvicorn.error")
+
+# Rows sent to the database per COPY
+DEFAULT_CHUNK_SIZE = 5000
+
+# Rejected rows listed in the report; the rest are only counted
+MAX_REPORTED_ERRORS = 1000
+
+# Errors caused by the rows themselves; a chunk that fails with one of these is retried row by row
+ROW_ERRORS = (asyncpg.DataError, asyncpg.UniqueViolationError)
+
+
+class ImportReport:
+    def __init__(self):
+        self.inserted = 0
+        self.rejected = 0
+        self.errors = []
+        self.copy_errors = []
+
+    def reject(self, line: int, error: str):
+        self.rejected += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"line": line, "error": error})
+
+    # Record a chunk whose COPY failed and was loaded row by row instead
+    def copy_failed(self, first_line: int, last_line: int, error: str):
+        if len(self.copy_errors) < MAX_REPORTED_ERRORS:
+            self.copy_errors.append({"first_line": first_line, "last_line": last_line, "error": error})
+
+    def as_dict(self):
+        return {"inserted": self.inserted, "rejected": self.rejected, "errors": self.errors, "copy_errors": self.copy_errors}
+
+
+# Guess the file format from its name, defaulting to CSV
+def detect_format(filename: Optional[str]):
+    if filename and filename.lower().endswith((".ndjson", ".jsonl")):
+        return "ndjson"
+    return "csv"
+
+
+# Yield (line number, raw row dict) pairs from a binary file without reading it all at once
+def iter_rows(binary_file: IO[bytes], file_format: str) -> Iterator[tuple]:
+    text = codecs.getreader("utf-8-sig")(binary_file)
+    if file_format == "ndjson":
+        for line_number, line in enumerate(text, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield line_number, ValueError(f"Invalid JSON: {e}")
+                continue
+            yield line_number, row if isinstance(row, dict) else ValueError("Expected a JSON object")
+    elif file_format == "csv":
+        reader = csv.DictReader(text)
+        for row in reader:
+            yield reader.line_num, row
+    else:
+        raise ValueError(f"Unsupported format: {file_format}")
+
+
+# Turn a raw row into a record in BOOK_COPY_COLUMNS order, raising ValueError if it is invalid
+def validate_row(row: dict, genres_by_name: dict) -> tuple:
+    book_name = (row.get("book_name") or "").strip()
+    if not book_name:
+        raise ValueError("book_name is required")
+
+    try:
+        book_quantity = int(row.get("book_quantity"))
+    except (TypeError, ValueError):
+        raise ValueError("book_quantity must be an integer")
+    if book_quantity < 0:
+        raise ValueError("book_quantity must not be negative")
+
+    genre_id = None
+    genre_name = (row.get("genre") or row.get("genre_name") or "").strip()
+    if genre_name:
+        genre_id = genres_by_name.get(genre_name.lower())
+        if genre_id is None:
+            raise ValueError(f"Unknown genre: {genre_name}")
+    elif row.get("genre_id") not in (None, ""):
+        try:
+            genre_id = int(row["genre_id"])
+        except (TypeError, ValueError):
+            raise ValueError("genre_id must be an integer")
+        if genre_id not in genres_by_name.values():
+            raise ValueError(f"Unknown genre_id: {genre_id}")
+
+    book_description = row.get("book_description") or None
+    book_pic = row.get("book_pic") or None
+    return (book_name, book_quantity, book_quantity, book_description, book_pic, genre_id)
+
+
+# Read and validate rows until chunk_size of them are valid or the file ends, rejecting the rest
+# Blocking file reads happen here, so the import runs it in the threadpool
+def read_chunk(rows: Iterator[tuple], genres_by_name: dict, chunk_size: int, report: ImportReport) -> list:
+    chunk = []
+    for line_number, row in rows:
+        if isinstance(row, Exception):
+            report.reject(line_number, str(row))
+            continue
+        try:
+            chunk.append((line_number, validate_row(row, genres_by_name)))
+        except ValueError as e:
+            report.reject(line_number, str(e))
+            continue
+        if len(chunk) >= chunk_size:
+            break
+    return chunk
+
+
+# Load a validated chunk, falling back to row-by-row inserts to isolate rows the database rejects
+async def load_chunk(chunk: list, report: ImportReport):
+    records = [record for _, record in chunk]
+    try:
+        report.inserted += await copy_books_into_db(records)
+        return
+    except ROW_ERRORS as e:
+        logger.exception("COPY of lines %d-%d failed, loading them row by row", chunk[0][0], chunk[-1][0])
+        report.copy_failed(chunk[0][0], chunk[-1][0], str(e))
+    inserted = 0
+    try:
+        for line_number, record in chunk:
+            try:
+                await insert_book_record(record)
+                inserted += 1
+            except ROW_ERRORS as e:
+                report.reject(line_number, str(e))
+    finally:
+        report.inserted += inserted
+        if inserted:
+            invalidate_catalog_lists()
+
+
+# Import books from a binary file object and return the import report
+async def import_books(binary_file: IO[bytes], file_format: str, chunk_size: int = DEFAULT_CHUNK_SIZE):
+    genres_by_name = {genre["genre_name"].lower(): genre["genre_id"] for genre in await get_all_genres_from_db()}
+    report = ImportReport()
+    rows = iter_rows(binary_file, file_format)
+    while True:
+        chunk = await run_in_threadpool(read_chunk, rows, genres_by_name, chunk_size, report)
+        if not chunk:
+            return report
+        await load_chunk(chunk, report)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Bulk import books from CSV or NDJSON")
+    parser.add_argument("path", help="CSV or NDJSON file to import")
+    parser.add_argument("--format", choices=["csv", "ndjson"], help="file format (default: from the file extension)")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="rows per COPY")
+    args = parser.parse_args()
+
+    await connect_db()
+    try:
+        started = time.perf_counter()
+        with open(args.path, "rb") as binary_file:
+            report = await import_books(binary_file, args.format or detect_format(args.path), args.chunk_size)
+        elapsed = time.perf_counter() - started
+    finally:
+        await disconnect_db()
+
+    for error in report.errors:
+        print(f"line {error['line']}: {error['error']}")
+    print(f"Imported {report.inserted} books, rejected {report.rejected} rows in {elapsed:.1f}s")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,147 @@
+"""Book cover storage: pre-sized, content-addressed image variants.
+
+An uploaded cover is decoded and resized once, at upload time, into every
+variant in COVER_VARIANTS, and the variants are written next to the original
+under COVER_STORAGE_DIR. Resizing is CPU bound and holds the GIL, so it runs in
+a process pool and never blocks the event loop.
+
+Every file of a cover is named ``<cover_key>-<variant>.<ext>``. The cover key
+is a hash of the uploaded bytes and of COVER_VARIANTS_VERSION, so a name always
+refers to the same bytes and the files can be cached forever. The same image
+uploaded twice is stored once. books.cover_key records the key of a book's cover.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional
+import asyncio
+import hashlib
+import io
+import os
+import re
+from PIL import Image, ImageOps
+
+# Directory holding the cover files; share it between instances that serve the same database
+COVER_STORAGE_DIR = os.environ.get("COVER_STORAGE_DIR", os.path.join(os.path.dirname(__file__), "covers"))
+
+# Largest accepted upload and largest decoded image, which bound the memory a single upload can take
+COVER_MAX_BYTES = int(os.environ.get("COVER_MAX_BYTES", 10 * 1024 * 1024))
+COVER_MAX_PIXELS = int(os.environ.get("COVER_MAX_PIXELS", 40_000_000))
+
+# Uploads resized at once
+COVER_WORKERS = int(os.environ.get("COVER_WORKERS", min(2, os.cpu_count() or 1)))
+
+# Variant name -> (largest width in pixels, Pillow format, extension)
+COVER_VARIANTS = {
+    "thumb": (200, "JPEG", "jpg"),
+    "thumb-webp": (200, "WEBP", "webp"),
+    "medium": (600, "JPEG", "jpg"),
+    "medium-webp": (600, "WEBP", "webp"),
+}
+# Bump when COVER_VARIANTS or the encoder settings change, so new uploads get new names
+COVER_VARIANTS_VERSION = 1
+
+# Formats accepted for the original, with the extension it is stored under
+ORIGINAL_EXTENSIONS = {"PNG": "png", "JPEG": "jpg", "WEBP": "webp", "GIF": "gif"}
+
+COVER_KEY_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+COVER_FILE_PATTERN = re.compile(r"^[0-9a-f]{32}-(original|thumb|thumb-webp|medium|medium-webp)\.(png|jpg|webp|gif)$")
+
+_executor = ProcessPoolExecutor(max_workers=COVER_WORKERS)
+
+
+class InvalidCover(ValueError):
+    pass
+
+
+def cover_key(data: bytes) -> str:
+    digest = hashlib.blake2b(data, digest_size=16)
+    digest.update(f"variants-v{COVER_VARIANTS_VERSION}".encode())
+    return digest.hexdigest()
+
+
+def variant_filename(key: str, variant: str) -> str:
+    return f"{key}-{variant}.{COVER_VARIANTS[variant][2]}"
+
+
+# Decode an upload and encode every variant; runs in a worker process
+# Returns {file suffix: bytes}, including the original under "original.<ext>"
+def render_cover_variants(data: bytes) -> Dict[str, bytes]:
+    Image.MAX_IMAGE_PIXELS = COVER_MAX_PIXELS
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            if image.format not in ORIGINAL_EXTENSIONS:
+                raise InvalidCover(f"Unsupported image format {image.format}")
+            # The size is known from the header, before any pixel is decoded
+            if image.width * image.height > COVER_MAX_PIXELS:
+                raise InvalidCover(f"Covers are limited to {COVER_MAX_PIXELS} pixels")
+            original_extension = ORIGINAL_EXTENSIONS[image.format]
+            image = ImageOps.exif_transpose(image)
+            image.load()
+    except InvalidCover:
+        raise
+    except Exception as e:  # Pillow raises several types for corrupt, truncated or oversized images
+        raise InvalidCover(f"Not a readable image: {e}")
+
+    # JPEG has no alpha channel, so transparent covers are flattened onto white
+    if image.mode in ("RGBA", "LA", "P"):
+        image = image.convert("RGBA")
+        flat = Image.new("RGB", image.size, "white")
+        flat.paste(image, mask=image.getchannel("A"))
+        image = flat
+    elif image.mode != "RGB":
+        image = image.convert("RGB")
+
+    files = {f"original.{original_extension}": data}
+    resized = {}
+    for variant, (width, image_format, extension) in COVER_VARIANTS.items():
+        # Variants of the same width share one resize; covers are never scaled up
+        if width not in resized:
+            copy = image.copy()
+            copy.thumbnail((width, width * 4), Image.Resampling.LANCZOS)
+            resized[width] = copy
+        output = io.BytesIO()
+        if image_format == "JPEG":
+            resized[width].save(output, "JPEG", quality=82, optimize=True, progressive=True)
+        else:
+            resized[width].save(output, "WEBP", quality=80, method=6)
+        files[f"{variant}.{extension}"] = output.getvalue()
+    return files
+
+
+def write_cover_files(key: str, files: Dict[str, bytes]):
+    os.makedirs(COVER_STORAGE_DIR, exist_ok=True)
+    for suffix, content in files.items():
+        path = os.path.join(COVER_STORAGE_DIR, f"{key}-{suffix}")
+        # Written under a temporary name and renamed, so a file is never served half written
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "wb") as output:
+            output.write(content)
+        os.replace(temporary, path)
+
+
+def cover_exists(key: str) -> bool:
+    if not COVER_KEY_PATTERN.match(key):
+        return False
+    return all(
+        os.path.exists(os.path.join(COVER_STORAGE_DIR, variant_filename(key, variant))) for variant in COVER_VARIANTS
+    )
+
+
+# Store an uploaded cover and return its key; raises InvalidCover for anything that is not a usable image
+async def store_cover(data: bytes) -> str:
+    if len(data) > COVER_MAX_BYTES:
+        raise InvalidCover(f"Covers are limited to {COVER_MAX_BYTES} bytes")
+    key = cover_key(data)
+    if await asyncio.to_thread(cover_exists, key):
+        return key
+    loop = asyncio.get_running_loop()
+    files = await loop.run_in_executor(_executor, render_cover_variants, data)
+    await asyncio.to_thread(write_cover_files, key, files)
+    return key
+
+
+# Path of a stored cover file, or None for names that are not cover files or do not exist
+def cover_path(filename: str) -> Optional[str]:
+    if not COVER_FILE_PATTERN.match(filename):
+        return None
+    path = os.path.join(COVER_STORAGE_DIR, filename)
+    return path if os.path.isfile(path) else None
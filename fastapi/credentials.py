@@ -0,0 +1,103 @@
+"""Password hashing and verification.
+
+Passwords are hashed with scrypt, a memory-hard KDF from the standard library.
+Hashing is CPU and memory heavy by design, so it runs in a bounded thread pool
+(OpenSSL releases the GIL while it works) and never blocks the event loop.
+
+Stored hashes look like ``scrypt$<n>$<r>$<p>$<salt>$<hash>``. Values written by
+the old Vigenère cipher in routes/password_cypher.py are still accepted so
+existing users can log in. ``python manage.py migrate-passwords`` wraps them as
+``scrypt-vigenere$...``, the scrypt hash of the old cipher text, which needs no
+plaintext; every other scheme is upgraded to plain scrypt on the next login.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from routes.password_cypher import encrypt
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+
+# scrypt cost: CPU/memory cost n (a power of two), block size r and parallelism p
+# Memory used per hash is about 128 * n * r bytes (32 MiB with the defaults)
+PASSWORD_HASH_N = int(os.environ.get("PASSWORD_HASH_N", 2 ** 15))
+PASSWORD_HASH_R = int(os.environ.get("PASSWORD_HASH_R", 8))
+PASSWORD_HASH_P = int(os.environ.get("PASSWORD_HASH_P", 1))
+
+# Hashes computed at once; bounds both CPU and the memory taken by scrypt
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", min(4, os.cpu_count() or 1)))
+
+SALT_BYTES = 16
+HASH_BYTES = 32
+
+_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
+
+
+def _b64encode(raw: bytes) -> str:
+    return base64.b64encode(raw).decode().rstrip("=")
+
+
+def _b64decode(text: str) -> bytes:
+    return base64.b64decode(text + "=" * (-len(text) % 4))
+
+
+def _scrypt(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    return hashlib.scrypt(
+        password.encode(), salt=salt, n=n, r=r, p=p,
+        maxmem=2 * 128 * n * r * p + 1024 * 1024, dklen=HASH_BYTES,
+    )
+
+
+# Hash a password synchronously; use hash_password from async code
+def hash_password_sync(password: str, n: int = PASSWORD_HASH_N, r: int = PASSWORD_HASH_R, p: int = PASSWORD_HASH_P,
+                       scheme: str = "scrypt") -> str:
+    salt = os.urandom(SALT_BYTES)
+    digest = _scrypt(password, salt, n, r, p)
+    return f"{scheme}${n}${r}${p}${_b64encode(salt)}${_b64encode(digest)}"
+
+
+# Wrap a legacy Vigenère value in scrypt without knowing the password
+def wrap_legacy_hash(legacy_value: str) -> str:
+    return hash_password_sync(legacy_value, scheme="scrypt-vigenere")
+
+
+# Wrap a batch of (user_id, legacy value) pairs; runs in the migration's worker processes
+def wrap_legacy_hashes(pairs: list) -> list:
+    return [(user_id, legacy_value, wrap_legacy_hash(legacy_value)) for user_id, legacy_value in pairs]
+
+
+# True if the stored value is still in the old Vigenère format
+def is_legacy_hash(stored: str) -> bool:
+    return not stored.startswith(("scrypt$", "scrypt-vigenere$"))
+
+
+# Check a password against a stored value synchronously; use verify_password from async code
+def verify_password_sync(password: str, stored: str) -> bool:
+    if not stored:
+        return False
+    if is_legacy_hash(stored):
+        # Legacy Vigenère-encoded value that has not been migrated yet
+        return hmac.compare_digest(encrypt(password).encode(), stored.encode())
+    try:
+        scheme, n, r, p, salt, digest = stored.split("$")
+        if scheme == "scrypt-vigenere":
+            # Migrated legacy value: scrypt of the old cipher text
+            password = encrypt(password)
+        expected = _b64decode(digest)
+        actual = _scrypt(password, _b64decode(salt), int(n), int(r), int(p))
+    except ValueError:
+        return False
+    return hmac.compare_digest(actual, expected)
+
+
+# True if the stored value was not produced with the current scheme and cost settings
+def needs_rehash(stored: str) -> bool:
+    return not stored.startswith(f"scrypt${PASSWORD_HASH_N}${PASSWORD_HASH_R}${PASSWORD_HASH_P}$")
+
+
+async def hash_password(password: str) -> str:
+    return await asyncio.get_running_loop().run_in_executor(_executor, hash_password_sync, password)
+
+
+async def verify_password(password: str, stored: str) -> bool:
+    return await asyncio.get_running_loop().run_in_executor(_executor, verify_password_sync, password, stored)
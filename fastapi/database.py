@@ -1,26 +1,284 @@
 from databases import Database
-from typing import Optional
-from datetime import datetime
+from typing import List, Optional
+from datetime import date, datetime, timedelta
+import asyncio
+import base64
+import json
+import logging
+import os
+from cache import TopK, catalog_cache, content_etag, read_coalescer
+from metrics import collectors, db_reads_coalesced, instrument_module, instrument_pool
+from migrations import migrate
+from prepared import PreparedStatement, warm_up_statements
 
-# Configuration for Database connection
-POSTGRES_USER = "temp"
-POSTGRES_PASSWORD = "temp"
-POSTGRES_DB = "advcompro"
-POSTGRES_HOST = "db"
+# Configuration for Database connection, overridable from the environment
+POSTGRES_USER = os.environ.get("POSTGRES_USER", "temp")
+POSTGRES_PASSWORD = os.environ.get("POSTGRES_PASSWORD", "temp")
+POSTGRES_DB = os.environ.get("POSTGRES_DB", "advcompro")
+POSTGRES_HOST = os.environ.get("POSTGRES_HOST", "db")
 
-DATABASE_URL = f'postgresql+asyncpg://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}/{POSTGRES_DB}'
+DATABASE_URL = os.environ.get(
+    "DATABASE_URL", f'postgresql+asyncpg://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}/{POSTGRES_DB}'
+)
 
-# Database instance
-database = Database(DATABASE_URL)
+# Optional read replica; read-only queries that can tolerate replication lag are sent there
+DATABASE_REPLICA_URL = os.environ.get("DATABASE_REPLICA_URL")
+
+# Connection pool settings
+DB_POOL_MIN_SIZE = int(os.environ.get("DB_POOL_MIN_SIZE", 1))
+DB_POOL_MAX_SIZE = int(os.environ.get("DB_POOL_MAX_SIZE", 10))
+# Seconds to wait while opening a new connection
+DB_CONNECT_TIMEOUT = float(os.environ.get("DB_CONNECT_TIMEOUT", 10))
+# Server-side limit for a single statement in milliseconds (0 disables it)
+DB_STATEMENT_TIMEOUT_MS = int(os.environ.get("DB_STATEMENT_TIMEOUT_MS", 30000))
+# Idle connections are closed after this many seconds
+DB_POOL_MAX_INACTIVE_LIFETIME = float(os.environ.get("DB_POOL_MAX_INACTIVE_LIFETIME", 300))
+# Connections are replaced after serving this many queries, which bounds their lifetime
+DB_POOL_MAX_QUERIES = int(os.environ.get("DB_POOL_MAX_QUERIES", 50000))
+
+# Pooled connections opened at startup, before the first request needs them
+DB_POOL_WARM_SIZE = int(os.environ.get("DB_POOL_WARM_SIZE", min(4, DB_POOL_MAX_SIZE)))
+
+# Apply pending schema migrations when connecting
+DB_MIGRATE_ON_STARTUP = os.environ.get("DB_MIGRATE_ON_STARTUP", "1") not in ("", "0", "false")
+
+POOL_OPTIONS = {
+    "min_size": DB_POOL_MIN_SIZE,
+    "max_size": DB_POOL_MAX_SIZE,
+    "timeout": DB_CONNECT_TIMEOUT,
+    "max_inactive_connection_lifetime": DB_POOL_MAX_INACTIVE_LIFETIME,
+    "max_queries": DB_POOL_MAX_QUERIES,
+    "server_settings": {"statement_timeout": str(DB_STATEMENT_TIMEOUT_MS)},
+}
+
+logger = logging.getLogger("uvicorn.error")
+
+# Database instance for writes and read-your-writes paths
+database = Database(DATABASE_URL, **POOL_OPTIONS)
+
+# Database instance for plain reads; the primary itself when no replica is configured
+# Reads that must see this app's own writes (cache fills after invalidation, table versions,
+# rows sent under a table-version ETag, login, maintenance jobs) keep using database
+replica_database = Database(DATABASE_REPLICA_URL, **POOL_OPTIONS) if DATABASE_REPLICA_URL else database
+
+# Hashable stand-in for a query parameter value
+def _freeze(value):
+    if isinstance(value, (list, tuple, set)):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+# Run a read on replica_database, sharing it with concurrent reads of the same query and values
+# Used for aggregates that dashboards request many times at once; results are shared, not copied
+async def _coalesced_read(method: str, query: str, values: Optional[dict] = None):
+    key = (method, query, tuple(sorted((name, _freeze(value)) for name, value in (values or {}).items())))
+
+    async def load():
+        return await getattr(replica_database, method)(query, values=values)
+    return await read_coalescer.run(key, load)
+
+# The coalescers keep their own totals; copy them into the counter on scrape
+def _collect_coalescing():
+    db_reads_coalesced.values[("reads", "in_flight")] = read_coalescer.coalesced
+    db_reads_coalesced.values[("reads", "recent")] = read_coalescer.reused
+    db_reads_coalesced.values[("catalog", "in_flight")] = catalog_cache.stats()["coalesced"]
+
+collectors["coalescing"] = _collect_coalescing
+
+# Page size limits for the paginated list endpoints
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Largest batch accepted by the bulk borrow and return endpoints
+MAX_BULK_ITEMS = 500
 
 # Database Connection Functions
 async def connect_db():
     await database.connect()
-    print("Database connected")
+    instrument_pool(database, "primary")
+    if replica_database is not database:
+        await replica_database.connect()
+        instrument_pool(replica_database, "replica")
+    if DB_MIGRATE_ON_STARTUP:
+        await migrate(database)
+    await warm_up_statements(database)
+    logger.info("Database connected")
 
 async def disconnect_db():
+    if replica_database is not database:
+        await replica_database.disconnect()
     await database.disconnect()
-    print("Database disconnected")
+    logger.info("Database disconnected")
+
+# Open up to DB_POOL_WARM_SIZE connections in each pool now, so early requests do not pay for the handshake
+async def warm_up_pool():
+    for db in {id(database): database, id(replica_database): replica_database}.values():
+        pool = getattr(db._backend, "_pool", None)
+        if pool is None:
+            continue
+        connections = []
+        try:
+            for _ in range(min(DB_POOL_WARM_SIZE, pool.get_max_size())):
+                connections.append(await pool.acquire())
+        finally:
+            for connection in connections:
+                await pool.release(connection)
+
+# Load what the first requests ask for into the catalog cache and the leaderboards
+async def warm_up_caches():
+    await asyncio.gather(
+        get_all_books_from_db(DEFAULT_PAGE_SIZE + 1),
+        get_all_genres_from_db(),
+        get_books_by_genre_count_from_db(),
+        get_genres_with_books_from_db(),
+        refresh_most_borrowed_boards(),
+    )
+
+# Function to check that the primary answers queries
+async def ping_db():
+    return await database.fetch_val("SELECT 1")
+
+
+# -------------------- CACHE HELPERS --------------------
+
+# Convert a database record (from databases or straight from asyncpg) into a plain dict
+def record_to_dict(row):
+    if row is None:
+        return None
+    return dict(row._mapping) if hasattr(row, "_mapping") else dict(row)
+
+# Drop the cached catalog entries affected by a change to one book
+# A quantity-only change leaves genre counts and the other list pages untouched
+def invalidate_book_cache(book_id: int, quantity_only: bool = False):
+    catalog_cache.invalidate(("book", book_id))
+    if quantity_only:
+        catalog_cache.invalidate_where(
+            lambda key, rows: key[0] == "books" and (rows is None or any(row["book_id"] == book_id for row in rows))
+        )
+    else:
+        invalidate_catalog_lists()
+
+# Bumped whenever books are added, removed or renamed, so catalog-wide responses are rebuilt
+catalog_version = 0
+
+# Drop the cached book list pages, genre counts and genre listings after books were added or changed in bulk
+# Version-keyed entries are dropped too, so stale versions do not hold LRU slots until they age out
+def invalidate_catalog_lists():
+    global catalog_version
+    catalog_version += 1
+    catalog_cache.invalidate_where(lambda key, rows: key[0] in ("books", "genre_counts", "genres_with_books"))
+
+# Drop the whole catalog cache, after changes whose extent is not known
+def invalidate_catalog_cache():
+    global catalog_version
+    catalog_version += 1
+    catalog_cache.clear()
+
+# Drop the cached entries made stale by a stock change that any process made, as notified on
+# AVAILABILITY_CHANNEL; the process that made it has already dropped its own
+def invalidate_notified_availability(change: dict):
+    if change["type"] != "availability":
+        invalidate_catalog_cache()
+        return
+    for book_id, _, _ in change["books"]:
+        invalidate_book_cache(book_id, quantity_only=True)
+    for book_id in change["deleted"]:
+        invalidate_book_cache(book_id)
+
+
+# -------------------- TABLE VERSION OPERATIONS --------------------
+
+# Function to get the change counter and last change time of each of the given tables
+# Tables that were never written since versioning started report version 0 and no time
+async def get_table_versions(tables: List[str]):
+    query = """
+    SELECT table_name, CAST(SUM(version) AS BIGINT) AS version, MAX(updated_at) AS updated_at
+    FROM table_version_stripes
+    WHERE table_name = ANY(:tables)
+    GROUP BY table_name
+    """
+    rows = await database.fetch_all(query, values={"tables": list(tables)})
+    found = {row["table_name"]: (row["version"], row["updated_at"]) for row in rows}
+    return {table: found.get(table, (0, None)) for table in tables}
+
+
+# -------------------- CHECKPOINT OPERATIONS --------------------
+
+# Function to get the last id processed by a job, or 0 if it never ran
+async def get_checkpoint(name: str):
+    query = "SELECT last_id FROM maintenance_checkpoints WHERE name = :name"
+    last_id = await database.fetch_val(query, values={"name": name})
+    return last_id or 0
+
+# Function to record the last id processed by a job
+async def save_checkpoint(name: str, last_id: int):
+    query = """
+    INSERT INTO maintenance_checkpoints (name, last_id, updated_at)
+    VALUES (:name, :last_id, now())
+    ON CONFLICT (name) DO UPDATE SET last_id = EXCLUDED.last_id, updated_at = now()
+    """
+    await database.execute(query, values={"name": name, "last_id": last_id})
+
+# Function to forget the progress of a job so it starts over
+async def reset_checkpoint(name: str):
+    await database.execute("DELETE FROM maintenance_checkpoints WHERE name = :name", values={"name": name})
+
+
+# -------------------- PAGINATION HELPERS --------------------
+
+# Encode the sort key of the last row of a page into an opaque cursor
+def encode_cursor(last_id: int):
+    raw = json.dumps({"after": last_id}).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+# Read the sort key stored in a cursor, raising ValueError if it is malformed
+def read_cursor(cursor: str):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        return json.loads(base64.urlsafe_b64decode(padded.encode()))["after"]
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+# Decode a cursor produced by encode_cursor, raising ValueError if it is malformed
+def decode_cursor(cursor: Optional[str]):
+    if not cursor:
+        return None
+    after = read_cursor(cursor)
+    if not isinstance(after, int):
+        raise ValueError("Invalid cursor")
+    return after
+
+# Decode a cursor holding a (timestamp, id) sort key, raising ValueError if it is malformed
+def decode_timestamp_cursor(cursor: Optional[str]):
+    if not cursor:
+        return None
+    after = read_cursor(cursor)
+    try:
+        timestamp, last_id = after
+        if not isinstance(last_id, int):
+            raise ValueError
+        return datetime.fromisoformat(timestamp), last_id
+    except (TypeError, ValueError):
+        raise ValueError("Invalid cursor")
+
+# Decode a cursor holding a (count, id) sort key, raising ValueError if it is malformed
+def decode_count_cursor(cursor: Optional[str]):
+    if not cursor:
+        return None
+    after = read_cursor(cursor)
+    try:
+        count, last_id = after
+    except (TypeError, ValueError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(count, int) or not isinstance(last_id, int):
+        raise ValueError("Invalid cursor")
+    return count, last_id
+
+# Split a result fetched with limit + 1 rows into the page and the cursor of the next page
+def split_page(rows, limit: int, key: str):
+    if len(rows) <= limit:
+        return rows, None
+    page = rows[:limit]
+    return page, encode_cursor(page[-1][key])
 
 
 # -------------------- USER OPERATIONS --------------------
@@ -28,9 +286,14 @@ async def disconnect_db():
 # Function to insert a new user into the users table
 async def insert_user(username: str, password_hash: str, email: str):
     query = """
-    INSERT INTO users (username, password_hash, email)
-    VALUES (:username, :password_hash, :email)
-    RETURNING user_id, username, password_hash, email, created_at
+    WITH inserted AS (
+        INSERT INTO users (username, password_hash, email)
+        VALUES (:username, :password_hash, :email)
+        RETURNING user_id, username, password_hash, email, created_at
+    ), counts AS (
+        INSERT INTO user_borrow_counts (user_id) SELECT user_id FROM inserted
+    )
+    SELECT * FROM inserted
     """
     values = {"username": username, "password_hash": password_hash, "email": email}
     return await database.fetch_one(query=query, values=values)
@@ -38,18 +301,26 @@ async def insert_user(username: str, password_hash: str, email: str):
 # Get total members count
 async def get_total_members_from_db():
     query = "SELECT COUNT(*) FROM users"
-    result = await database.fetch_one(query)
+    result = await _coalesced_read("fetch_one", query)
     return result[0]
 
 # Function to select a user by user_id from the users table
+GET_USER = PreparedStatement("get_user", "SELECT * FROM users WHERE user_id = $1")
+
+# Read on the primary: the row is sent under an ETag taken from the table versions there, and a lagging
+# replica would pair an old row with the new tag, which clients would then keep through 304s
 async def get_user(user_id: int):
-    query = "SELECT * FROM users WHERE user_id = :user_id"
-    return await database.fetch_one(query=query, values={"user_id": user_id})
+    return record_to_dict(await GET_USER.fetchrow(database, user_id))
 
 # Function to select a user by email from the users table
-async def get_user_by_email(email: str, password_hash: str):
-    query = "SELECT * FROM users WHERE email = :email and password_hash = :password_hash"
-    return await database.fetch_one(query=query, values={"email": email, "password_hash": password_hash})
+async def get_user_by_email(email: str):
+    query = "SELECT * FROM users WHERE email = :email"
+    return await database.fetch_one(query=query, values={"email": email})
+
+# Function to replace the stored password hash of a user
+async def update_user_password_hash(user_id: int, password_hash: str):
+    query = "UPDATE users SET password_hash = :password_hash WHERE user_id = :user_id"
+    await database.execute(query=query, values={"user_id": user_id, "password_hash": password_hash})
 
 # Function to update a user in the users table
 async def update_user(user_id: int, username: str, password_hash: str, email: str):
@@ -67,76 +338,226 @@ async def delete_user(user_id: int):
     query = "DELETE FROM users WHERE user_id = :user_id RETURNING *"
     return await database.fetch_one(query=query, values={"user_id": user_id})
 
-# Function to get all users from the users table
-async def get_all_users_from_db():
+# Function to get users from the users table, ordered by user_id
+# Pass after_id (the last user_id seen) and limit to fetch one keyset page
+async def get_all_users_from_db(limit: Optional[int] = None, after_id: Optional[int] = None):
+    conditions = []
+    values = {}
+    if after_id is not None:
+        conditions.append("user_id > :after_id")
+        values["after_id"] = after_id
     query = "SELECT * FROM users"
-    return await database.fetch_all(query)
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY user_id"
+    if limit is not None:
+        query += " LIMIT :limit"
+        values["limit"] = limit
+    return await replica_database.fetch_all(query, values=values)
+
+# Function to stream the users whose password is still in the legacy format, through a server-side cursor
+async def iterate_legacy_password_hashes(after_id: int = 0):
+    query = """
+    SELECT user_id, password_hash
+    FROM users
+    WHERE user_id > :after_id
+        AND split_part(password_hash, '$', 1) NOT IN ('scrypt', 'scrypt-vigenere')
+    ORDER BY user_id
+    """
+    async for row in database.iterate(query, values={"after_id": after_id}):
+        yield row
+
+# Function to write a batch of migrated password hashes and the migration checkpoint in one transaction
+# Each row is (user_id, old hash, new hash); rows whose hash changed meanwhile are left alone
+async def replace_password_hashes(rows: List[tuple], checkpoint: str):
+    query = """
+    UPDATE users u
+    SET password_hash = v.new_hash
+    FROM unnest(CAST(:user_ids AS int[]), CAST(:old_hashes AS text[]), CAST(:new_hashes AS text[]))
+        AS v(user_id, old_hash, new_hash)
+    WHERE u.user_id = v.user_id AND u.password_hash = v.old_hash
+    """
+    values = {
+        "user_ids": [row[0] for row in rows],
+        "old_hashes": [row[1] for row in rows],
+        "new_hashes": [row[2] for row in rows],
+    }
+    async with database.transaction():
+        await database.execute(query, values=values)
+        await save_checkpoint(checkpoint, max(row[0] for row in rows))
+
+# Sort orders of the users-with-borrow-count report and the counter column each one ranks by
+USER_BORROW_COUNT_SORTS = {"user_id": None, "lifetime": "lifetime_borrows", "active": "active_borrows"}
+
+# Function to get users with their lifetime (total_borrows) and active borrow counts from the per-user counters
+# sort is user_id (ascending), or lifetime or active (highest count first)
+# Pass after (the last user_id seen, or the (count, user_id) of the last row for the count sorts) and limit
+# to fetch one keyset page
+async def get_all_users_with_borrow_count(limit: Optional[int] = None, after=None, sort: str = "user_id"):
+    if sort not in USER_BORROW_COUNT_SORTS:
+        raise ValueError(f"Unsupported sort: {sort}")
+    column = USER_BORROW_COUNT_SORTS[sort]
+    values = {}
+    if column is None:
+        query = """
+        SELECT u.user_id, u.username, u.email,
+            COALESCE(c.lifetime_borrows, 0) AS total_borrows, COALESCE(c.active_borrows, 0) AS active_borrows
+        FROM users u
+        LEFT JOIN user_borrow_counts c ON c.user_id = u.user_id
+        """
+        if after is not None:
+            query += " WHERE u.user_id > :after_id"
+            values["after_id"] = after
+        query += " ORDER BY u.user_id"
+    else:
+        # Users appear here once they have a counter row: from creation, their first borrow or a repair
+        query = """
+        SELECT u.user_id, u.username, u.email, c.lifetime_borrows AS total_borrows, c.active_borrows
+        FROM user_borrow_counts c
+        JOIN users u ON u.user_id = c.user_id
+        """
+        if after is not None:
+            query += f" WHERE (c.{column}, c.user_id) < (CAST(:after_count AS integer), CAST(:after_id AS integer))"
+            values["after_count"], values["after_id"] = after
+        query += f" ORDER BY c.{column} DESC, c.user_id DESC"
+    if limit is not None:
+        query += " LIMIT :limit"
+        values["limit"] = limit
+    return await replica_database.fetch_all(query, values=values)
 
-# Function to get all users with borrow count
-async def get_all_users_with_borrow_count():
+# Query comparing every user's counters with a count over the borrow table
+USER_BORROW_COUNT_MISMATCHES = """
+WITH actual AS (
+    SELECT u.user_id,
+        COUNT(b.borrow_id) FILTER (WHERE b.return_date IS NULL) AS active_borrows,
+        COUNT(b.borrow_id) AS lifetime_borrows
+    FROM users u
+    LEFT JOIN borrow b ON b.user_id = u.user_id
+    GROUP BY u.user_id
+)
+SELECT a.user_id, a.active_borrows, a.lifetime_borrows,
+    c.active_borrows AS stored_active_borrows, c.lifetime_borrows AS stored_lifetime_borrows
+FROM actual a
+LEFT JOIN user_borrow_counts c ON c.user_id = a.user_id
+WHERE c.user_id IS NULL OR c.active_borrows <> a.active_borrows OR c.lifetime_borrows <> a.lifetime_borrows
+ORDER BY a.user_id
+"""
+
+# Function to list users whose stored borrow counters do not match the borrow table
+async def find_user_borrow_count_mismatches():
+    return await database.fetch_all(USER_BORROW_COUNT_MISMATCHES)
+
+# Function to rewrite the counters of every user whose stored counts are wrong or missing
+# Borrow writes are blocked meanwhile so the counts cannot move under the repair; returns the number of users fixed
+async def repair_user_borrow_counts():
+    async with database.transaction():
+        await database.execute("LOCK TABLE borrow IN SHARE MODE")
+        query = """
+        WITH mismatches AS (""" + USER_BORROW_COUNT_MISMATCHES + """
+        ), repaired AS (
+            INSERT INTO user_borrow_counts (user_id, active_borrows, lifetime_borrows)
+            SELECT user_id, active_borrows, lifetime_borrows FROM mismatches
+            ON CONFLICT (user_id) DO UPDATE
+            SET active_borrows = EXCLUDED.active_borrows, lifetime_borrows = EXCLUDED.lifetime_borrows
+            RETURNING user_id
+        )
+        SELECT COUNT(*) FROM repaired
+        """
+        return await database.fetch_val(query)
+
+
+# Function to stream users with their borrow count through a server-side cursor
+# borrowed_from and borrowed_to limit which borrows are counted
+async def iterate_users_with_borrow_count_from_db(user_id: Optional[int] = None, borrowed_from: Optional[datetime] = None,
+                                                  borrowed_to: Optional[datetime] = None):
+    join_conditions = ["u.user_id = b.user_id"]
+    where = ""
+    values = {}
+    if borrowed_from is not None:
+        join_conditions.append("b.borrow_date >= :borrowed_from")
+        values["borrowed_from"] = borrowed_from
+    if borrowed_to is not None:
+        join_conditions.append("b.borrow_date < :borrowed_to")
+        values["borrowed_to"] = borrowed_to
+    if user_id is not None:
+        where = " WHERE u.user_id = :user_id"
+        values["user_id"] = user_id
     query = """
     SELECT u.user_id, u.username, u.email, COUNT(b.borrow_id) AS total_borrows
     FROM users u
-    LEFT JOIN borrow b ON u.user_id = b.user_id
-    GROUP BY u.user_id;
+    LEFT JOIN borrow b ON """ + " AND ".join(join_conditions) + where + """
+    GROUP BY u.user_id
+    ORDER BY u.user_id
     """
-    return await database.fetch_all(query)
+    async for row in replica_database.iterate(query, values=values):
+        yield row
 
 
 # -------------------- BOOK OPERATIONS --------------------
 
 # Function to insert a new book into the books table with genre_id
-async def insert_book(book_name: str, book_quantity: int, book_description: Optional[str], book_pic: Optional[str], genre_id: Optional[int]):
+# cover_key is the key of a cover stored with covers.store_cover
+async def insert_book(book_name: str, book_quantity: int, book_description: Optional[str], book_pic: Optional[str], genre_id: Optional[int],
+                      cover_key: Optional[str] = None):
 
     query = """
-    INSERT INTO books (book_name, book_quantity, book_description, book_pic, genre_id, available_quantity)
-    VALUES (:book_name, :book_quantity, :book_description, :book_pic, :genre_id, :book_quantity)
-    RETURNING book_id, book_name, book_quantity, available_quantity, book_description, book_pic, genre_id
+    INSERT INTO books (book_name, book_quantity, book_description, book_pic, cover_key, genre_id, available_quantity)
+    VALUES (:book_name, :book_quantity, :book_description, :book_pic, :cover_key, :genre_id, :book_quantity)
+    RETURNING book_id, book_name, book_quantity, available_quantity, book_description, book_pic, cover_key, genre_id
     """
     values = {
         "book_name": book_name,
         "book_quantity": book_quantity,
         "book_description": book_description,
         "book_pic": book_pic,
+        "cover_key": cover_key,
         "genre_id": genre_id
     }
-    return await database.fetch_one(query=query, values=values)
+    result = await database.fetch_one(query=query, values=values)
+    if result is not None:
+        invalidate_book_cache(result["book_id"])
+    return result
 
 # Function to get the total unique books count from the database
 async def get_total_unique_books_from_db():
     query = "SELECT COUNT(*) FROM books"
-    result = await database.fetch_one(query)
+    result = await _coalesced_read("fetch_one", query)
     return result[0] if result else None
 
 # Function to get the total number of books from the database
 async def get_total_books_from_db():
     query = "SELECT SUM(book_quantity) FROM books"
-    result = await database.fetch_one(query)
+    result = await _coalesced_read("fetch_one", query)
     return result[0] if result else None
 
 # Function to get the available number of books from the database
 async def get_available_books_from_db():
     query = "SELECT SUM(available_quantity) FROM books"
-    result = await database.fetch_one(query)
+    result = await _coalesced_read("fetch_one", query)
     return result[0] if result else None
 
 # Function to select a book by book_id from the books table with genre details
-async def get_book(book_id: int):
-    query = """
-    SELECT b.book_id, b.book_name, b.book_quantity, b.available_quantity, b.book_description, b.book_pic, b.genre_id, g.genre_name
+GET_BOOK = PreparedStatement("get_book", """
+    SELECT b.book_id, b.book_name, b.book_quantity, b.available_quantity, b.book_description, b.book_pic, b.cover_key, b.genre_id, g.genre_name
     FROM books b
     LEFT JOIN genre g ON b.genre_id = g.genre_id
-    WHERE b.book_id = :book_id
-    """
-    return await database.fetch_one(query=query, values={"book_id": book_id})
+    WHERE b.book_id = $1
+""")
+
+async def get_book(book_id: int):
+    async def load():
+        return record_to_dict(await GET_BOOK.fetchrow(database, book_id))
+    return await catalog_cache.get_or_load(("book", book_id), load)
 
 
-async def update_book(book_id: int, book_name: str, book_quantity: Optional[int], available_quantity: Optional[int], book_description: Optional[str], book_pic: Optional[str], genre_id: Optional[int]):
+# cover_key is the key of a cover stored with covers.store_cover; the current cover is kept when it is None
+async def update_book(book_id: int, book_name: str, book_quantity: Optional[int], available_quantity: Optional[int], book_description: Optional[str], book_pic: Optional[str], genre_id: Optional[int],
+                      cover_key: Optional[str] = None):
     query = """
     UPDATE books 
-    SET book_name = :book_name, book_quantity = :book_quantity, available_quantity = :available_quantity, book_description = :book_description, book_pic =:book_pic, genre_id = :genre_id
+    SET book_name = :book_name, book_quantity = :book_quantity, available_quantity = :available_quantity, book_description = :book_description, book_pic =:book_pic, cover_key = COALESCE(:cover_key, cover_key), genre_id = :genre_id
     WHERE book_id = :book_id
-    RETURNING book_id, book_name, book_quantity, available_quantity, book_description, book_pic, genre_id
+    RETURNING book_id, book_name, book_quantity, available_quantity, book_description, book_pic, cover_key, genre_id
     """
     values = {
         "book_id": book_id,
@@ -145,9 +566,13 @@ async def update_book(book_id: int, book_name: str, book_quantity: Optional[int]
         "available_quantity": available_quantity,
         "book_description": book_description,
         "book_pic": book_pic,
+        "cover_key": cover_key,
         "genre_id": genre_id
     }
-    return await database.fetch_one(query=query, values=values)
+    result = await database.fetch_one(query=query, values=values)
+    if result is not None:
+        invalidate_book_cache(book_id)
+    return result
 
 
 
@@ -155,18 +580,76 @@ async def update_book(book_id: int, book_name: str, book_quantity: Optional[int]
 # Function to delete a user from the users table
 async def delete_book(book_id: int):
     query = "DELETE FROM books WHERE book_id = :book_id RETURNING *"
-    return await database.fetch_one(query=query, values={"book_id": book_id})
+    result = await database.fetch_one(query=query, values={"book_id": book_id})
+    if result is not None:
+        invalidate_book_cache(book_id)
+        for board in most_borrowed_boards.values():
+            board.discard(book_id)
+    return result
 
 
 
-# Function to get all books from the books table along with genre details
-async def get_all_books_from_db():
+# Function to get books from the books table along with genre details, ordered by book_id
+# Pass after_id (the last book_id seen) and limit to fetch one keyset page
+async def get_all_books_from_db(limit: Optional[int] = None, after_id: Optional[int] = None, genre_id: Optional[int] = None):
+    conditions = []
+    values = {}
+    if after_id is not None:
+        conditions.append("b.book_id > :after_id")
+        values["after_id"] = after_id
+    if genre_id is not None:
+        conditions.append("b.genre_id = :genre_id")
+        values["genre_id"] = genre_id
     query = """
-    SELECT b.book_id, b.book_name, b.book_quantity,b.available_quantity, b.book_description, b.book_pic, b.genre_id, g.genre_name
+    SELECT b.book_id, b.book_name, b.book_quantity,b.available_quantity, b.book_description, b.book_pic, b.cover_key, b.genre_id, g.genre_name
     FROM books b
-    LEFT JOIN genre g ON b.genre_id = g.genre_id;
+    LEFT JOIN genre g ON b.genre_id = g.genre_id
     """
-    return await database.fetch_all(query)
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY b.book_id"
+    if limit is not None:
+        query += " LIMIT :limit"
+        values["limit"] = limit
+    async def load():
+        return [record_to_dict(row) for row in await database.fetch_all(query, values=values)]
+    return await catalog_cache.get_or_load(("books", limit, after_id, genre_id), load)
+
+# Function to stream books with genre details through a server-side cursor
+async def iterate_books_from_db(genre_id: Optional[int] = None):
+    where = ""
+    values = {}
+    if genre_id is not None:
+        where = " WHERE b.genre_id = :genre_id"
+        values["genre_id"] = genre_id
+    query = """
+    SELECT b.book_id, b.book_name, b.book_quantity, b.available_quantity, b.book_description, b.book_pic, b.cover_key, b.genre_id, g.genre_name
+    FROM books b
+    LEFT JOIN genre g ON b.genre_id = g.genre_id
+    """ + where + " ORDER BY b.book_id"
+    async for row in replica_database.iterate(query, values=values):
+        yield row
+
+# Columns written by copy_books_into_db, in record order
+BOOK_COPY_COLUMNS = ["book_name", "book_quantity", "available_quantity", "book_description", "book_pic", "genre_id"]
+
+# Function to load a chunk of books with COPY in one transaction
+# Each record is a tuple in BOOK_COPY_COLUMNS order
+async def copy_books_into_db(records: List[tuple]):
+    async with database.connection() as connection:
+        async with connection.transaction():
+            await connection.raw_connection.copy_records_to_table("books", records=records, columns=BOOK_COPY_COLUMNS)
+    invalidate_catalog_lists()
+    return len(records)
+
+# Function to insert a single record in BOOK_COPY_COLUMNS order
+# Caches are left alone so a batch of these can be followed by one invalidate_catalog_lists
+async def insert_book_record(record: tuple):
+    query = f"""
+    INSERT INTO books ({", ".join(BOOK_COPY_COLUMNS)})
+    VALUES ({", ".join(":" + column for column in BOOK_COPY_COLUMNS)})
+    """
+    await database.execute(query=query, values=dict(zip(BOOK_COPY_COLUMNS, record)))
 
 async def get_books_by_genre_count_from_db():
     query = """
@@ -175,7 +658,32 @@ async def get_books_by_genre_count_from_db():
     LEFT JOIN books b ON g.genre_id = b.genre_id
     GROUP BY g.genre_name;
     """
-    return await database.fetch_all(query)
+    async def load():
+        return [record_to_dict(row) for row in await database.fetch_all(query)]
+    return await catalog_cache.get_or_load(("genre_counts",), load)
+
+
+# -------------------- DASHBOARD OPERATIONS --------------------
+
+# Function to get every dashboard counter in a single statement
+async def get_dashboard_summary_from_db():
+    query = """
+    WITH book_totals AS (
+        SELECT
+            COUNT(*) AS total_unique_books,
+            COALESCE(SUM(book_quantity), 0) AS total_books,
+            COALESCE(SUM(available_quantity), 0) AS available_books
+        FROM books
+    )
+    SELECT
+        bt.total_unique_books,
+        bt.total_books,
+        bt.available_books,
+        (SELECT COUNT(*) FROM users) AS total_members,
+        (SELECT COUNT(*) FROM borrow) AS total_borrows
+    FROM book_totals bt
+    """
+    return await _coalesced_read("fetch_one", query)
 
 
 # -------------------- GENRE OPERATIONS --------------------
@@ -186,49 +694,512 @@ async def get_all_genres_from_db():
     SELECT genre_id, genre_name, genre_description
     FROM genre;
     """
-    return await database.fetch_all(query)
+    async def load():
+        return [record_to_dict(row) for row in await database.fetch_all(query)]
+    return await catalog_cache.get_or_load(("genres",), load)
 
+# Function to get every genre with its books as a pre-encoded JSON array
+# The nesting is done by Postgres; returns (body bytes, ETag), cached per catalog version
 async def get_genres_with_books_from_db():
     query = """
-    SELECT g.genre_id, g.genre_name, g.genre_description, b.book_id, b.book_name
+    SELECT CAST(COALESCE(
+        json_agg(
+            json_build_object(
+                'genre_id', g.genre_id,
+                'genre_name', g.genre_name,
+                'genre_description', g.genre_description,
+                'books', COALESCE(gb.books, CAST('[]' AS json))
+            )
+            ORDER BY g.genre_id
+        ),
+        CAST('[]' AS json)
+    ) AS text)
     FROM genre g
-    LEFT JOIN books b ON g.genre_id = b.genre_id
+    LEFT JOIN LATERAL (
+        SELECT json_agg(json_build_object('book_id', b.book_id, 'book_name', b.book_name) ORDER BY b.book_id) AS books
+        FROM books b
+        WHERE b.genre_id = g.genre_id
+    ) gb ON true
+    """
+    async def load():
+        body = (await database.fetch_val(query)).encode()
+        return body, content_etag(body)
+    return await catalog_cache.get_or_load(("genres_with_books", catalog_version), load)
+
+# -------------------- BORROW ROLLUP OPERATIONS --------------------
+
+# CTEs that add the borrows returned by the CTE named source to the daily rollup and the per-book and per-user counters
+# The source must return borrow_date, book_id, user_id, borrow_quantity and return_date
+def rollup_add_cte(source: str):
+    return f"""
+    rollup AS (
+        INSERT INTO borrow_daily_stats (day, borrow_count, borrow_quantity)
+        SELECT CAST(borrow_date AS date), COUNT(*), SUM(borrow_quantity)
+        FROM {source}
+        GROUP BY CAST(borrow_date AS date)
+        ON CONFLICT (day) DO UPDATE
+        SET borrow_count = borrow_daily_stats.borrow_count + EXCLUDED.borrow_count,
+            borrow_quantity = borrow_daily_stats.borrow_quantity + EXCLUDED.borrow_quantity
+    ), book_rollup AS (
+        INSERT INTO book_borrow_daily (day, book_id, borrow_count, borrow_quantity)
+        SELECT CAST(borrow_date AS date), book_id, COUNT(*), SUM(borrow_quantity)
+        FROM {source}
+        GROUP BY CAST(borrow_date AS date), book_id
+        ON CONFLICT (day, book_id) DO UPDATE
+        SET borrow_count = book_borrow_daily.borrow_count + EXCLUDED.borrow_count,
+            borrow_quantity = book_borrow_daily.borrow_quantity + EXCLUDED.borrow_quantity
+    ), book_totals AS (
+        INSERT INTO book_borrow_totals (book_id, borrow_count, borrow_quantity)
+        SELECT book_id, COUNT(*), SUM(borrow_quantity)
+        FROM {source}
+        GROUP BY book_id
+        ON CONFLICT (book_id) DO UPDATE
+        SET borrow_count = book_borrow_totals.borrow_count + EXCLUDED.borrow_count,
+            borrow_quantity = book_borrow_totals.borrow_quantity + EXCLUDED.borrow_quantity
+    ), user_counts AS (
+        INSERT INTO user_borrow_counts (user_id, active_borrows, lifetime_borrows)
+        SELECT user_id, COUNT(*) FILTER (WHERE return_date IS NULL), COUNT(*)
+        FROM {source}
+        GROUP BY user_id
+        ON CONFLICT (user_id) DO UPDATE
+        SET active_borrows = user_borrow_counts.active_borrows + EXCLUDED.active_borrows,
+            lifetime_borrows = user_borrow_counts.lifetime_borrows + EXCLUDED.lifetime_borrows
+    )
+    """
+
+# CTEs that remove the borrows returned by the CTE named source from the daily rollup and the per-book and per-user counters
+def rollup_remove_cte(source: str):
+    return f"""
+    rollup AS (
+        UPDATE borrow_daily_stats s
+        SET borrow_count = s.borrow_count - d.borrow_count,
+            borrow_quantity = s.borrow_quantity - d.borrow_quantity
+        FROM (
+            SELECT CAST(borrow_date AS date) AS day, COUNT(*) AS borrow_count, SUM(borrow_quantity) AS borrow_quantity
+            FROM {source}
+            GROUP BY CAST(borrow_date AS date)
+        ) d
+        WHERE s.day = d.day
+    ), book_rollup AS (
+        UPDATE book_borrow_daily s
+        SET borrow_count = s.borrow_count - d.borrow_count,
+            borrow_quantity = s.borrow_quantity - d.borrow_quantity
+        FROM (
+            SELECT CAST(borrow_date AS date) AS day, book_id, COUNT(*) AS borrow_count, SUM(borrow_quantity) AS borrow_quantity
+            FROM {source}
+            GROUP BY CAST(borrow_date AS date), book_id
+        ) d
+        WHERE s.day = d.day AND s.book_id = d.book_id
+    ), book_totals AS (
+        UPDATE book_borrow_totals s
+        SET borrow_count = s.borrow_count - d.borrow_count,
+            borrow_quantity = s.borrow_quantity - d.borrow_quantity
+        FROM (
+            SELECT book_id, COUNT(*) AS borrow_count, SUM(borrow_quantity) AS borrow_quantity
+            FROM {source}
+            GROUP BY book_id
+        ) d
+        WHERE s.book_id = d.book_id
+    ), user_counts AS (
+        UPDATE user_borrow_counts s
+        SET active_borrows = s.active_borrows - d.active_borrows,
+            lifetime_borrows = s.lifetime_borrows - d.lifetime_borrows
+        FROM (
+            SELECT user_id, COUNT(*) FILTER (WHERE return_date IS NULL) AS active_borrows, COUNT(*) AS lifetime_borrows
+            FROM {source}
+            GROUP BY user_id
+        ) d
+        WHERE s.user_id = d.user_id
+    )
+    """
+
+# CTE that takes the borrows returned (closed) by the CTE named source off the active count of their users
+def user_returns_cte(source: str):
+    return f"""
+    user_counts AS (
+        UPDATE user_borrow_counts s
+        SET active_borrows = s.active_borrows - d.returned
+        FROM (SELECT user_id, COUNT(*) AS returned FROM {source} GROUP BY user_id) d
+        WHERE s.user_id = d.user_id
+    )
+    """
+
+# Function to rebuild the daily rollup and the per-book counters from the borrow table
+async def backfill_borrow_rollup():
+    async with database.transaction():
+        # Block borrow writes so the rebuilt totals match the table exactly
+        await database.execute("LOCK TABLE borrow IN SHARE MODE")
+        await database.execute("DELETE FROM borrow_daily_stats")
+        await database.execute("DELETE FROM book_borrow_daily")
+        await database.execute("DELETE FROM book_borrow_totals")
+        await database.execute("""
+        INSERT INTO borrow_daily_stats (day, borrow_count, borrow_quantity)
+        SELECT CAST(borrow_date AS date), COUNT(*), SUM(borrow_quantity)
+        FROM borrow
+        GROUP BY CAST(borrow_date AS date)
+        """)
+        await database.execute("""
+        INSERT INTO book_borrow_daily (day, book_id, borrow_count, borrow_quantity)
+        SELECT CAST(borrow_date AS date), book_id, COUNT(*), SUM(borrow_quantity)
+        FROM borrow
+        GROUP BY CAST(borrow_date AS date), book_id
+        """)
+        await database.execute("""
+        INSERT INTO book_borrow_totals (book_id, borrow_count, borrow_quantity)
+        SELECT book_id, COUNT(*), SUM(borrow_quantity)
+        FROM borrow
+        GROUP BY book_id
+        """)
+        return await database.fetch_val("SELECT COUNT(*) FROM borrow_daily_stats")
+
+# -------------------- MOST-BORROWED LEADERBOARD --------------------
+
+# Leaderboard windows and the number of days each covers, today included (None for all time)
+MOST_BORROWED_WINDOWS = {"7d": 7, "30d": 30, "all": None}
+
+# Largest leaderboard served; twice as many books are kept so deletes rarely leave a gap at the bottom
+MOST_BORROWED_MAX_LIMIT = 50
+
+# Top books of each window, loaded from the per-book counters and adjusted by this process's own writes
+most_borrowed_boards = {
+    window: TopK(f"most-borrowed-{window}", MOST_BORROWED_MAX_LIMIT * 2) for window in MOST_BORROWED_WINDOWS
+}
+
+def most_borrowed_score(row):
+    return (row["borrow_count"], row["borrow_quantity"], -row["book_id"])
+
+# Function to reload one leaderboard from the per-book counters
+async def load_most_borrowed_board(window: str):
+    days = MOST_BORROWED_WINDOWS[window]
+    board = most_borrowed_boards[window]
+    values = {"limit": board.capacity}
+    if days is None:
+        query = """
+        SELECT t.book_id, bk.book_name, t.borrow_count, t.borrow_quantity
+        FROM book_borrow_totals t
+        JOIN books bk ON bk.book_id = t.book_id
+        WHERE t.borrow_count > 0
+        ORDER BY t.borrow_count DESC, t.borrow_quantity DESC, t.book_id
+        LIMIT :limit
+        """
+    else:
+        query = """
+        SELECT d.book_id, bk.book_name, SUM(d.borrow_count) AS borrow_count, SUM(d.borrow_quantity) AS borrow_quantity
+        FROM book_borrow_daily d
+        JOIN books bk ON bk.book_id = d.book_id
+        WHERE d.day > CURRENT_DATE - CAST(:days AS integer)
+        GROUP BY d.book_id, bk.book_name
+        HAVING SUM(d.borrow_count) > 0
+        ORDER BY borrow_count DESC, borrow_quantity DESC, d.book_id
+        LIMIT :limit
+        """
+        values["days"] = days
+    rows = await database.fetch_all(query, values=values)
+    board.replace([record_to_dict(row) for row in rows], "book_id", most_borrowed_score)
+
+# Function to reload every leaderboard, which also picks up writes made by other app instances
+async def refresh_most_borrowed_boards():
+    for window in MOST_BORROWED_WINDOWS:
+        await load_most_borrowed_board(window)
+
+# Function to get the most borrowed books of a window, served from memory
+async def get_most_borrowed_books(window: str, limit: int):
+    board = most_borrowed_boards[window]
+    if board.loaded_at is None:
+        await load_most_borrowed_board(window)
+    return board.top(limit)
+
+# Apply borrows made (sign 1) or deleted (sign -1) by this process to the leaderboards they fall in
+def adjust_most_borrowed(rows, sign: int):
+    today = date.today()
+    for row in rows:
+        age_days = (today - row["borrow_date"].date()).days
+        deltas = {"borrow_count": sign, "borrow_quantity": sign * row["borrow_quantity"]}
+        for window, days in MOST_BORROWED_WINDOWS.items():
+            if days is None or age_days < days:
+                most_borrowed_boards[window].adjust(row["book_id"], deltas, most_borrowed_score)
+
+# Function to get borrow counts per day, week or month from the daily rollup
+# Covers start <= day < end, with a zero row for every period without borrows
+async def get_borrow_stats_from_db(start: date, end: date, granularity: str):
+    if granularity not in ("day", "week", "month"):
+        raise ValueError(f"Unsupported granularity: {granularity}")
+    query = f"""
+    SELECT CAST(p.period AS date) AS period, COALESCE(SUM(s.borrow_count), 0) AS borrow_count
+    FROM generate_series(
+        date_trunc('{granularity}', CAST(CAST(:start AS date) AS timestamp)),
+        date_trunc('{granularity}', CAST(CAST(:end AS date) AS timestamp) - interval '1 day'),
+        interval '1 {granularity}'
+    ) AS p(period)
+    LEFT JOIN borrow_daily_stats s
+        ON date_trunc('{granularity}', CAST(s.day AS timestamp)) = p.period
+        AND s.day >= CAST(:start AS date) AND s.day < CAST(:end AS date)
+    GROUP BY p.period
+    ORDER BY p.period
     """
-    return await database.fetch_all(query)
+    return await _coalesced_read("fetch_all", query, {"start": start, "end": end})
+
 
 # -------------------- BORROW OPERATIONS --------------------
 
 # Function to insert a new borrow into the borrows table
 async def insert_borrow(user_id: int, book_id: int, borrow_quantity: int):
     query = """
-    INSERT INTO borrow (user_id, book_id, borrow_quantity)
-    VALUES (:user_id, :book_id, :borrow_quantity)
-    RETURNING borrow_id, user_id, book_id, borrow_quantity, borrow_date, return_date
+    WITH inserted AS (
+        INSERT INTO borrow (user_id, book_id, borrow_quantity)
+        VALUES (:user_id, :book_id, :borrow_quantity)
+        RETURNING borrow_id, user_id, book_id, borrow_quantity, borrow_date, return_date
+    ), """ + rollup_add_cte("inserted") + """
+    SELECT * FROM inserted
     """
     values = {"user_id": user_id, "book_id": book_id, "borrow_quantity": borrow_quantity}
-    return await database.fetch_one(query=query, values=values)
+    result = await database.fetch_one(query=query, values=values)
+    if result is not None:
+        adjust_most_borrowed([result], 1)
+    return result
+
+# Function to borrow a book in one atomic statement
+# The stock is decremented only if enough copies are available, and the borrow row is written in the same statement
+# Returns None if the book does not exist or does not have enough copies available
+async def borrow_book(user_id: int, book_id: int, borrow_quantity: int):
+    query = """
+    WITH stock AS (
+        UPDATE books
+        SET available_quantity = available_quantity - :borrow_quantity
+        WHERE book_id = :book_id AND available_quantity >= :borrow_quantity AND :borrow_quantity > 0
+        RETURNING book_id
+    ), inserted AS (
+        INSERT INTO borrow (user_id, book_id, borrow_quantity)
+        SELECT :user_id, book_id, :borrow_quantity FROM stock
+        RETURNING borrow_id, user_id, book_id, borrow_quantity, borrow_date, return_date
+    ), """ + rollup_add_cte("inserted") + """
+    SELECT * FROM inserted
+    """
+    values = {"user_id": user_id, "book_id": book_id, "borrow_quantity": borrow_quantity}
+    result = await database.fetch_one(query=query, values=values)
+    if result is not None:
+        invalidate_book_cache(book_id, quantity_only=True)
+        adjust_most_borrowed([result], 1)
+    return result
+
+# Function to return a borrow in one atomic statement
+# The borrow is closed and its copies put back in stock only if it has not been returned yet
+# Returns None if the borrow does not exist or was already returned
+async def return_borrow(borrow_id: int, return_date: datetime):
+    query = """
+    WITH closed AS (
+        UPDATE borrow
+        SET return_date = :return_date
+        WHERE borrow_id = :borrow_id AND return_date IS NULL
+        RETURNING borrow_id, user_id, book_id, borrow_quantity, borrow_date, return_date
+    ), restock AS (
+        UPDATE books bk
+        SET available_quantity = bk.available_quantity + c.borrow_quantity
+        FROM closed c
+        WHERE bk.book_id = c.book_id
+    ), """ + user_returns_cte("closed") + """
+    SELECT borrow_id, user_id, book_id, borrow_quantity, borrow_date, return_date FROM closed
+    """
+    values = {"borrow_id": borrow_id, "return_date": return_date}
+    result = await database.fetch_one(query=query, values=values)
+    if result is not None:
+        invalidate_book_cache(result["book_id"], quantity_only=True)
+    return result
+
+# Decide which items of a bulk borrow are granted and return their statuses, in input order
+# available maps each existing book_id to its stock and user_ids holds the existing users. Items are
+# granted in order while they fit in what is left of the stock; a rejected item takes no stock,
+# so a later, smaller item for the same book may still be granted
+def allocate_bulk_borrows(items: List[dict], available: dict, user_ids: set) -> List[str]:
+    remaining = dict(available)
+    statuses = []
+    for item in items:
+        book_id, quantity = item["book_id"], item["borrow_quantity"]
+        if book_id not in remaining or item["user_id"] not in user_ids:
+            statuses.append("not_found")
+        elif quantity <= 0:
+            statuses.append("invalid_quantity")
+        elif quantity > remaining[book_id]:
+            statuses.append("insufficient_stock")
+        else:
+            remaining[book_id] -= quantity
+            statuses.append("ok")
+    return statuses
+
+# Function to borrow a batch of books in one transaction
+# The books are locked, the items allocated with allocate_bulk_borrows, and the granted ones
+# inserted with their stock and counter updates in one set-based statement
+# Returns one row per item, in input order, with a status of ok, insufficient_stock, not_found or invalid_quantity
+async def borrow_books_bulk(items: List[dict]):
+    lock_query = """
+    SELECT book_id, available_quantity
+    FROM books
+    WHERE book_id = ANY(CAST(:book_ids AS int[]))
+    ORDER BY book_id
+    FOR UPDATE
+    """
+    users_query = "SELECT user_id FROM users WHERE user_id = ANY(CAST(:user_ids AS int[]))"
+    insert_query = """
+    WITH granted AS (
+        SELECT *
+        FROM unnest(CAST(:user_ids AS int[]), CAST(:book_ids AS int[]), CAST(:quantities AS int[]))
+            WITH ORDINALITY AS g(user_id, book_id, borrow_quantity, grant_index)
+    ), stock AS (
+        UPDATE books bk
+        SET available_quantity = bk.available_quantity - g.total
+        FROM (SELECT book_id, SUM(borrow_quantity) AS total FROM granted GROUP BY book_id) g
+        WHERE bk.book_id = g.book_id
+    ), inserted AS (
+        INSERT INTO borrow (user_id, book_id, borrow_quantity)
+        SELECT user_id, book_id, borrow_quantity FROM granted ORDER BY grant_index
+        RETURNING borrow_id, user_id, book_id, borrow_quantity, borrow_date, return_date
+    ), """ + rollup_add_cte("inserted") + """
+    SELECT borrow_id, borrow_date FROM inserted ORDER BY borrow_id
+    """
+    async with database.transaction():
+        # Locked in book_id order so that concurrent batches cannot deadlock on each other
+        stock = await database.fetch_all(lock_query, values={"book_ids": sorted({item["book_id"] for item in items})})
+        users = await database.fetch_all(users_query, values={"user_ids": list({item["user_id"] for item in items})})
+        statuses = allocate_bulk_borrows(
+            items, {row["book_id"]: row["available_quantity"] for row in stock}, {row["user_id"] for row in users}
+        )
+        granted = [item for item, status in zip(items, statuses) if status == "ok"]
+        inserted = []
+        if granted:
+            values = {
+                "user_ids": [item["user_id"] for item in granted],
+                "book_ids": [item["book_id"] for item in granted],
+                "quantities": [item["borrow_quantity"] for item in granted],
+            }
+            # Borrow ids are drawn in insertion order, which is grant order
+            inserted = iter(await database.fetch_all(insert_query, values=values))
+
+    result = []
+    for index, (item, status) in enumerate(zip(items, statuses), start=1):
+        borrow = next(inserted) if status == "ok" else None
+        result.append({
+            "item_index": index,
+            "user_id": item["user_id"],
+            "book_id": item["book_id"],
+            "borrow_quantity": item["borrow_quantity"],
+            "status": status,
+            "borrow_id": borrow["borrow_id"] if borrow else None,
+            "borrow_date": borrow["borrow_date"] if borrow else None,
+        })
+    borrowed = [row for row in result if row["status"] == "ok"]
+    for book_id in {row["book_id"] for row in borrowed}:
+        invalidate_book_cache(book_id, quantity_only=True)
+    adjust_most_borrowed(borrowed, 1)
+    return result
+
+# Function to return a batch of borrows in one set-based statement
+# Open borrows are closed and their copies put back in stock; a missing return_date means now
+# Returns one row per borrow_id, in input order, with a status of ok, already_returned, not_found or duplicate
+async def return_borrows_bulk(borrow_ids: List[int], return_date: Optional[datetime]):
+    query = """
+    WITH items AS (
+        SELECT borrow_id, item_index,
+            ROW_NUMBER() OVER (PARTITION BY borrow_id ORDER BY item_index) AS occurrence
+        FROM unnest(CAST(:borrow_ids AS int[])) WITH ORDINALITY AS i(borrow_id, item_index)
+    ), closed AS (
+        UPDATE borrow b
+        SET return_date = COALESCE(CAST(:return_date AS timestamp), NOW())
+        WHERE b.borrow_id IN (SELECT borrow_id FROM items) AND b.return_date IS NULL
+        RETURNING b.borrow_id, b.user_id, b.book_id, b.borrow_quantity, b.return_date
+    ), restock AS (
+        UPDATE books bk
+        SET available_quantity = bk.available_quantity + c.total
+        FROM (SELECT book_id, SUM(borrow_quantity) AS total FROM closed GROUP BY book_id) c
+        WHERE bk.book_id = c.book_id
+    ), """ + user_returns_cte("closed") + """
+    SELECT
+        i.item_index, i.borrow_id,
+        CASE
+            WHEN i.occurrence > 1 THEN 'duplicate'
+            WHEN c.borrow_id IS NOT NULL THEN 'ok'
+            WHEN b.borrow_id IS NULL THEN 'not_found'
+            ELSE 'already_returned'
+        END AS status,
+        c.book_id, c.return_date
+    FROM items i
+    LEFT JOIN closed c ON c.borrow_id = i.borrow_id AND i.occurrence = 1
+    LEFT JOIN borrow b ON b.borrow_id = i.borrow_id
+    ORDER BY i.item_index
+    """
+    values = {"borrow_ids": borrow_ids, "return_date": return_date}
+    result = await database.fetch_all(query=query, values=values)
+    for book_id in {row["book_id"] for row in result if row["status"] == "ok"}:
+        invalidate_book_cache(book_id, quantity_only=True)
+    return result
 
 # Get total borrows count
 async def get_total_borrows_from_db():
     query = "SELECT COUNT(*) FROM borrow"
-    result = await database.fetch_one(query)
+    result = await _coalesced_read("fetch_one", query)
     return result[0]
 
-# Function to update the return date of a borrow by borrow_id
-async def update_borrow_return_date(borrow_id: int, return_date: Optional[datetime]):
+# Function to change the return date of a borrow that was already returned
+# Stock and counters are untouched; returning and reopening go through return_borrow and reopen_borrow
+# Returns None if the borrow does not exist or is still open
+async def update_borrow_return_date(borrow_id: int, return_date: datetime):
     query = """
-    UPDATE borrow 
+    UPDATE borrow
     SET return_date = :return_date
-    WHERE borrow_id = :borrow_id
+    WHERE borrow_id = :borrow_id AND return_date IS NOT NULL
     RETURNING borrow_id, user_id, book_id, borrow_quantity, borrow_date, return_date
     """
     values = {"borrow_id": borrow_id, "return_date": return_date}
     return await database.fetch_one(query=query, values=values)
 
+# Function to reopen a returned borrow in one atomic statement
+# Its copies are taken back out of stock only if enough are available, and it rejoins its user's active count
+# Returns None if the borrow does not exist, else the borrow with a status of ok, open (it was
+# never returned, so nothing changed) or insufficient_stock
+async def reopen_borrow(borrow_id: int):
+    query = """
+    WITH target AS (
+        SELECT borrow_id, book_id, borrow_quantity, return_date
+        FROM borrow
+        WHERE borrow_id = :borrow_id
+        FOR UPDATE
+    ), stock AS (
+        UPDATE books bk
+        SET available_quantity = bk.available_quantity - t.borrow_quantity
+        FROM target t
+        WHERE bk.book_id = t.book_id AND t.return_date IS NOT NULL AND bk.available_quantity >= t.borrow_quantity
+        RETURNING bk.book_id
+    ), reopened AS (
+        UPDATE borrow b
+        SET return_date = NULL
+        FROM stock
+        WHERE b.borrow_id = :borrow_id
+        RETURNING b.borrow_id, b.user_id
+    ), user_counts AS (
+        UPDATE user_borrow_counts s
+        SET active_borrows = s.active_borrows + 1
+        FROM reopened r
+        WHERE s.user_id = r.user_id
+    )
+    SELECT
+        b.borrow_id, b.user_id, b.book_id, b.borrow_quantity, b.borrow_date,
+        CASE WHEN r.borrow_id IS NULL THEN t.return_date END AS return_date,
+        CASE
+            WHEN r.borrow_id IS NOT NULL THEN 'ok'
+            WHEN t.return_date IS NULL THEN 'open'
+            ELSE 'insufficient_stock'
+        END AS status
+    FROM target t
+    JOIN borrow b ON b.borrow_id = t.borrow_id
+    LEFT JOIN reopened r ON r.borrow_id = t.borrow_id
+    """
+    result = await database.fetch_one(query=query, values={"borrow_id": borrow_id})
+    if result is not None and result["status"] == "ok":
+        invalidate_book_cache(result["book_id"], quantity_only=True)
+    return result
+
 
 # Function to select a borrow by borrow_id
-async def get_borrow(borrow_id: int):
-    query = """
+GET_BORROW = PreparedStatement("get_borrow", """
     SELECT 
         b.borrow_id, 
         b.user_id, 
@@ -237,57 +1208,83 @@ async def get_borrow(borrow_id: int):
         bk.book_name,  -- Join to get book_name
         b.borrow_quantity, 
         b.borrow_date, 
-        b.return_date
+        b.return_date,
+        b.due_date
     FROM borrow b
     JOIN users u ON b.user_id = u.user_id
     JOIN books bk ON b.book_id = bk.book_id
-    WHERE borrow_id = :borrow_id
-    """
-    return await database.fetch_one(query=query, values={"borrow_id": borrow_id})
+    WHERE borrow_id = $1
+""")
+
+async def get_borrow(borrow_id: int):
+    return record_to_dict(await GET_BORROW.fetchrow(replica_database, borrow_id))
 
 # Function to delete a borrow by borrow_id
 async def delete_borrow(borrow_id: int):
-    query = "DELETE FROM borrow WHERE borrow_id = :borrow_id RETURNING *"
-    return await database.fetch_one(query=query, values={"borrow_id": borrow_id})
+    query = """
+    WITH deleted AS (
+        DELETE FROM borrow WHERE borrow_id = :borrow_id RETURNING *
+    ), """ + rollup_remove_cte("deleted") + """
+    SELECT * FROM deleted
+    """
+    result = await database.fetch_one(query=query, values={"borrow_id": borrow_id})
+    if result is not None:
+        adjust_most_borrowed([result], -1)
+    return result
 
 
 async def get_borrows_by_user_from_db(user_id: int):
     query = """
-    SELECT b.borrow_id, b.user_id, u.username, b.book_id, bk.book_name, b.borrow_quantity, b.borrow_date, b.return_date
+    SELECT b.borrow_id, b.user_id, u.username, b.book_id, bk.book_name, b.borrow_quantity, b.borrow_date, b.return_date,
+        b.due_date
     FROM borrow b
     JOIN users u ON b.user_id = u.user_id
     JOIN books bk ON b.book_id = bk.book_id
     WHERE b.user_id = :user_id
     """
-    return await database.fetch_all(query, values={"user_id": user_id})
+    return await replica_database.fetch_all(query, values={"user_id": user_id})
 
 
+# Function to get the borrow count of each of the last seven days from the daily rollup
 async def get_weekly_borrowing_from_db():
-    query = """
-    SELECT
-        TO_CHAR(date_trunc('day', borrow_date), 'Day') AS day_of_week,
-        COUNT(*) AS borrow_count
-    FROM
-        borrow
-    GROUP BY
-        TO_CHAR(date_trunc('day', borrow_date), 'Day'),
-        date_trunc('day', borrow_date)
-    ORDER BY
-        date_trunc('day', borrow_date);
-    """
-    try:
-        result = await database.fetch_all(query)
-        # Log the result for debugging
-        print("Database result:", result)
-        return result
-    except Exception as e:
-        print("Error executing query:", e)
-        return None
+    end = date.today() + timedelta(days=1)
+    return await get_borrow_stats_from_db(end - timedelta(days=7), end, "day")
 
 
 
 
-async def get_all_borrows_from_db():
+# Build the WHERE clause shared by the borrow list queries
+def build_borrow_filters(after_id: Optional[int] = None, user_id: Optional[int] = None, book_id: Optional[int] = None,
+                         borrowed_from: Optional[datetime] = None, borrowed_to: Optional[datetime] = None,
+                         not_returned: bool = False):
+    conditions = []
+    values = {}
+    if after_id is not None:
+        conditions.append("b.borrow_id > :after_id")
+        values["after_id"] = after_id
+    if user_id is not None:
+        conditions.append("b.user_id = :user_id")
+        values["user_id"] = user_id
+    if book_id is not None:
+        conditions.append("b.book_id = :book_id")
+        values["book_id"] = book_id
+    if borrowed_from is not None:
+        conditions.append("b.borrow_date >= :borrowed_from")
+        values["borrowed_from"] = borrowed_from
+    if borrowed_to is not None:
+        conditions.append("b.borrow_date < :borrowed_to")
+        values["borrowed_to"] = borrowed_to
+    if not_returned:
+        conditions.append("b.return_date IS NULL")
+    where = " WHERE " + " AND ".join(conditions) if conditions else ""
+    return where, values
+
+# Function to get borrows with user and book names, ordered by borrow_id
+# Pass after_id (the last borrow_id seen) and limit to fetch one keyset page
+async def get_all_borrows_from_db(limit: Optional[int] = None, after_id: Optional[int] = None, user_id: Optional[int] = None,
+                                  book_id: Optional[int] = None, borrowed_from: Optional[datetime] = None,
+                                  borrowed_to: Optional[datetime] = None, not_returned: bool = False):
+    where, values = build_borrow_filters(after_id, user_id, book_id, borrowed_from, borrowed_to, not_returned)
     query = """
     SELECT 
         b.borrow_id, 
@@ -297,23 +1294,119 @@ async def get_all_borrows_from_db():
         bk.book_name,  -- Join to get book_name
         b.borrow_quantity, 
         b.borrow_date, 
-        b.return_date
+        b.return_date,
+        b.due_date
+    FROM borrow b
+    JOIN users u ON b.user_id = u.user_id
+    JOIN books bk ON b.book_id = bk.book_id
+    """ + where + " ORDER BY b.borrow_id"
+    if limit is not None:
+        query += " LIMIT :limit"
+        values["limit"] = limit
+    return await replica_database.fetch_all(query, values=values)
+
+
+# Function to stream borrows with user and book names through a server-side cursor
+async def iterate_borrows_from_db(user_id: Optional[int] = None, book_id: Optional[int] = None,
+                                  borrowed_from: Optional[datetime] = None, borrowed_to: Optional[datetime] = None,
+                                  not_returned: bool = False):
+    where, values = build_borrow_filters(None, user_id, book_id, borrowed_from, borrowed_to, not_returned)
+    query = """
+    SELECT b.borrow_id, b.user_id, u.username, b.book_id, bk.book_name, b.borrow_quantity, b.borrow_date, b.return_date,
+        b.due_date
     FROM borrow b
     JOIN users u ON b.user_id = u.user_id
     JOIN books bk ON b.book_id = bk.book_id
+    """ + where + " ORDER BY b.borrow_id"
+    async for row in replica_database.iterate(query, values=values):
+        yield row
+
+
+# -------------------- OVERDUE OPERATIONS --------------------
+
+# Key for pg_try_advisory_xact_lock, so only one app instance refreshes the overdue counts at a time
+OVERDUE_REFRESH_LOCK_ID = 727502
+
+# Function to get open borrows past their due date, most overdue first (or least overdue first)
+# Pass after (the (due_date, borrow_id) of the last row seen) and limit to fetch one keyset page
+# The filter and sort match the partial index on unreturned borrows
+async def get_overdue_borrows_from_db(limit: int, after: Optional[tuple] = None, user_id: Optional[int] = None,
+                                      most_overdue_first: bool = True):
+    conditions = ["b.return_date IS NULL", "b.due_date < LOCALTIMESTAMP"]
+    values = {"limit": limit}
+    direction = "ASC" if most_overdue_first else "DESC"
+    if after is not None:
+        comparison = ">" if most_overdue_first else "<"
+        conditions.append(
+            f"(b.due_date, b.borrow_id) {comparison} (CAST(:after_due_date AS timestamp), CAST(:after_id AS integer))"
+        )
+        values["after_due_date"], values["after_id"] = after
+    if user_id is not None:
+        conditions.append("b.user_id = :user_id")
+        values["user_id"] = user_id
+    query = f"""
+    SELECT b.borrow_id, b.user_id, u.username, b.book_id, bk.book_name, b.borrow_quantity, b.borrow_date, b.return_date,
+        b.due_date, CAST(date_part('day', LOCALTIMESTAMP - b.due_date) AS integer) AS days_overdue
+    FROM borrow b
+    JOIN users u ON b.user_id = u.user_id
+    JOIN books bk ON b.book_id = bk.book_id
+    WHERE {" AND ".join(conditions)}
+    ORDER BY b.due_date {direction}, b.borrow_id {direction}
+    LIMIT :limit
     """
-    return await database.fetch_all(query)
+    return await replica_database.fetch_all(query, values=values)
 
+# Function to recompute the overdue count of every user in one statement
+# Returns the number of users with overdue borrows, or None if another instance is already refreshing
+async def refresh_user_overdue_counts():
+    query = """
+    WITH current_counts AS (
+        SELECT user_id, COUNT(*) AS overdue_count, MIN(due_date) AS oldest_due_date
+        FROM borrow
+        WHERE return_date IS NULL AND due_date < LOCALTIMESTAMP
+        GROUP BY user_id
+    ), cleared AS (
+        DELETE FROM user_overdue_counts o
+        WHERE NOT EXISTS (SELECT 1 FROM current_counts c WHERE c.user_id = o.user_id)
+    ), upserted AS (
+        INSERT INTO user_overdue_counts (user_id, overdue_count, oldest_due_date, refreshed_at)
+        SELECT user_id, overdue_count, oldest_due_date, now() FROM current_counts
+        ON CONFLICT (user_id) DO UPDATE
+        SET overdue_count = EXCLUDED.overdue_count, oldest_due_date = EXCLUDED.oldest_due_date,
+            refreshed_at = EXCLUDED.refreshed_at
+    )
+    SELECT COUNT(*) FROM current_counts
+    """
+    async with database.transaction():
+        locked = await database.fetch_val("SELECT pg_try_advisory_xact_lock(:lock_id)", values={"lock_id": OVERDUE_REFRESH_LOCK_ID})
+        if not locked:
+            return None
+        return await database.fetch_val(query)
 
-async def update_book_quantity_on_borrow(book_id: int, borrow_quantity: int):
+# Function to get the users with the most overdue borrows, as of the last refresh
+async def get_user_overdue_counts_from_db(limit: int):
     query = """
+    SELECT o.user_id, u.username, u.email, o.overdue_count, o.oldest_due_date, o.refreshed_at
+    FROM user_overdue_counts o
+    JOIN users u ON u.user_id = o.user_id
+    ORDER BY o.overdue_count DESC, o.oldest_due_date, o.user_id
+    LIMIT :limit
+    """
+    return await _coalesced_read("fetch_all", query, {"limit": limit})
+
+
+UPDATE_BOOK_QUANTITY_ON_BORROW = PreparedStatement("update_book_quantity_on_borrow", """
     UPDATE books
-    SET available_quantity = available_quantity - :borrow_quantity
-    WHERE book_id = :book_id AND available_quantity >= :borrow_quantity
+    SET available_quantity = available_quantity - $2
+    WHERE book_id = $1 AND available_quantity >= $2
     RETURNING available_quantity
-    """
-    values = {"book_id": book_id, "borrow_quantity": borrow_quantity}
-    return await database.fetch_one(query=query, values=values)
+""")
+
+async def update_book_quantity_on_borrow(book_id: int, borrow_quantity: int):
+    result = record_to_dict(await UPDATE_BOOK_QUANTITY_ON_BORROW.fetchrow(database, book_id, borrow_quantity))
+    if result is not None:
+        invalidate_book_cache(book_id, quantity_only=True)
+    return result
 
 async def update_book_quantity_on_return(book_id: int, borrow_quantity: int):
     query = """
@@ -323,5 +1416,11 @@ async def update_book_quantity_on_return(book_id: int, borrow_quantity: int):
     RETURNING available_quantity
     """
     values = {"book_id": book_id, "borrow_quantity": borrow_quantity}
-    return await database.fetch_one(query=query, values=values)
+    result = await database.fetch_one(query=query, values=values)
+    if result is not None:
+        invalidate_book_cache(book_id, quantity_only=True)
+    return result
+
 
+# Time every query function above; must stay at the end of the module
+instrument_module(globals())
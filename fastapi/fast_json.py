@@ -0,0 +1,35 @@
+from fastapi import Response
+from pydantic import BaseModel
+from typing import Iterable, Mapping, Optional, Type
+from datetime import date, datetime
+import json
+import os
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is optional
+    orjson = None
+
+# Opt-in: encode list responses straight from the database rows instead of through Pydantic
+FAST_JSON_RESPONSES = os.environ.get("FAST_JSON_RESPONSES", "").lower() in ("1", "true", "yes")
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+# Encode rows to a JSON array, keeping only the fields of the response model, in model order
+def encode_rows(rows: Iterable[Mapping], model: Type[BaseModel]) -> bytes:
+    fields = list(model.model_fields)
+    items = [{field: row[field] for field in fields} for row in rows]
+    if orjson is not None:
+        return orjson.dumps(items)
+    return json.dumps(items, default=_json_default, separators=(",", ":")).encode()
+
+
+# Build a JSON response for a list route, carrying over headers already set on the injected response
+def fast_list_response(rows: Iterable[Mapping], model: Type[BaseModel], response: Optional[Response] = None) -> Response:
+    headers = dict(response.headers) if response is not None else None
+    return Response(content=encode_rows(rows, model), media_type="application/json", headers=headers)
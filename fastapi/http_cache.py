@@ -0,0 +1,58 @@
+from fastapi import Request
+from datetime import timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import List, Optional
+from database import get_table_versions
+import hashlib
+
+# Cache-Control for catalog reads: shared caches may serve them briefly, then must revalidate
+CATALOG_CACHE_CONTROL = "public, max-age=5, stale-while-revalidate=30"
+
+# Cache-Control for per-user reads: only the client may cache them, and must always revalidate
+USER_CACHE_CONTROL = "private, no-cache"
+
+
+# Check an If-None-Match header against the current ETag of a resource
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # Weak comparison, as required for If-None-Match
+    candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return etag.removeprefix("W/") in candidates
+
+
+# Check an If-Modified-Since header against the last change of a resource (HTTP dates have one-second precision)
+def not_modified_since(if_modified_since: Optional[str], last_modified) -> bool:
+    if not if_modified_since or last_modified is None:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    if since.tzinfo is None:
+        return False
+    return last_modified.replace(microsecond=0) <= since
+
+
+# Build the validators of a read from the versions of the tables it depends on
+# Returns (headers, not_modified); the caller answers 304 with the headers when not_modified is True
+async def conditional_headers(request: Request, tables: List[str], cache_control: str):
+    versions = await get_table_versions(tables)
+    # The URL is part of the tag so different pages and filters never share an ETag
+    url_hash = hashlib.blake2b(str(request.url).encode(), digest_size=8).hexdigest()
+    version_tag = ".".join(str(versions[table][0]) for table in tables)
+    etag = f'W/"{version_tag}-{url_hash}"'
+
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    changed_at = [updated_at for _, updated_at in versions.values() if updated_at is not None]
+    last_modified = max(changed_at) if changed_at else None
+    if last_modified is not None:
+        headers["Last-Modified"] = format_datetime(last_modified.astimezone(timezone.utc), usegmt=True)
+
+    # If-None-Match takes precedence over If-Modified-Since when both are sent
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return headers, etag_matches(if_none_match, etag)
+    return headers, not_modified_since(request.headers.get("if-modified-since"), last_modified)
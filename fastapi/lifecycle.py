@@ -0,0 +1,63 @@
+"""Startup, readiness and shutdown of one app process.
+
+The lifespan handler connects and warms up the process before the server
+starts accepting connections: it opens the pools (applying migrations),
+pre-opens pooled connections, fills the catalog cache and the leaderboards,
+and starts the background tasks. Only then does /health/ready answer 200.
+
+On SIGTERM the launcher calls begin_drain() first, which fails readiness and
+ends the live availability streams; uvicorn then stops accepting connections
+and lets in-flight requests finish before the shutdown half of the lifespan
+closes the pools.
+"""
+from contextlib import asynccontextmanager
+import logging
+import time
+from availability import broadcaster
+from background import start_background_tasks, stop_background_tasks
+from database import connect_db, disconnect_db, warm_up_caches, warm_up_pool
+from metrics import app_ready, app_startup_seconds, flush_metrics
+
+logger = logging.getLogger("uvicorn.error")
+
+# True from the end of warmup until the process starts draining
+ready = False
+
+
+def set_ready(value: bool):
+    global ready
+    ready = value
+    app_ready.set(1 if value else 0)
+
+
+# Stop taking new work ahead of shutdown; called from the signal handler, so it must not block
+def begin_drain():
+    if ready:
+        logger.info("Draining: readiness now fails and live streams are closed")
+    set_ready(False)
+    broadcaster.close()
+
+
+@asynccontextmanager
+async def lifespan(app):
+    started = time.perf_counter()
+    await connect_db()
+    connected = time.perf_counter()
+    await warm_up_pool()
+    await warm_up_caches()
+    start_background_tasks()
+    finished = time.perf_counter()
+    app_startup_seconds.set(finished - started)
+    set_ready(True)
+    logger.info(
+        f"Ready in {finished - started:.2f}s "
+        f"(connect and migrate {connected - started:.2f}s, warmup {finished - connected:.2f}s)"
+    )
+    try:
+        yield
+    finally:
+        set_ready(False)
+        await stop_background_tasks()
+        # The last counts of this worker stay in the merged totals after it exits
+        await flush_metrics()
+        await disconnect_db()
@@ -0,0 +1,290 @@
+"""Maintenance commands for the library database.
+
+Run from the fastapi directory:
+
+    python manage.py migrate [--status] [--target 5]
+    python manage.py check-queries [--min-rows 10000]
+    python manage.py backfill-rollups
+    python manage.py verify-borrow-counts [--repair]
+    python manage.py migrate-passwords [--batch-size 500] [--workers 8] [--restart]
+"""
+import argparse
+import asyncio
+import inspect
+import json
+import os
+import time
+from collections import deque
+
+# Maintenance jobs scan whole tables, so they are not subject to the API's statement timeout
+os.environ.setdefault("DB_STATEMENT_TIMEOUT_MS", "0")
+# Migrations are applied explicitly with the migrate command
+os.environ.setdefault("DB_MIGRATE_ON_STARTUP", "0")
+
+from concurrent.futures import ProcessPoolExecutor
+from credentials import wrap_legacy_hashes
+from database import *
+from migrations import migrate, migration_status
+from prepared import PreparedStatement
+import database as database_module
+
+PASSWORD_MIGRATION_CHECKPOINT = "migrate-passwords"
+
+
+async def run_migrations(args):
+    if args.status:
+        for version, name, applied in await migration_status(database):
+            print(f"{version:4d}  {'applied' if applied else 'pending':8s} {name}")
+        return
+    started = time.perf_counter()
+    applied = await migrate(database, args.target)
+    for migration in applied:
+        print(f"applied {migration.version}: {migration.name}")
+    print(f"Applied {len(applied)} migrations in {time.perf_counter() - started:.1f}s")
+
+
+# Sample value for each parameter name used by the database.py functions
+SAMPLE_ARGUMENTS = {
+    "tables": ["books"], "name": "check-queries", "last_id": 1, "checkpoint": "check-queries",
+    "user_id": 1, "username": "check", "password_hash": "check", "email": "check@example.com",
+    "book_id": 1, "book_name": "check", "book_quantity": 1, "available_quantity": 1,
+    "book_description": "check", "book_pic": "check.png", "cover_key": "0" * 32, "genre_id": 1,
+    "borrow_id": 1, "borrow_ids": [1, 2], "borrow_quantity": 1,
+    "items": [{"user_id": 1, "book_id": 1, "borrow_quantity": 1}], "rows": [(1, "old", "new")],
+    "limit": DEFAULT_PAGE_SIZE, "after_id": 1, "after": (datetime.now(), 1), "most_overdue_first": True, "not_returned": True, "granularity": "day", "window": "7d",
+    "sort": "lifetime",
+    "borrowed_from": datetime.now() - timedelta(days=30), "borrowed_to": datetime.now(),
+    "return_date": datetime.now(), "start": date.today() - timedelta(days=30), "end": date.today(),
+}
+
+# Sample values for functions whose parameter of a shared name takes a different shape
+FUNCTION_SAMPLE_ARGUMENTS = {
+    "get_all_users_with_borrow_count": {"after": (1, 1)},
+}
+
+# Functions that are not checked: connection management, COPY, and whole-table maintenance
+UNCHECKED_FUNCTIONS = {
+    "connect_db", "disconnect_db", "warm_up_pool", "copy_books_into_db", "backfill_borrow_rollup",
+    "find_user_borrow_count_mismatches", "repair_user_borrow_counts",
+}
+
+
+# Call a database.py function with its queries captured instead of run, and return (sql, args, named) for each
+async def capture_queries(function, kwargs: dict):
+    captured = []
+
+    def recorder(result=None):
+        async def record(query, values=None):
+            captured.append((query, values or {}, True))
+            return result
+        return record
+
+    async def record_iterate(query, values=None):
+        captured.append((query, values or {}, True))
+        return
+        yield
+
+    def prepared_recorder(result=None):
+        async def record(statement, db, *args):
+            captured.append((statement.sql, args, False))
+            return result
+        return record
+
+    originals = []
+    for db in {id(database): database, id(replica_database): replica_database}.values():
+        for method, result in (("fetch_all", []), ("fetch_one", None), ("fetch_val", None), ("execute", None)):
+            originals.append((db, method, db.__dict__.get(method)))
+            setattr(db, method, recorder(result))
+        originals.append((db, "iterate", db.__dict__.get("iterate")))
+        db.iterate = record_iterate
+    prepared_originals = (PreparedStatement.fetchrow, PreparedStatement.fetch)
+    PreparedStatement.fetchrow, PreparedStatement.fetch = prepared_recorder(), prepared_recorder([])
+    catalog_cache.clear()
+    read_coalescer.clear()
+    try:
+        result = function(**kwargs)
+        if inspect.isasyncgen(result):
+            async for _ in result:
+                pass
+        else:
+            await result
+    except Exception:
+        # The empty results handed back above may trip up the caller; the queries are already captured
+        pass
+    finally:
+        PreparedStatement.fetchrow, PreparedStatement.fetch = prepared_originals
+        for db, method, original in originals:
+            if original is None:
+                delattr(db, method)
+            else:
+                setattr(db, method, original)
+    return captured
+
+
+# Yield (node type, relation) for every node of an EXPLAIN (FORMAT JSON) plan
+def walk_plan(plan: dict):
+    yield plan["Node Type"], plan.get("Relation Name")
+    for child in plan.get("Plans", []):
+        yield from walk_plan(child)
+
+
+# EXPLAIN every query of every database.py function and flag sequential scans on large tables
+async def check_queries(args):
+    rows = await database.fetch_all("""
+    SELECT c.relname, GREATEST(c.reltuples, 0) AS estimated_rows
+    FROM pg_class c
+    WHERE c.relkind = 'r' AND c.relnamespace = CAST('public' AS regnamespace)
+    """)
+    table_rows = {row["relname"]: int(row["estimated_rows"]) for row in rows}
+
+    flagged = 0
+    for name, function in vars(database_module).items():
+        if name.startswith("_") or name in UNCHECKED_FUNCTIONS:
+            continue
+        if getattr(function, "__module__", None) != "database":
+            continue
+        if not (inspect.iscoroutinefunction(function) or inspect.isasyncgenfunction(function)):
+            continue
+        parameters = inspect.signature(function).parameters
+        samples = {**SAMPLE_ARGUMENTS, **FUNCTION_SAMPLE_ARGUMENTS.get(name, {})}
+        missing = [p for p in parameters if p not in samples]
+        if missing:
+            print(f"{name}: skipped, no sample value for {', '.join(missing)}")
+            continue
+
+        for query, query_args, named in await capture_queries(function, {p: samples[p] for p in parameters}):
+            explain = "EXPLAIN (FORMAT JSON) " + query
+            try:
+                if named:
+                    plan = await database.fetch_val(explain, values=query_args)
+                else:
+                    async with database.connection() as connection:
+                        plan = await connection.raw_connection.fetchval(explain, *query_args)
+            except Exception as e:
+                print(f"{name}: could not explain ({e})")
+                continue
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            for node_type, relation in walk_plan(plan[0]["Plan"]):
+                if node_type == "Seq Scan" and table_rows.get(relation, 0) >= args.min_rows:
+                    flagged += 1
+                    print(f"{name}: sequential scan on {relation} (~{table_rows[relation]} rows)")
+
+    print(f"{flagged} sequential scans on tables with at least {args.min_rows} rows")
+    if flagged:
+        raise SystemExit(1)
+
+
+async def backfill_rollups(args):
+    started = time.perf_counter()
+    days = await backfill_borrow_rollup()
+    print(f"Rebuilt daily borrow rollup for {days} days in {time.perf_counter() - started:.1f}s")
+
+
+# Compare the per-user borrow counters with the borrow table, optionally rewriting the wrong ones
+async def verify_borrow_counts(args):
+    started = time.perf_counter()
+    mismatches = await find_user_borrow_count_mismatches()
+    for row in mismatches[:20]:
+        print(
+            f"user {row['user_id']}: active {row['stored_active_borrows']} (actual {row['active_borrows']}), "
+            f"lifetime {row['stored_lifetime_borrows']} (actual {row['lifetime_borrows']})"
+        )
+    if len(mismatches) > 20:
+        print(f"... and {len(mismatches) - 20} more")
+    print(f"{len(mismatches)} users with wrong borrow counters ({time.perf_counter() - started:.1f}s)")
+    if args.repair:
+        repaired = await repair_user_borrow_counts()
+        print(f"Repaired the counters of {repaired} users")
+    elif mismatches:
+        raise SystemExit(1)
+
+
+# Wrap every legacy Vigenère password in scrypt, resuming from the last checkpoint
+# Batches are hashed in parallel across processes but written back in user_id order,
+# so the checkpoint never moves past a batch that has not been stored
+async def migrate_passwords(args):
+    if args.restart:
+        await reset_checkpoint(PASSWORD_MIGRATION_CHECKPOINT)
+    after_id = await get_checkpoint(PASSWORD_MIGRATION_CHECKPOINT)
+    print(f"Migrating legacy passwords after user_id {after_id} with {args.workers} worker processes")
+
+    # The cursor is read in its own task so it holds its own connection, separate from the writes
+    batches = asyncio.Queue(maxsize=args.workers * 2)
+
+    async def read_batches():
+        try:
+            batch = []
+            async for row in iterate_legacy_password_hashes(after_id):
+                batch.append((row["user_id"], row["password_hash"]))
+                if len(batch) >= args.batch_size:
+                    await batches.put(batch)
+                    batch = []
+            if batch:
+                await batches.put(batch)
+        finally:
+            # Always signal the end, even if reading failed; the failure is raised by awaiting the task
+            await batches.put(None)
+
+    loop = asyncio.get_running_loop()
+    reader = asyncio.create_task(read_batches())
+    started = time.perf_counter()
+    migrated = 0
+
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        in_flight = deque()
+
+        async def write_oldest():
+            nonlocal migrated
+            rows = await in_flight.popleft()
+            await replace_password_hashes(rows, PASSWORD_MIGRATION_CHECKPOINT)
+            migrated += len(rows)
+            rate = migrated / (time.perf_counter() - started)
+            print(f"migrated {migrated} users ({rate:.0f}/s), checkpoint user_id {rows[-1][0]}")
+
+        try:
+            while (batch := await batches.get()) is not None:
+                in_flight.append(loop.run_in_executor(pool, wrap_legacy_hashes, batch))
+                if len(in_flight) >= args.workers:
+                    await write_oldest()
+            while in_flight:
+                await write_oldest()
+            await reader
+        finally:
+            reader.cancel()
+
+    elapsed = time.perf_counter() - started
+    print(f"Migrated {migrated} users in {elapsed:.1f}s ({migrated / elapsed if elapsed else 0:.0f}/s)")
+
+
+COMMANDS = {
+    "migrate": (run_migrations, "apply pending schema migrations"),
+    "check-queries": (check_queries, "EXPLAIN the database.py queries and flag sequential scans on large tables"),
+    "backfill-rollups": (backfill_rollups, "rebuild the daily borrow rollup from the borrow table"),
+    "verify-borrow-counts": (verify_borrow_counts, "check the per-user borrow counters against the borrow table"),
+    "migrate-passwords": (migrate_passwords, "wrap legacy Vigenère passwords in scrypt, resumably"),
+}
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Maintenance commands for the library database")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subcommands = {name: subparsers.add_parser(name, help=help_text) for name, (_, help_text) in COMMANDS.items()}
+    subcommands["migrate"].add_argument("--status", action="store_true", help="list migrations without applying them")
+    subcommands["migrate"].add_argument("--target", type=int, help="stop after this version")
+    subcommands["check-queries"].add_argument("--min-rows", type=int, default=10000, help="smallest table to flag")
+    subcommands["verify-borrow-counts"].add_argument("--repair", action="store_true", help="rewrite wrong counters")
+    subcommands["migrate-passwords"].add_argument("--batch-size", type=int, default=500, help="users per batch")
+    subcommands["migrate-passwords"].add_argument("--workers", type=int, default=os.cpu_count() or 1, help="hashing processes")
+    subcommands["migrate-passwords"].add_argument("--restart", action="store_true", help="ignore the saved checkpoint")
+    args = parser.parse_args()
+
+    await connect_db()
+    try:
+        await COMMANDS[args.command][0](args)
+    finally:
+        await disconnect_db()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,438 @@
+"""In-process request and query metrics, exposed in Prometheus text format.
+
+Everything runs on the event loop thread, so the counters are plain dicts
+updated without locks; recording one observation is a bisect and a few
+additions. Requests are labelled by route template (/api/books/{book_id}),
+never by the raw path, and queries by database.py function name, which keeps
+the number of series fixed.
+
+Every process keeps its own samples. When serve.py runs several workers it
+gives them a shared METRICS_DIR: each worker writes a snapshot of its samples
+there every METRICS_FLUSH_SECONDS, and /metrics, whichever worker answers it,
+merges the snapshots of all of them. Counters and histograms are summed over
+every worker that ever ran, so they never go backwards when one exits; gauges
+only cover the workers still running.
+"""
+from bisect import bisect_left
+from typing import Callable, List, Optional
+import asyncio
+import functools
+import inspect
+import json
+import logging
+import os
+import time
+
+# Calls to database.py functions slower than this are logged (0 disables the log)
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", 500))
+
+# Histogram bucket upper bounds in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Directory shared by the workers of one server, set by serve.py; a process without it renders its own samples
+METRICS_DIR = os.environ.get("METRICS_DIR")
+# Seconds between the snapshots each worker writes to METRICS_DIR
+METRICS_FLUSH_SECONDS = float(os.environ.get("METRICS_FLUSH_SECONDS", 1))
+
+slow_query_logger = logging.getLogger("slow_query")
+
+
+class Counter:
+    def __init__(self, name: str, help: str, label_names: tuple = ()):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.values = {}  # label values -> count
+
+    def inc(self, labels: tuple = (), amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dump(self):
+        return [[list(labels), value] for labels, value in self.values.items()]
+
+    # Sum the samples of every worker's snapshot
+    def merge(self, snapshots: List["Snapshot"]):
+        values = {}
+        for snapshot in snapshots:
+            for labels, value in snapshot.samples.get(self.name, []):
+                values[tuple(labels)] = values.get(tuple(labels), 0) + value
+        return values
+
+    def render(self, values: Optional[dict] = None):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in (self.values if values is None else values).items():
+            yield f"{self.name}{format_labels(self.label_names, labels)} {value}"
+
+
+class Gauge(Counter):
+    """A value that goes up and down. Across workers it is summed ("livesum") or,
+    for values that make no sense added up, reported per worker with a pid label ("liveall")."""
+
+    def __init__(self, name: str, help: str, label_names: tuple = (), multiprocess: str = "livesum"):
+        super().__init__(name, help, label_names)
+        self.multiprocess = multiprocess
+
+    def dec(self, labels: tuple = (), amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) - amount
+
+    def set(self, value: float, labels: tuple = ()):
+        self.values[labels] = value
+
+    # Only running workers count; a worker that exited no longer holds connections or streams
+    def merge(self, snapshots: List["Snapshot"]):
+        live = [snapshot for snapshot in snapshots if snapshot.alive]
+        if self.multiprocess == "livesum":
+            return super().merge(live)
+        return {
+            tuple(labels) + (str(snapshot.pid),): value
+            for snapshot in live
+            for labels, value in snapshot.samples.get(self.name, [])
+        }
+
+    def render(self, values: Optional[dict] = None):
+        label_names = self.label_names
+        if values is not None and self.multiprocess == "liveall":
+            label_names += ("pid",)
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} gauge"
+        for labels, value in (self.values if values is None else values).items():
+            yield f"{self.name}{format_labels(label_names, labels)} {value}"
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, label_names: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.buckets = buckets
+        self.series = {}  # label values -> [per-bucket counts (last one is +Inf), sum]
+
+    def observe(self, value: float, labels: tuple = ()):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def dump(self):
+        return [[list(labels), counts, total] for labels, (counts, total) in self.series.items()]
+
+    def merge(self, snapshots: List["Snapshot"]):
+        series = {}
+        for snapshot in snapshots:
+            for labels, counts, total in snapshot.samples.get(self.name, []):
+                merged = series.setdefault(tuple(labels), [[0] * (len(self.buckets) + 1), 0.0])
+                merged[0] = [a + b for a, b in zip(merged[0], counts)]
+                merged[1] += total
+        return series
+
+    def render(self, series: Optional[dict] = None):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        bucket_names = self.label_names + ("le",)
+        for labels, (counts, total) in (self.series if series is None else series).items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                yield f"{self.name}_bucket{format_labels(bucket_names, labels + (str(bound),))} {cumulative}"
+            yield f"{self.name}_sum{format_labels(self.label_names, labels)} {total}"
+            yield f"{self.name}_count{format_labels(self.label_names, labels)} {cumulative}"
+
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in zip(names, values)) + "}"
+
+
+http_requests = Counter("http_requests_total", "HTTP requests by route and status.", ("method", "route", "status"))
+http_request_duration = Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route.", ("method", "route")
+)
+http_requests_in_flight = Gauge("http_requests_in_flight", "HTTP requests being served.")
+db_query_duration = Histogram(
+    "db_query_duration_seconds", "Latency of database.py functions.", ("function",)
+)
+db_query_rows = Counter("db_query_rows_total", "Rows returned by database.py functions.", ("function",))
+db_query_errors = Counter("db_query_errors_total", "database.py calls that raised.", ("function",))
+db_slow_queries = Counter("db_slow_queries_total", "database.py calls over SLOW_QUERY_MS.", ("function",))
+db_pool_acquire_duration = Histogram(
+    "db_pool_acquire_duration_seconds", "Time spent waiting for a pooled connection.", ("pool",)
+)
+db_pool_connections = Gauge("db_pool_connections", "Open pooled connections.", ("pool", "state"))
+app_ready = Gauge(
+    "app_ready", "1 while the process accepts traffic, 0 while starting or draining.", multiprocess="liveall"
+)
+app_startup_seconds = Gauge(
+    "app_startup_seconds", "Time spent connecting and warming up before serving.", multiprocess="liveall"
+)
+availability_subscribers = Gauge(
+    "availability_subscribers", "Open live availability streams.", ("transport",)
+)
+availability_notifications = Counter(
+    "availability_notifications_total", "Availability notifications received from Postgres."
+)
+availability_overflows = Counter(
+    "availability_overflows_total", "Availability subscribers that fell behind and were sent a reset."
+)
+db_reads_coalesced = Counter(
+    "db_reads_coalesced_total", "Reads answered from another caller's load instead of the database.", ("source", "kind")
+)
+
+REGISTRY = [
+    http_requests, http_request_duration, http_requests_in_flight,
+    db_query_duration, db_query_rows, db_query_errors, db_slow_queries,
+    db_pool_acquire_duration, db_pool_connections, db_reads_coalesced,
+    app_ready, app_startup_seconds,
+    availability_subscribers, availability_notifications, availability_overflows,
+]
+
+# Called just before rendering to refresh gauges that are sampled rather than tracked
+collectors = {}  # name -> callable
+
+
+def render_metrics() -> str:
+    lines = []
+    if METRICS_DIR is None:
+        for collect in collectors.values():
+            collect()
+        for metric in REGISTRY:
+            lines.extend(metric.render())
+    else:
+        # This worker's own snapshot is written first, so what it reports never runs ahead of its file
+        write_snapshot(take_snapshot())
+        snapshots = read_snapshots()
+        for metric in REGISTRY:
+            lines.extend(metric.render(metric.merge(snapshots)))
+    return "\n".join(lines) + "\n"
+
+
+# -------------------- WORKER SNAPSHOTS --------------------
+
+class Snapshot:
+    __slots__ = ("pid", "alive", "samples")
+
+    def __init__(self, pid: int, alive: bool, samples: dict):
+        self.pid = pid
+        self.alive = alive
+        self.samples = samples  # metric name -> dumped samples
+
+
+def process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# Serialize the samples of this process; runs on the event loop, which is the only writer
+def take_snapshot() -> bytes:
+    for collect in collectors.values():
+        collect()
+    return json.dumps({metric.name: metric.dump() for metric in REGISTRY}).encode()
+
+
+def write_snapshot(data: bytes):
+    path = os.path.join(METRICS_DIR, f"{os.getpid()}.json")
+    # Written under a temporary name and renamed, so readers never see half a snapshot
+    temporary = f"{path}.tmp"
+    with open(temporary, "wb") as output:
+        output.write(data)
+    os.replace(temporary, path)
+
+
+def read_snapshots() -> List[Snapshot]:
+    snapshots = []
+    for filename in os.listdir(METRICS_DIR):
+        if not filename.endswith(".json"):
+            continue
+        pid = int(filename.removesuffix(".json"))
+        try:
+            with open(os.path.join(METRICS_DIR, filename), "rb") as snapshot_file:
+                samples = json.load(snapshot_file)
+        except (OSError, ValueError):
+            continue
+        snapshots.append(Snapshot(pid, process_alive(pid), samples))
+    return snapshots
+
+
+# Write this worker's snapshot to METRICS_DIR; run periodically and once more on shutdown
+async def flush_metrics():
+    if METRICS_DIR is not None:
+        await asyncio.to_thread(write_snapshot, take_snapshot())
+
+
+# -------------------- REQUESTS --------------------
+
+# Route template of a request, including the prefix it was included or mounted under (/api/books/{book_id})
+# The router stores the matched route in the scope, but its path leaves that prefix out, so the prefix is
+# taken from the request path: everything before the segments the template itself matched
+# Unmatched paths share one label
+def route_label(scope) -> str:
+    route_path = getattr(scope.get("route"), "path", None)
+    if not route_path:
+        return "unmatched"
+    if ":path}" in route_path:
+        # A path parameter can span any number of segments, so only the mount prefix is known
+        return scope.get("root_path", "") + route_path
+    segments = scope["path"].split("/")
+    prefix_length = len(segments) - len(route_path.split("/"))
+    if prefix_length <= 0:
+        return route_path
+    return "/".join(segments[:prefix_length + 1]) + route_path
+
+
+class RequestMetricsMiddleware:
+    """ASGI middleware recording latency, status and in-flight count per route template."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        http_requests_in_flight.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            http_requests_in_flight.dec()
+            route_name = route_label(scope)
+            method = scope["method"]
+            http_request_duration.observe(elapsed, (method, route_name))
+            http_requests.inc((method, route_name, str(status)))
+
+
+# -------------------- QUERIES --------------------
+
+# Describe call arguments by name and type only, so no user data reaches the log
+def redact_arguments(signature: inspect.Signature, args: tuple, kwargs: dict) -> str:
+    try:
+        bound = signature.bind(*args, **kwargs)
+    except TypeError:
+        return "..."
+    return ", ".join(f"{name}=<{type(value).__name__}>" for name, value in bound.arguments.items())
+
+
+def count_rows(result) -> int:
+    if result is None:
+        return 0
+    if isinstance(result, list):
+        return len(result)
+    return 1
+
+
+def record_query(name: str, elapsed: float, rows: int, signature: inspect.Signature, args: tuple, kwargs: dict):
+    db_query_duration.observe(elapsed, (name,))
+    if rows:
+        db_query_rows.inc((name,), rows)
+    if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS:
+        db_slow_queries.inc((name,))
+        slow_query_logger.warning(
+            "slow query %s(%s) took %.1f ms", name, redact_arguments(signature, args, kwargs), elapsed * 1000
+        )
+
+
+def timed_query(function: Callable):
+    name = function.__name__
+    signature = inspect.signature(function)
+
+    if inspect.isasyncgenfunction(function):
+        # Streaming readers are timed from the first row requested to the last one consumed
+        @functools.wraps(function)
+        async def timed_generator(*args, **kwargs):
+            started = time.perf_counter()
+            rows = 0
+            try:
+                async for row in function(*args, **kwargs):
+                    rows += 1
+                    yield row
+            except Exception:
+                db_query_errors.inc((name,))
+                raise
+            finally:
+                record_query(name, time.perf_counter() - started, rows, signature, args, kwargs)
+        return timed_generator
+
+    @functools.wraps(function)
+    async def timed(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            result = await function(*args, **kwargs)
+        except Exception:
+            db_query_errors.inc((name,))
+            record_query(name, time.perf_counter() - started, 0, signature, args, kwargs)
+            raise
+        record_query(name, time.perf_counter() - started, count_rows(result), signature, args, kwargs)
+        return result
+    return timed
+
+
+# Wrap every coroutine and async generator function defined in a module's namespace
+def instrument_module(namespace: dict):
+    module_name = namespace["__name__"]
+    for name, value in list(namespace.items()):
+        if name.startswith("_") or getattr(value, "__module__", None) != module_name:
+            continue
+        if inspect.iscoroutinefunction(value) or inspect.isasyncgenfunction(value):
+            namespace[name] = timed_query(value)
+
+
+# -------------------- POOL --------------------
+
+class TimedPool:
+    """Proxy for an asyncpg pool that times how long acquire() waits for a connection."""
+
+    def __init__(self, pool, label: str):
+        self._pool = pool
+        self._label = (label,)
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+    async def acquire(self, *, timeout=None):
+        started = time.perf_counter()
+        try:
+            return await self._pool.acquire(timeout=timeout)
+        finally:
+            db_pool_acquire_duration.observe(time.perf_counter() - started, self._label)
+
+
+# Time connection checkouts of a connected databases.Database and sample its pool size on scrape
+def instrument_pool(database, label: str):
+    # databases keeps the asyncpg pool on its backend; skip quietly for other backends
+    backend = getattr(database, "_backend", None)
+    pool = getattr(backend, "_pool", None)
+    if pool is None or not hasattr(pool, "get_size"):
+        return
+    if not isinstance(pool, TimedPool):
+        backend._pool = TimedPool(pool, label)
+
+    def collect():
+        current = backend._pool
+        if current is None:
+            return
+        idle = current.get_idle_size()
+        db_pool_connections.set(idle, (label, "idle"))
+        db_pool_connections.set(current.get_size() - idle, (label, "in_use"))
+
+    collectors[f"pool:{label}"] = collect
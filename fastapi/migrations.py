@@ -0,0 +1,512 @@
+"""Versioned schema migrations.
+
+Migrations are applied in version order and each applied version is recorded
+in schema_migrations, so every one runs exactly once per database. The base
+schema uses IF NOT EXISTS throughout, so databases created before migrations
+existed are adopted without changes. Several app instances may start at once;
+an advisory lock lets only one of them migrate. The others poll for the lock
+with pg_try_advisory_lock instead of blocking in pg_advisory_lock: a session
+blocked on the lock is running a statement, and CREATE INDEX CONCURRENTLY in
+the lock holder would wait for that statement to finish, so neither could go on.
+
+Index migrations build their indexes with CREATE INDEX CONCURRENTLY, outside a
+transaction, so reads and writes continue while they run.
+"""
+from typing import Dict, List, Optional
+import asyncio
+import logging
+
+logger = logging.getLogger("uvicorn.error")
+
+# Arbitrary key for pg_advisory_lock, shared by every instance of the app
+MIGRATION_LOCK_ID = 727501
+# Seconds between attempts to take the migration lock while another instance holds it
+MIGRATION_LOCK_POLL_SECONDS = 0.5
+
+# Tables whose changes are counted in table_version_stripes, with the key column that picks the stripe
+VERSIONED_TABLES = {"books": "book_id", "genre": "genre_id", "users": "user_id"}
+
+# Counters per versioned table; writes to rows in different stripes never wait on each other
+TABLE_VERSION_STRIPES = 64
+
+# users.role_id of ordinary members and of admins, who may open the dashboard and management pages
+MEMBER_ROLE_ID = 1
+ADMIN_ROLE_ID = 2
+
+# Days a borrow may be kept before it is overdue
+LOAN_PERIOD_DAYS = 14
+
+# NOTIFY channel carrying changes to the stock of books
+AVAILABILITY_CHANNEL = "book_availability"
+
+# Statements changing more books than this send a reset instead of the changes, keeping the
+# payload under the 8000 byte NOTIFY limit
+AVAILABILITY_NOTIFY_MAX_ROWS = 200
+
+# NOTIFY channel carrying the name of a catalog table (books or genre) whose listed fields changed
+CATALOG_CHANNEL = "catalog_changes"
+
+
+class Migration:
+    def __init__(self, version: int, name: str, statements: List[str]):
+        self.version = version
+        self.name = name
+        self.statements = statements
+
+    # Run the statements and record the version in one transaction
+    async def apply(self, connection):
+        async with connection.transaction():
+            for statement in self.statements:
+                await connection.execute(statement)
+            await record_version(connection, self)
+
+
+class IndexMigration(Migration):
+    """Builds indexes concurrently; indexes maps each index name to its ON clause."""
+
+    def __init__(self, version: int, name: str, indexes: Dict[str, str]):
+        super().__init__(version, name, [
+            f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {index} ON {definition}" for index, definition in indexes.items()
+        ])
+        self.indexes = indexes
+
+    async def apply(self, connection):
+        # An interrupted concurrent build leaves an invalid index behind, which IF NOT EXISTS would keep
+        for index in self.indexes:
+            invalid = await connection.fetchval("""
+            SELECT NOT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+            WHERE c.relname = $1
+            """, index)
+            if invalid:
+                await connection.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {index}")
+        for statement in self.statements:
+            await connection.execute(statement)
+        await record_version(connection, self)
+
+
+MIGRATIONS = [
+    Migration(1, "base schema", [
+        """
+        CREATE TABLE IF NOT EXISTS genre (
+            genre_id SERIAL PRIMARY KEY,
+            genre_name TEXT NOT NULL,
+            genre_description TEXT
+        )
+        """,
+        f"""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id SERIAL PRIMARY KEY,
+            username TEXT NOT NULL,
+            password_hash TEXT NOT NULL,
+            email TEXT NOT NULL,
+            role_id INTEGER NOT NULL DEFAULT {MEMBER_ROLE_ID},
+            created_at TIMESTAMP NOT NULL DEFAULT now()
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS books (
+            book_id SERIAL PRIMARY KEY,
+            book_name TEXT NOT NULL,
+            book_quantity INTEGER NOT NULL DEFAULT 0,
+            available_quantity INTEGER NOT NULL DEFAULT 0,
+            book_description TEXT,
+            book_pic TEXT,
+            genre_id INTEGER REFERENCES genre (genre_id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS borrow (
+            borrow_id SERIAL PRIMARY KEY,
+            user_id INTEGER NOT NULL REFERENCES users (user_id),
+            book_id INTEGER NOT NULL REFERENCES books (book_id),
+            borrow_quantity INTEGER NOT NULL,
+            borrow_date TIMESTAMP NOT NULL DEFAULT now(),
+            return_date TIMESTAMP
+        )
+        """,
+    ]),
+    # Per-table change counters, bumped by a statement-level trigger on every write to a versioned table
+    # so conditional GETs can be answered without reading the rows themselves
+    Migration(2, "table versions", [
+        """
+        CREATE TABLE IF NOT EXISTS table_versions (
+            table_name TEXT PRIMARY KEY,
+            version BIGINT NOT NULL DEFAULT 0,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        """,
+        """
+        CREATE OR REPLACE FUNCTION bump_table_version() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO table_versions (table_name, version, updated_at)
+            VALUES (TG_TABLE_NAME, 1, now())
+            ON CONFLICT (table_name) DO UPDATE
+            SET version = table_versions.version + 1, updated_at = now();
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """,
+    ] + [
+        statement
+        for table in VERSIONED_TABLES
+        for statement in (
+            f"DROP TRIGGER IF EXISTS {table}_bump_version ON {table}",
+            f"""
+            CREATE TRIGGER {table}_bump_version
+            AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+            FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version()
+            """,
+        )
+    ]),
+    # Daily borrow totals, kept up to date by every statement that inserts or deletes borrows
+    Migration(3, "daily borrow rollup", [
+        """
+        CREATE TABLE IF NOT EXISTS borrow_daily_stats (
+            day DATE PRIMARY KEY,
+            borrow_count INTEGER NOT NULL DEFAULT 0,
+            borrow_quantity INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        # Fill in days that are not in the rollup yet; days already tracked are left alone
+        """
+        INSERT INTO borrow_daily_stats (day, borrow_count, borrow_quantity)
+        SELECT CAST(borrow_date AS date), COUNT(*), SUM(borrow_quantity)
+        FROM borrow
+        GROUP BY CAST(borrow_date AS date)
+        ON CONFLICT (day) DO NOTHING
+        """,
+    ]),
+    # Progress of resumable maintenance jobs, keyed by job name
+    Migration(4, "maintenance checkpoints", [
+        """
+        CREATE TABLE IF NOT EXISTS maintenance_checkpoints (
+            name TEXT PRIMARY KEY,
+            last_id BIGINT NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        """,
+    ]),
+    # Indexes behind login, the per-user and per-book borrow lists, the borrow date filters and the
+    # genre filter; the trailing id columns match the keyset order of the paginated lists
+    IndexMigration(5, "hot query indexes", {
+        # Not unique, so databases that already hold duplicate emails can still be migrated
+        "users_email_idx": "users (email)",
+        "borrow_user_id_idx": "borrow (user_id, borrow_id)",
+        "borrow_book_id_idx": "borrow (book_id, borrow_id)",
+        "borrow_borrow_date_idx": "borrow (borrow_date)",
+        "books_genre_id_idx": "books (genre_id, book_id)",
+    }),
+    # Borrows are due LOAN_PERIOD_DAYS after they are made. Returned borrows are never overdue,
+    # so only open ones get a due date here. Per-user overdue counts are filled in by a background task.
+    Migration(6, "borrow due dates", [
+        "ALTER TABLE borrow ADD COLUMN IF NOT EXISTS due_date TIMESTAMP",
+        f"ALTER TABLE borrow ALTER COLUMN due_date SET DEFAULT LOCALTIMESTAMP + INTERVAL '{LOAN_PERIOD_DAYS} days'",
+        f"""
+        UPDATE borrow SET due_date = borrow_date + INTERVAL '{LOAN_PERIOD_DAYS} days'
+        WHERE due_date IS NULL AND return_date IS NULL
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS user_overdue_counts (
+            user_id INTEGER PRIMARY KEY,
+            overdue_count INTEGER NOT NULL,
+            oldest_due_date TIMESTAMP NOT NULL,
+            refreshed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        """,
+    ]),
+    # Open borrows in due-date order; stays small however much returned history piles up
+    IndexMigration(7, "overdue borrows index", {
+        "borrow_overdue_idx": "borrow (due_date, borrow_id) WHERE return_date IS NULL",
+    }),
+    # Per-book borrow counters for the most-borrowed leaderboards, kept up to date by the same
+    # statements as the daily rollup: daily counts for the windowed boards and lifetime totals
+    Migration(8, "per-book borrow counters", [
+        """
+        CREATE TABLE IF NOT EXISTS book_borrow_daily (
+            day DATE NOT NULL,
+            book_id INTEGER NOT NULL,
+            borrow_count INTEGER NOT NULL DEFAULT 0,
+            borrow_quantity INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, book_id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS book_borrow_totals (
+            book_id INTEGER PRIMARY KEY,
+            borrow_count BIGINT NOT NULL DEFAULT 0,
+            borrow_quantity BIGINT NOT NULL DEFAULT 0
+        )
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS book_borrow_totals_rank_idx
+        ON book_borrow_totals (borrow_count DESC, borrow_quantity DESC, book_id)
+        """,
+        """
+        INSERT INTO book_borrow_daily (day, book_id, borrow_count, borrow_quantity)
+        SELECT CAST(borrow_date AS date), book_id, COUNT(*), SUM(borrow_quantity)
+        FROM borrow
+        GROUP BY CAST(borrow_date AS date), book_id
+        ON CONFLICT (day, book_id) DO NOTHING
+        """,
+        """
+        INSERT INTO book_borrow_totals (book_id, borrow_count, borrow_quantity)
+        SELECT book_id, COUNT(*), SUM(borrow_quantity)
+        FROM borrow
+        GROUP BY book_id
+        ON CONFLICT (book_id) DO NOTHING
+        """,
+    ]),
+    # Per-user borrow counters, kept up to date by every statement that creates, returns or deletes borrows,
+    # so the users-with-borrow-count report is sorted and paged from an index instead of aggregating borrow
+    Migration(9, "per-user borrow counters", [
+        """
+        CREATE TABLE IF NOT EXISTS user_borrow_counts (
+            user_id INTEGER PRIMARY KEY REFERENCES users (user_id) ON DELETE CASCADE,
+            active_borrows INTEGER NOT NULL DEFAULT 0,
+            lifetime_borrows INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        """
+        INSERT INTO user_borrow_counts (user_id, active_borrows, lifetime_borrows)
+        SELECT u.user_id, COUNT(b.borrow_id) FILTER (WHERE b.return_date IS NULL), COUNT(b.borrow_id)
+        FROM users u
+        LEFT JOIN borrow b ON b.user_id = u.user_id
+        GROUP BY u.user_id
+        ON CONFLICT (user_id) DO NOTHING
+        """,
+        "CREATE INDEX IF NOT EXISTS user_borrow_counts_lifetime_idx ON user_borrow_counts (lifetime_borrows, user_id)",
+        "CREATE INDEX IF NOT EXISTS user_borrow_counts_active_idx ON user_borrow_counts (active_borrows, user_id)",
+    ]),
+    # Every statement that changes the stock of books, or deletes books, sends the new
+    # [book_id, available_quantity, book_quantity] of each changed book on AVAILABILITY_CHANNEL.
+    # Postgres delivers the notification to every listening app process when the transaction commits
+    Migration(10, "book availability notifications", [
+        f"""
+        CREATE OR REPLACE FUNCTION notify_book_availability() RETURNS trigger AS $$
+        DECLARE
+            changes INTEGER;
+            changed JSONB := '[]';
+            deleted JSONB := '[]';
+        BEGIN
+            IF TG_OP = 'UPDATE' THEN
+                SELECT COUNT(*) INTO changes
+                FROM new_rows n JOIN old_rows o ON o.book_id = n.book_id
+                WHERE n.available_quantity IS DISTINCT FROM o.available_quantity
+                    OR n.book_quantity IS DISTINCT FROM o.book_quantity;
+                IF changes BETWEEN 1 AND {AVAILABILITY_NOTIFY_MAX_ROWS} THEN
+                    SELECT jsonb_agg(jsonb_build_array(n.book_id, n.available_quantity, n.book_quantity)) INTO changed
+                    FROM new_rows n JOIN old_rows o ON o.book_id = n.book_id
+                    WHERE n.available_quantity IS DISTINCT FROM o.available_quantity
+                        OR n.book_quantity IS DISTINCT FROM o.book_quantity;
+                END IF;
+            ELSIF TG_OP = 'DELETE' THEN
+                SELECT COUNT(*) INTO changes FROM old_rows;
+                IF changes BETWEEN 1 AND {AVAILABILITY_NOTIFY_MAX_ROWS} THEN
+                    SELECT jsonb_agg(book_id) INTO deleted FROM old_rows;
+                END IF;
+            END IF;
+
+            IF changes = 0 THEN
+                RETURN NULL;
+            ELSIF changes IS NULL OR changes > {AVAILABILITY_NOTIFY_MAX_ROWS} THEN
+                -- Truncated or changed in bulk: listeners reload instead
+                PERFORM pg_notify('{AVAILABILITY_CHANNEL}', '{{"type": "reset"}}');
+            ELSE
+                PERFORM pg_notify('{AVAILABILITY_CHANNEL}', CAST(
+                    jsonb_build_object('type', 'availability', 'books', changed, 'deleted', deleted) AS text
+                ));
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """,
+        "DROP TRIGGER IF EXISTS books_notify_availability_update ON books",
+        """
+        CREATE TRIGGER books_notify_availability_update
+        AFTER UPDATE ON books REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_book_availability()
+        """,
+        "DROP TRIGGER IF EXISTS books_notify_availability_delete ON books",
+        """
+        CREATE TRIGGER books_notify_availability_delete
+        AFTER DELETE ON books REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_book_availability()
+        """,
+        "DROP TRIGGER IF EXISTS books_notify_availability_truncate ON books",
+        """
+        CREATE TRIGGER books_notify_availability_truncate
+        AFTER TRUNCATE ON books
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_book_availability()
+        """,
+    ]),
+    # Key of the stored cover image of each book; its variants are named <cover_key>-<variant>.<ext>
+    Migration(11, "book cover keys", [
+        "ALTER TABLE books ADD COLUMN IF NOT EXISTS cover_key TEXT",
+    ]),
+    # Role of each user, returned on login and checked by the frontend before it opens admin pages;
+    # databases whose users table predates the base schema may lack it
+    Migration(12, "user roles", [
+        f"ALTER TABLE users ADD COLUMN IF NOT EXISTS role_id INTEGER NOT NULL DEFAULT {MEMBER_ROLE_ID}",
+    ]),
+    # Statements that add, remove or edit books or genres, other than their stock, send the table name on
+    # CATALOG_CHANNEL, so every app process can drop its cached catalog; stock changes already go out on
+    # AVAILABILITY_CHANNEL. Identical notifications of one transaction are delivered once
+    Migration(13, "catalog change notifications", [
+        f"""
+        CREATE OR REPLACE FUNCTION notify_catalog_change() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('{CATALOG_CHANNEL}', TG_TABLE_NAME);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """,
+        "DROP TRIGGER IF EXISTS books_notify_catalog ON books",
+        """
+        CREATE TRIGGER books_notify_catalog
+        AFTER INSERT OR DELETE OR TRUNCATE OR UPDATE OF book_name, book_description, book_pic, genre_id, cover_key
+        ON books
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_catalog_change()
+        """,
+        "DROP TRIGGER IF EXISTS genre_notify_catalog ON genre",
+        """
+        CREATE TRIGGER genre_notify_catalog
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON genre
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_catalog_change()
+        """,
+    ]),
+    # The table versions of migration 2 become TABLE_VERSION_STRIPES counters per table, picked by the key of
+    # each changed row, and a table's version is the sum of its counters. Every borrow and return used to
+    # update the single books row of table_versions, which made them all wait on each other; now only writes
+    # to books in the same stripe do. Statements that change no rows no longer bump anything
+    Migration(14, "striped table versions", [
+        """
+        CREATE TABLE IF NOT EXISTS table_version_stripes (
+            table_name TEXT NOT NULL,
+            stripe INTEGER NOT NULL,
+            version BIGINT NOT NULL DEFAULT 0,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            PRIMARY KEY (table_name, stripe)
+        )
+        """,
+        # Carried over into stripe 0, so versions keep growing and old ETags are never reused
+        """
+        INSERT INTO table_version_stripes (table_name, stripe, version, updated_at)
+        SELECT table_name, 0, version, updated_at FROM table_versions
+        ON CONFLICT (table_name, stripe) DO NOTHING
+        """,
+        f"""
+        CREATE OR REPLACE FUNCTION bump_table_version_stripes() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'TRUNCATE' THEN
+                INSERT INTO table_version_stripes (table_name, stripe, version, updated_at)
+                SELECT TG_TABLE_NAME, stripe, 1, now() FROM generate_series(0, {TABLE_VERSION_STRIPES - 1}) AS s(stripe)
+                ON CONFLICT (table_name, stripe) DO UPDATE
+                SET version = table_version_stripes.version + 1, updated_at = now();
+            ELSE
+                -- TG_ARGV[0] is the key column; stripes are bumped in order so concurrent statements cannot deadlock
+                EXECUTE format(
+                    'INSERT INTO table_version_stripes (table_name, stripe, version, updated_at)
+                    SELECT $1, stripe, 1, now() FROM (SELECT DISTINCT %I %% $2 AS stripe FROM %I) s
+                    ORDER BY stripe
+                    ON CONFLICT (table_name, stripe) DO UPDATE
+                    SET version = table_version_stripes.version + 1, updated_at = now()',
+                    TG_ARGV[0], CASE WHEN TG_OP = 'DELETE' THEN 'old_rows' ELSE 'new_rows' END
+                ) USING TG_TABLE_NAME, {TABLE_VERSION_STRIPES};
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """,
+    ] + [
+        statement
+        for table, key in VERSIONED_TABLES.items()
+        for statement in (
+            f"DROP TRIGGER IF EXISTS {table}_bump_version ON {table}",
+            # Transition tables need one trigger per event
+            f"DROP TRIGGER IF EXISTS {table}_bump_version_insert ON {table}",
+            f"""
+            CREATE TRIGGER {table}_bump_version_insert
+            AFTER INSERT ON {table} REFERENCING NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version_stripes('{key}')
+            """,
+            f"DROP TRIGGER IF EXISTS {table}_bump_version_update ON {table}",
+            f"""
+            CREATE TRIGGER {table}_bump_version_update
+            AFTER UPDATE ON {table} REFERENCING NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version_stripes('{key}')
+            """,
+            f"DROP TRIGGER IF EXISTS {table}_bump_version_delete ON {table}",
+            f"""
+            CREATE TRIGGER {table}_bump_version_delete
+            AFTER DELETE ON {table} REFERENCING OLD TABLE AS old_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version_stripes('{key}')
+            """,
+            f"DROP TRIGGER IF EXISTS {table}_bump_version_truncate ON {table}",
+            f"""
+            CREATE TRIGGER {table}_bump_version_truncate
+            AFTER TRUNCATE ON {table}
+            FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version_stripes('{key}')
+            """,
+        )
+    ] + [
+        "DROP FUNCTION IF EXISTS bump_table_version()",
+        "DROP TABLE IF EXISTS table_versions",
+    ]),
+]
+
+
+async def record_version(connection, migration: Migration):
+    await connection.execute(
+        "INSERT INTO schema_migrations (version, name) VALUES ($1, $2)", migration.version, migration.name
+    )
+
+
+async def get_applied_versions(connection):
+    await connection.execute("""
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    )
+    """)
+    return {row["version"] for row in await connection.fetch("SELECT version FROM schema_migrations")}
+
+
+# Take the migration lock, polling between attempts so no statement is left waiting on it
+async def acquire_migration_lock(connection):
+    waiting = False
+    while not await connection.fetchval("SELECT pg_try_advisory_lock($1)", MIGRATION_LOCK_ID):
+        if not waiting:
+            logger.info("Waiting for another instance to finish migrating")
+            waiting = True
+        await asyncio.sleep(MIGRATION_LOCK_POLL_SECONDS)
+
+
+# Apply every migration up to target (all by default) that has not run yet and return the applied ones
+async def migrate(database, target: Optional[int] = None):
+    applied = []
+    async with database.connection() as db_connection:
+        # DDL is sent to asyncpg as written, without the bind-parameter parsing of databases
+        connection = db_connection.raw_connection
+        await acquire_migration_lock(connection)
+        try:
+            # Index builds on large tables can take far longer than the API's statement timeout
+            await connection.execute("SET statement_timeout = 0")
+            done = await get_applied_versions(connection)
+            for migration in sorted(MIGRATIONS, key=lambda m: m.version):
+                if migration.version in done or (target is not None and migration.version > target):
+                    continue
+                logger.info(f"Applying migration {migration.version}: {migration.name}")
+                await migration.apply(connection)
+                applied.append(migration)
+        finally:
+            await connection.execute("RESET statement_timeout")
+            await connection.execute("SELECT pg_advisory_unlock($1)", MIGRATION_LOCK_ID)
+    return applied
+
+
+# List (version, name, applied) for every known migration
+async def migration_status(database):
+    async with database.connection() as db_connection:
+        done = await get_applied_versions(db_connection.raw_connection)
+    return [(m.version, m.name, m.version in done) for m in sorted(MIGRATIONS, key=lambda m: m.version)]
@@ -0,0 +1,39 @@
+"""Prepared statements run directly on asyncpg.
+
+The ``databases`` library compiles every query through SQLAlchemy and wraps
+each row in its own Record type. For the hottest lookups that overhead is
+measurable, so those statements are registered once here, with positional
+``$n`` parameters, and run on the pool's underlying asyncpg connection.
+asyncpg prepares a statement the first time it runs on a connection and keeps
+it in that connection's statement cache, so each pooled connection prepares
+each statement only once. Rows come back as asyncpg's lightweight Records.
+"""
+from databases import Database
+from typing import Dict
+
+
+class PreparedStatement:
+    # Every registered statement, by name
+    registry: Dict[str, "PreparedStatement"] = {}
+
+    def __init__(self, name: str, sql: str):
+        if name in PreparedStatement.registry:
+            raise ValueError(f"Statement {name} is already registered")
+        self.name = name
+        self.sql = sql
+        PreparedStatement.registry[name] = self
+
+    async def fetchrow(self, database: Database, *args):
+        async with database.connection() as connection:
+            return await connection.raw_connection.fetchrow(self.sql, *args)
+
+    async def fetch(self, database: Database, *args):
+        async with database.connection() as connection:
+            return await connection.raw_connection.fetch(self.sql, *args)
+
+
+# Prepare every registered statement on one connection, so errors surface at startup
+async def warm_up_statements(database: Database):
+    async with database.connection() as connection:
+        for statement in PreparedStatement.registry.values():
+            await connection.raw_connection.prepare(statement.sql)
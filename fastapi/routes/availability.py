@@ -0,0 +1,69 @@
+from fastapi import APIRouter, HTTPException, WebSocket
+from fastapi.responses import StreamingResponse
+import asyncio
+from availability import CLOSE, broadcaster
+from metrics import availability_subscribers
+
+router = APIRouter()
+
+# Clients reconnect after this many milliseconds when the stream drops
+SSE_RETRY_MS = 3000
+
+
+# Endpoint streaming book availability changes as Server-Sent Events
+# Each event is {"type": "availability", "books": [[book_id, available_quantity, book_quantity], ...], "deleted": [book_id, ...]}
+# or {"type": "reset"} when changes may have been missed and the book list should be fetched again
+@router.get("/availability/stream")
+async def stream_availability():
+    if not broadcaster.is_accepting():
+        raise HTTPException(status_code=503, detail="Not accepting availability subscribers")
+
+    # Subscribed only once streaming starts, so the generator's cleanup always runs
+    async def events():
+        subscriber = broadcaster.subscribe()
+        availability_subscribers.inc(("sse",))
+        try:
+            yield f"retry: {SSE_RETRY_MS}\n\n".encode()
+            while True:
+                # Everything queued since the last write goes out in one chunk
+                messages = await subscriber.receive()
+                yield b"".join(message.frame for message in messages)
+                if any(message is CLOSE for message in messages):
+                    return
+        finally:
+            availability_subscribers.dec(("sse",))
+            broadcaster.unsubscribe(subscriber)
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return StreamingResponse(events(), media_type="text/event-stream", headers=headers)
+
+
+# WebSocket carrying the same messages as /availability/stream, one JSON text frame each
+@router.websocket("/availability/ws")
+async def availability_websocket(websocket: WebSocket):
+    if not broadcaster.is_accepting():
+        # 1013: try again later
+        await websocket.close(code=1013)
+        return
+    await websocket.accept()
+    subscriber = broadcaster.subscribe()
+    availability_subscribers.inc(("websocket",))
+
+    async def send_messages():
+        while True:
+            for message in await subscriber.receive():
+                if message is CLOSE:
+                    await websocket.close(code=1012)  # service restart
+                    return
+                if message.data is not None:
+                    await websocket.send_text(message.data)
+
+    sender = asyncio.create_task(send_messages())
+    try:
+        # Clients send nothing; anything they do send is ignored until they disconnect
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
+    finally:
+        sender.cancel()
+        availability_subscribers.dec(("websocket",))
+        broadcaster.unsubscribe(subscriber)
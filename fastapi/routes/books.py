@@ -1,8 +1,12 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, File, HTTPException, Query, Request, Response, UploadFile
 from pydantic import BaseModel
 from typing import Optional, List
 from database import *
 from datetime import datetime
+from catalog_import import detect_format, import_books
+from http_cache import CATALOG_CACHE_CONTROL, conditional_headers
+from fast_json import FAST_JSON_RESPONSES, fast_list_response
+from covers import cover_exists
 
 router = APIRouter()
 
@@ -13,6 +17,7 @@ class BookCreate(BaseModel):
     book_description: Optional[str]
     book_pic: Optional[str]
     genre_id: Optional[int]  # New field for genre
+    cover_key: Optional[str] = None  # Key returned by POST /covers
 
 # Pydantic model for book update
 class BookUpdate(BaseModel):
@@ -22,6 +27,7 @@ class BookUpdate(BaseModel):
     book_description: Optional[str]
     book_pic: Optional[str]
     genre_id: Optional[int]  # New field for genre
+    cover_key: Optional[str] = None  # Key returned by POST /covers; the current cover is kept when omitted
 
 # Pydantic model for book response
 class Book(BaseModel):
@@ -33,15 +39,36 @@ class Book(BaseModel):
     book_pic: Optional[str]
     genre_id: Optional[int]  # New field for genre
     genre_name: Optional[str]  # To display the genre name
+    cover_key: Optional[str] = None  # Covers are served at /api/covers/<cover_key>-<variant>.<ext>
+
+# Pydantic model for one entry of the most-borrowed leaderboard
+class MostBorrowedBook(BaseModel):
+    book_id: int
+    book_name: str
+    borrow_count: int
+    borrow_quantity: int
 
 # Endpoint to create a new book
 @router.post("/books/create", response_model=BookCreate)
 async def create_book(book: BookCreate):
-    result = await insert_book(book.book_name, book.book_quantity, book.book_description, book.book_pic, book.genre_id)
+    if book.cover_key is not None and not cover_exists(book.cover_key):
+        raise HTTPException(status_code=400, detail="Unknown cover_key")
+    result = await insert_book(book.book_name, book.book_quantity, book.book_description, book.book_pic, book.genre_id,
+                               book.cover_key)
     if result is None:
         raise HTTPException(status_code=400, detail="Error creating book")
     return result
 
+# Endpoint to bulk import books from a CSV or NDJSON upload
+# Rows that fail validation are reported back without aborting the import
+@router.post("/books/import")
+async def import_books_endpoint(
+    file: UploadFile = File(...),
+    format: Optional[str] = Query(None, pattern="^(csv|ndjson)$"),
+):
+    report = await import_books(file.file, format or detect_format(file.filename))
+    return report.as_dict()
+
 # Endpoint to get total unique books count
 @router.get("/books/unique_count")
 async def get_total_unique_books():
@@ -66,9 +93,22 @@ async def get_available_books():
         raise HTTPException(status_code=404, detail="No available books found")
     return {"available_books": available_books}
 
+# Endpoint to get the most borrowed books of the last 7 or 30 days, or of all time
+# Served from an in-memory leaderboard that is reloaded from the per-book counters in the background
+@router.get("/books/most-borrowed", response_model=List[MostBorrowedBook])
+async def get_most_borrowed(
+    window: str = Query("30d", pattern="^(7d|30d|all)$"),
+    limit: int = Query(10, ge=1, le=MOST_BORROWED_MAX_LIMIT),
+):
+    return await get_most_borrowed_books(window, limit)
+
 # Endpoint to get a book by book_id
 @router.get("/books/{book_id}", response_model=Book)
-async def read_book(book_id: int):
+async def read_book(book_id: int, request: Request, response: Response):
+    headers, not_modified = await conditional_headers(request, ["books", "genre"], CATALOG_CACHE_CONTROL)
+    if not_modified:
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
     result = await get_book(book_id)
     if result is None:
         raise HTTPException(status_code=404, detail="Book not found")
@@ -77,7 +117,10 @@ async def read_book(book_id: int):
 # Endpoint to update a book
 @router.put("/books/{book_id}", response_model=BookUpdate)
 async def update_book_endpoint(book_id: int, book: BookUpdate):
-    result = await update_book(book_id, book.book_name, book.book_quantity,book.available_quantity, book.book_description, book.book_pic, book.genre_id)
+    if book.cover_key is not None and not cover_exists(book.cover_key):
+        raise HTTPException(status_code=400, detail="Unknown cover_key")
+    result = await update_book(book_id, book.book_name, book.book_quantity,book.available_quantity, book.book_description, book.book_pic, book.genre_id,
+                               book.cover_key)
     if result is None:
         raise HTTPException(status_code=404, detail="Book not found")
     return result
@@ -91,12 +134,32 @@ async def delete_book_endpoint(book_id: int):
     return {"detail": "Book deleted"}
 
 
-# Endpoint to get all books
+# Endpoint to get books one keyset page at a time
+# The cursor for the next page is returned in the X-Next-Cursor header
 @router.get("/books", response_model=List[Book])
-async def get_all_books():
-    result = await get_all_books_from_db()
-    if not result:
+async def get_all_books(
+    request: Request,
+    response: Response,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    genre_id: Optional[int] = None,
+):
+    try:
+        after_id = decode_cursor(cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    headers, not_modified = await conditional_headers(request, ["books", "genre"], CATALOG_CACHE_CONTROL)
+    if not_modified:
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    rows = await get_all_books_from_db(limit + 1, after_id, genre_id)
+    if not rows and cursor is None:
         raise HTTPException(status_code=404, detail="No books found")
+    result, next_cursor = split_page(rows, limit, "book_id")
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    if FAST_JSON_RESPONSES:
+        return fast_list_response(result, Book, response)
     return result
 
 @router.get("/books/genres/count")
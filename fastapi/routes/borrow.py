@@ -1,8 +1,9 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Query, Response
 from pydantic import BaseModel
 from typing import Optional, List
-from datetime import datetime
+from datetime import date, datetime, timedelta
 from database import *
+from fast_json import FAST_JSON_RESPONSES, fast_list_response
 
 router = APIRouter()
 
@@ -16,6 +17,31 @@ class BorrowCreate(BaseModel):
 class BorrowUpdate(BaseModel):
     return_date: Optional[datetime]
 
+# Pydantic model for a batch of borrows
+class BulkBorrowCreate(BaseModel):
+    items: List[BorrowCreate]
+
+# Pydantic model for the result of one item of a bulk borrow
+class BulkBorrowResult(BaseModel):
+    user_id: int
+    book_id: int
+    borrow_quantity: int
+    status: str  # ok, insufficient_stock, not_found or invalid_quantity
+    borrow_id: Optional[int] = None
+    borrow_date: Optional[datetime] = None
+
+# Pydantic model for a batch of returns (return_date defaults to now)
+class BulkReturn(BaseModel):
+    borrow_ids: List[int]
+    return_date: Optional[datetime] = None
+
+# Pydantic model for the result of one item of a bulk return
+class BulkReturnResult(BaseModel):
+    borrow_id: int
+    status: str  # ok, already_returned, not_found or duplicate
+    book_id: Optional[int] = None
+    return_date: Optional[datetime] = None
+
 # Pydantic model for borrow response
 # class Borrow(BaseModel):
 #     borrow_id: int
@@ -34,6 +60,20 @@ class Borrow(BaseModel):
     borrow_quantity: int
     borrow_date: datetime
     return_date: Optional[datetime]
+    due_date: Optional[datetime] = None
+
+# Pydantic model for an open borrow past its due date
+class OverdueBorrow(Borrow):
+    days_overdue: int
+
+# Pydantic model for the overdue borrow count of one user
+class UserOverdueCount(BaseModel):
+    user_id: int
+    username: str
+    email: str
+    overdue_count: int
+    oldest_due_date: datetime
+    refreshed_at: datetime
 
 # Endpoint to create a new borrow (with current timestamp and no return date)
 # @router.post("/borrows/create", response_model=Borrow)
@@ -45,18 +85,34 @@ class Borrow(BaseModel):
 
 @router.post("/borrows/create", response_model=BorrowCreate)
 async def create_borrow(borrow: BorrowCreate):
-    # Check if enough books are available
-    book = await get_book(borrow.book_id)
-    if book['available_quantity'] >= borrow.borrow_quantity:
-        # Create borrow record
-        result = await insert_borrow(borrow.user_id, borrow.book_id, borrow.borrow_quantity)
-        # Update the available quantity of the book
-        await update_book_quantity_on_borrow(borrow.book_id, borrow.borrow_quantity)
-        if result is None:
-            raise HTTPException(status_code=400, detail="Error creating borrow")
-        return result
-    else:
+    # Rejected here as well as in the statement, matching invalid_quantity in bulk borrows
+    if borrow.borrow_quantity <= 0:
+        raise HTTPException(status_code=400, detail="Borrow quantity must be positive")
+    # Check the stock, decrement it and create the borrow record in one statement
+    result = await borrow_book(borrow.user_id, borrow.book_id, borrow.borrow_quantity)
+    if result is None:
+        if await get_book(borrow.book_id) is None:
+            raise HTTPException(status_code=404, detail="Book not found")
         raise HTTPException(status_code=400, detail="Not enough books available")
+    return result
+
+# Endpoint to borrow a batch of books in one transaction
+@router.post("/borrows/bulk", response_model=List[BulkBorrowResult])
+async def create_borrows_bulk(batch: BulkBorrowCreate):
+    if not batch.items:
+        raise HTTPException(status_code=400, detail="No items to borrow")
+    if len(batch.items) > MAX_BULK_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BULK_ITEMS} items per batch")
+    return await borrow_books_bulk([item.dict() for item in batch.items])
+
+# Endpoint to return a batch of borrows in one transaction
+@router.post("/borrows/bulk-return", response_model=List[BulkReturnResult])
+async def return_borrows_bulk_endpoint(batch: BulkReturn):
+    if not batch.borrow_ids:
+        raise HTTPException(status_code=400, detail="No borrows to return")
+    if len(batch.borrow_ids) > MAX_BULK_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BULK_ITEMS} items per batch")
+    return await return_borrows_bulk(batch.borrow_ids, batch.return_date)
 
 # Endpoint to get total borrows count
 @router.get("/borrows/count")
@@ -64,51 +120,90 @@ async def get_total_borrows():
     total_borrows = await get_total_borrows_from_db()
     return {"total_borrows": total_borrows}
 
-# Endpoint to get borrowing counts for each day of the week
+# Endpoint to get borrowing counts for each day of the last week
 @router.get("/borrows/weekly-stats")
 async def get_weekly_borrowing_stats():
+    weekly_borrowing = await get_weekly_borrowing_from_db()
+
+    # Bucket the last seven days by weekday; each weekday occurs exactly once
+    days_of_week = ["Sunday", "Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday"]
+    borrowing_stats = {day: 0 for day in days_of_week}
+    for entry in weekly_borrowing:
+        borrowing_stats[entry["period"].strftime("%A")] = entry["borrow_count"]
+
+    # Return structured data suitable for chart rendering
+    return {
+        "series": [{"label": "Books", "data": [borrowing_stats[day] for day in days_of_week]}],
+        "xAxis": {"data": days_of_week, "scaleType": "band"}
+    }
+
+# Endpoint to get borrowing counts per day, week or month over a date range
+# The range covers start <= day < end and defaults to the last 30 days
+@router.get("/borrows/stats")
+async def get_borrowing_stats(
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    granularity: str = Query("day", pattern="^(day|week|month)$"),
+):
+    end = end or date.today() + timedelta(days=1)
+    start = start or end - timedelta(days=30)
+    if start >= end:
+        raise HTTPException(status_code=400, detail="start must be before end")
+
+    stats = await get_borrow_stats_from_db(start, end, granularity)
+    return {
+        "series": [{"label": "Books", "data": [entry["borrow_count"] for entry in stats]}],
+        "xAxis": {"data": [entry["period"].isoformat() for entry in stats], "scaleType": "band"}
+    }
+
+# Endpoint to get open borrows past their due date one keyset page at a time
+# Sorted by how overdue they are; the cursor for the next page is returned in the X-Next-Cursor header
+@router.get("/borrows/overdue", response_model=List[OverdueBorrow])
+async def get_overdue_borrows(
+    response: Response,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    user_id: Optional[int] = None,
+    order: str = Query("most_overdue", pattern="^(most_overdue|least_overdue)$"),
+):
     try:
-        weekly_borrowing = await get_weekly_borrowing_from_db()
-        if not weekly_borrowing:
-            raise HTTPException(status_code=404, detail="No borrowing data found")
-
-        # Initialize a dictionary to hold borrow counts for each day
-        days_of_week = ["Sunday", "Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday"]
-        borrowing_stats = {day: 0 for day in days_of_week}
-
-        # Log the fetched data to verify it
-        print(f"Weekly borrowing data fetched: {weekly_borrowing}")
-
-        # Iterate over the results and sum borrowings for each day
-        for entry in weekly_borrowing:
-            borrow_day = entry["day_of_week"].strip()  # Strip to handle spaces
-            # Ensure proper casing and mapping
-            borrow_day = borrow_day.capitalize()
-            if borrow_day in borrowing_stats:
-                borrowing_stats[borrow_day] = entry["borrow_count"]
-
-        # Return structured data suitable for chart rendering
-        return {
-            "series": [{"label": "Books", "data": [borrowing_stats[day] for day in days_of_week]}],
-            "xAxis": {"data": days_of_week, "scaleType": "band"}
-        }
-    except Exception as e:
-        print(f"Error fetching weekly borrowing stats: {e}")
-        raise HTTPException(status_code=500, detail="Internal server error")
+        after = decode_timestamp_cursor(cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    rows = await get_overdue_borrows_from_db(limit + 1, after, user_id, order == "most_overdue")
+    result = rows[:limit]
+    if len(rows) > limit:
+        last = result[-1]
+        response.headers["X-Next-Cursor"] = encode_cursor([last["due_date"].isoformat(), last["borrow_id"]])
+    if FAST_JSON_RESPONSES:
+        return fast_list_response(result, OverdueBorrow, response)
+    return result
+
+# Endpoint to get the users with the most overdue borrows
+# The counts are recomputed periodically in the background, so they may lag by a minute or so
+@router.get("/borrows/overdue/users", response_model=List[UserOverdueCount])
+async def get_user_overdue_counts(limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)):
+    return await get_user_overdue_counts_from_db(limit)
 
 
 @router.put("/borrows/{borrow_id}", response_model=BorrowUpdate)
 async def update_borrow(borrow_id: int, borrow: BorrowUpdate):
-    # Update the return date
-    result = await update_borrow_return_date(borrow_id, borrow.return_date)
-    
+    if borrow.return_date is None:
+        # Reopen the borrow and take its copies back out of stock in one statement
+        result = await reopen_borrow(borrow_id)
+        if result is None:
+            raise HTTPException(status_code=404, detail="Borrow not found")
+        if result["status"] == "insufficient_stock":
+            raise HTTPException(status_code=409, detail="Not enough books available to reopen this borrow")
+        return result
+
+    # Close the borrow and put its copies back in stock in one statement
+    result = await return_borrow(borrow_id, borrow.return_date)
+    # The borrow was already returned, so only the date changes
+    if result is None:
+        result = await update_borrow_return_date(borrow_id, borrow.return_date)
     if result is None:
         raise HTTPException(status_code=404, detail="Borrow not found")
-
-    # Increase the available quantity of the book when returned
-    if borrow.return_date:
-        await update_book_quantity_on_return(result['book_id'], result['borrow_quantity'])
-    
     return result
 
 
@@ -129,12 +224,31 @@ async def delete_borrow_endpoint(borrow_id: int):
         raise HTTPException(status_code=404, detail="Borrow not found")
     return {"detail": "Borrow deleted"}
 
-# Endpoint to get all borrows
+# Endpoint to get borrows one keyset page at a time
+# The cursor for the next page is returned in the X-Next-Cursor header
 @router.get("/borrows", response_model=List[Borrow])
-async def get_all_borrows():
-    result = await get_all_borrows_from_db()
-    if not result:
+async def get_all_borrows(
+    response: Response,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    user_id: Optional[int] = None,
+    book_id: Optional[int] = None,
+    borrowed_from: Optional[datetime] = None,
+    borrowed_to: Optional[datetime] = None,
+    not_returned: bool = False,
+):
+    try:
+        after_id = decode_cursor(cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    rows = await get_all_borrows_from_db(limit + 1, after_id, user_id, book_id, borrowed_from, borrowed_to, not_returned)
+    if not rows and cursor is None:
         raise HTTPException(status_code=404, detail="No borrows found")
+    result, next_cursor = split_page(rows, limit, "borrow_id")
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    if FAST_JSON_RESPONSES:
+        return fast_list_response(result, Borrow, response)
     return result
 
 # Endpoint to get all borrows for a specific user
@@ -143,6 +257,8 @@ async def get_borrows_by_user(user_id: int):
     result = await get_borrows_by_user_from_db(user_id)  # Add this DB function
     if not result:
         raise HTTPException(status_code=404, detail="No borrows found for this user")
+    if FAST_JSON_RESPONSES:
+        return fast_list_response(result, Borrow)
     return result
 
 
@@ -0,0 +1,9 @@
+from fastapi import APIRouter
+from cache import catalog_cache, read_coalescer
+
+router = APIRouter()
+
+# Endpoint to get hit, miss, size and coalescing counters of the in-process caches
+@router.get("/cache/stats")
+async def get_cache_stats():
+    return {"catalog": catalog_cache.stats(), "reads": read_coalescer.stats()}
@@ -0,0 +1,33 @@
+from fastapi import APIRouter, File, HTTPException, UploadFile
+from fastapi.responses import FileResponse
+from covers import COVER_MAX_BYTES, COVER_VARIANTS, InvalidCover, cover_path, store_cover, variant_filename
+
+router = APIRouter()
+
+# Cover files never change under a given name
+COVER_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+# Endpoint to upload a cover image (PNG, JPEG, WebP or GIF)
+# Returns the cover_key to pass when creating or updating a book, and the URL of every variant
+@router.post("/covers")
+async def upload_cover(file: UploadFile = File(...)):
+    data = await file.read(COVER_MAX_BYTES + 1)
+    try:
+        key = await store_cover(data)
+    except InvalidCover as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {
+        "cover_key": key,
+        "variants": {variant: f"/api/covers/{variant_filename(key, variant)}" for variant in COVER_VARIANTS},
+    }
+
+
+# Endpoint to get one stored cover file by name, <cover_key>-<variant>.<ext>
+# FileResponse answers Range requests and hands the file to the server without reading it into memory
+@router.get("/covers/{filename}")
+async def get_cover(filename: str):
+    path = cover_path(filename)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Cover not found")
+    return FileResponse(path, headers={"Cache-Control": COVER_CACHE_CONTROL})
@@ -0,0 +1,33 @@
+from fastapi import APIRouter, HTTPException
+from pydantic import BaseModel
+from database import *
+from cache import TTLCache
+
+router = APIRouter()
+
+# How long a summary snapshot is served before it is recomputed
+SUMMARY_TTL_SECONDS = 5.0
+
+# Pydantic model for the dashboard summary response
+class DashboardSummary(BaseModel):
+    total_unique_books: int
+    total_books: int
+    available_books: int
+    total_members: int
+    total_borrows: int
+
+# Last computed summary, shared by every viewer until it expires
+# Concurrent misses share one recomputation through the cache's single flight
+summary_cache = TTLCache("dashboard_summary", SUMMARY_TTL_SECONDS, max_entries=1, max_bytes=64 * 1024)
+
+# Endpoint to get all dashboard counters at once
+@router.get("/dashboard/summary", response_model=DashboardSummary)
+async def get_dashboard_summary():
+    async def load():
+        result = await get_dashboard_summary_from_db()
+        return None if result is None else dict(result._mapping)
+
+    summary = await summary_cache.get_or_load(("summary",), load)
+    if summary is None:
+        raise HTTPException(status_code=500, detail="Error computing dashboard summary")
+    return summary
@@ -0,0 +1,108 @@
+from fastapi import APIRouter, Query
+from fastapi.responses import StreamingResponse
+from typing import Optional
+from datetime import datetime
+from database import *
+import csv
+import io
+import json
+import zlib
+
+router = APIRouter()
+
+# Rows encoded into each chunk of the response body
+EXPORT_CHUNK_ROWS = 1000
+
+BORROW_EXPORT_COLUMNS = ["borrow_id", "user_id", "username", "book_id", "book_name", "borrow_quantity", "borrow_date", "return_date", "due_date"]
+USER_EXPORT_COLUMNS = ["user_id", "username", "email", "total_borrows"]
+BOOK_EXPORT_COLUMNS = ["book_id", "book_name", "book_quantity", "available_quantity", "book_description", "book_pic", "cover_key", "genre_id", "genre_name"]
+
+
+def json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+# Encode rows into CSV or NDJSON chunks of EXPORT_CHUNK_ROWS rows
+async def encode_rows(rows, columns, export_format: str):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if export_format == "csv" else None
+    if writer:
+        writer.writerow(columns)
+    count = 0
+    async for row in rows:
+        if writer:
+            writer.writerow([row[column] for column in columns])
+        else:
+            buffer.write(json.dumps({column: row[column] for column in columns}, default=json_default))
+            buffer.write("\n")
+        count += 1
+        if count % EXPORT_CHUNK_ROWS == 0:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+# Compress a stream of chunks into a single gzip stream
+async def gzip_chunks(chunks):
+    compressor = zlib.compressobj(wbits=31)
+    async for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def export_response(rows, columns, name: str, export_format: str, gzip: bool):
+    body = encode_rows(rows, columns, export_format)
+    filename = f"{name}.{export_format}"
+    media_type = "text/csv" if export_format == "csv" else "application/x-ndjson"
+    if gzip:
+        body = gzip_chunks(body)
+        filename += ".gz"
+        media_type = "application/gzip"
+    return StreamingResponse(
+        body,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+# Endpoint to export borrow history as CSV or NDJSON
+@router.get("/exports/borrows")
+async def export_borrows(
+    format: str = Query("csv", pattern="^(csv|ndjson)$"),
+    gzip: bool = False,
+    user_id: Optional[int] = None,
+    book_id: Optional[int] = None,
+    borrowed_from: Optional[datetime] = None,
+    borrowed_to: Optional[datetime] = None,
+    not_returned: bool = False,
+):
+    rows = iterate_borrows_from_db(user_id, book_id, borrowed_from, borrowed_to, not_returned)
+    return export_response(rows, BORROW_EXPORT_COLUMNS, "borrows", format, gzip)
+
+# Endpoint to export users with their borrow count as CSV or NDJSON
+@router.get("/exports/users")
+async def export_users(
+    format: str = Query("csv", pattern="^(csv|ndjson)$"),
+    gzip: bool = False,
+    user_id: Optional[int] = None,
+    borrowed_from: Optional[datetime] = None,
+    borrowed_to: Optional[datetime] = None,
+):
+    rows = iterate_users_with_borrow_count_from_db(user_id, borrowed_from, borrowed_to)
+    return export_response(rows, USER_EXPORT_COLUMNS, "users", format, gzip)
+
+# Endpoint to export the book catalog as CSV or NDJSON
+@router.get("/exports/books")
+async def export_books(
+    format: str = Query("csv", pattern="^(csv|ndjson)$"),
+    gzip: bool = False,
+    genre_id: Optional[int] = None,
+):
+    rows = iterate_books_from_db(genre_id)
+    return export_response(rows, BOOK_EXPORT_COLUMNS, "books", format, gzip)
@@ -1,7 +1,8 @@
-from fastapi import APIRouter, HTTPException
-from pydantic import BaseModel, ValidationError
+from fastapi import APIRouter, HTTPException, Request, Response
+from pydantic import BaseModel
 from typing import List
 from database import *
+from http_cache import CATALOG_CACHE_CONTROL, conditional_headers, etag_matches
 import logging
 
 router = APIRouter()
@@ -27,7 +28,11 @@ class GenreWithBooks(BaseModel):
 
 # Endpoint to get all genres
 @router.get("/genres", response_model=List[Genre])
-async def get_all_genres():
+async def get_all_genres(request: Request, response: Response):
+    headers, not_modified = await conditional_headers(request, ["genre"], CATALOG_CACHE_CONTROL)
+    if not_modified:
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
     result = await get_all_genres_from_db()
     if not result:
         raise HTTPException(status_code=404, detail="No genres found")
@@ -38,42 +43,17 @@ async def get_all_genres():
 # Add a logger
 logger = logging.getLogger("uvicorn.error")
 
+# Endpoint to get every genre with its books
+# The body is built by the database and cached as bytes; clients revalidate with If-None-Match
 @router.get("/genres-with-books", response_model=List[GenreWithBooks])
-async def get_genres_with_books():
+async def get_genres_with_books(request: Request):
     try:
-        # Fetch genres and their respective books
-        genres_query = "SELECT genre_id, genre_name, genre_description FROM genre"
-        genres = await database.fetch_all(genres_query)
-
-        books_query = "SELECT book_id, book_name, genre_id FROM books"
-        books = await database.fetch_all(books_query)
-
-        # Create a mapping of genres to books, ensuring 'books' is always initialized
-        genre_dict = {genre['genre_id']: {
-            'genre_id': genre['genre_id'],
-            'genre_name': genre['genre_name'],
-            'genre_description': genre['genre_description'],
-            'books': []  # Initialize books as an empty list
-        } for genre in genres}
-
-        # Append books to the respective genre's 'books' list
-        for book in books:
-            genre_id = book['genre_id']
-            if genre_id in genre_dict:
-                genre_dict[genre_id]['books'].append({
-                    'book_id': book['book_id'],
-                    'book_name': book['book_name']
-                })
-
-        # Convert the genre dictionary to a list for the response
-        validated_result = [GenreWithBooks(**genre) for genre in genre_dict.values()]
-        
-        
-    except ValidationError as e:
-        logger.error(f"Validation Error: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Validation error: {e}")
+        body, etag = await get_genres_with_books_from_db()
     except Exception as e:
         logger.error(f"Error fetching genres with books: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal server error")
-    
-    return validated_result
+
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
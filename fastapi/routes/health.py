@@ -0,0 +1,28 @@
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+import asyncio
+import lifecycle
+from database import ping_db
+
+router = APIRouter()
+
+# Seconds the readiness probe waits for the database
+READINESS_DB_TIMEOUT = 2.0
+
+
+# Liveness probe: answers as long as the event loop is running
+@router.get("/health/live", include_in_schema=False)
+async def liveness():
+    return {"status": "alive"}
+
+
+# Readiness probe: 503 while starting up, while draining for shutdown, or when the database does not answer
+@router.get("/health/ready", include_in_schema=False)
+async def readiness():
+    if not lifecycle.ready:
+        return JSONResponse({"status": "not ready"}, status_code=503)
+    try:
+        await asyncio.wait_for(ping_db(), READINESS_DB_TIMEOUT)
+    except Exception:
+        return JSONResponse({"status": "database unavailable"}, status_code=503)
+    return {"status": "ready"}
@@ -5,13 +5,13 @@ custom_key = "happycoding"
 def vigenere(message, key, direction=1):
     key_index = 0
     alphabet = "abcdefghijklmnopqrstuvwxyz"
-    final_message = ""
+    final_message = []
 
     for char in message.lower():
 
         # Append any non-letter character to the message
         if not char.isalpha():
-            final_message += char
+            final_message.append(char)
         else:
             # Find the right key character to encode/decode
             key_char = key[key_index % len(key)]
@@ -21,9 +21,9 @@ def vigenere(message, key, direction=1):
             offset = alphabet.index(key_char)
             index = alphabet.find(char)
             new_index = (index + offset * direction) % len(alphabet)
-            final_message += alphabet[new_index]
+            final_message.append(alphabet[new_index])
 
-    return final_message
+    return "".join(final_message)
 
 
 def encrypt(message, key=custom_key):
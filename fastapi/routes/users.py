@@ -1,10 +1,12 @@
-from fastapi import APIRouter, FastAPI, HTTPException
+from fastapi import APIRouter, FastAPI, HTTPException, Query, Request, Response
 from pydantic import BaseModel
 from typing import Optional
 from datetime import datetime
 from database import *
 from typing import List, Optional
-from routes.password_cypher import encrypt, decrypt
+from credentials import hash_password, needs_rehash, verify_password
+from http_cache import USER_CACHE_CONTROL, conditional_headers
+from fast_json import FAST_JSON_RESPONSES, fast_list_response
 
 
 router = APIRouter()
@@ -38,14 +40,14 @@ class UserWithBorrowCount(BaseModel):
     username: str
     email: str
     total_borrows: Optional[int]
+    active_borrows: Optional[int] = None
     
 
 
 # Endpoint to create a new user
 @router.post("/users/create", response_model=User)
 async def create_user(user: UserCreate):
-    # hashed_password = encrypt(user.password_hash)
-    result = await insert_user(user.username, encrypt(user.password_hash), user.email)
+    result = await insert_user(user.username, await hash_password(user.password_hash), user.email)
     if result is None:
         raise HTTPException(status_code=400, detail="Error creating user")
     return result
@@ -58,7 +60,11 @@ async def get_total_members():
 
 # Endpoint to get a user by user_id
 @router.get("/users/{user_id}", response_model=User)
-async def read_user(user_id: int):
+async def read_user(user_id: int, request: Request, response: Response):
+    headers, not_modified = await conditional_headers(request, ["users"], USER_CACHE_CONTROL)
+    if not_modified:
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
     result = await get_user(user_id)
     if result is None:
         raise HTTPException(status_code=404, detail="User not found")
@@ -67,7 +73,8 @@ async def read_user(user_id: int):
 # Endpoint to update a user
 @router.put("/users/{user_id}", response_model=User)
 async def update_user_endpoint(user_id: int, user: UserUpdate):
-    result = await update_user(user_id, user.username, user.password_hash, user.email)
+    password_hash = await hash_password(user.password_hash) if user.password_hash else None
+    result = await update_user(user_id, user.username, password_hash, user.email)
     if result is None:
         raise HTTPException(status_code=404, detail="User not found")
     return result
@@ -84,15 +91,19 @@ async def delete_user_endpoint(user_id: int):
 @router.post("/users/login")
 async def login_user(user: UserLogin):
     # Fetch user from the database
-    db_user = await get_user_by_email(user.email, encrypt(user.password_hash))
+    db_user = await get_user_by_email(user.email)
 
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
 
-    # Compare the stored hashed password with the provided password
-    if db_user.password_hash != encrypt(user.password_hash):
+    # Verify the password against the stored hash (off the event loop)
+    if not await verify_password(user.password_hash, db_user.password_hash):
         raise HTTPException(status_code=400, detail="Incorrect password")
 
+    # Upgrade hashes written by the old cipher or with an outdated cost on successful login
+    if needs_rehash(db_user.password_hash):
+        await update_user_password_hash(db_user.user_id, await hash_password(user.password_hash))
+
     # If login is successful, you can return user info (omit password hash)
     return {
         "user_id": db_user.user_id,
@@ -102,17 +113,50 @@ async def login_user(user: UserLogin):
         "created_at": db_user.created_at,
     }
 
-# Endpoint to get all users
+# Endpoint to get users one keyset page at a time
+# The cursor for the next page is returned in the X-Next-Cursor header
 @router.get("/users", response_model=List[User])
-async def get_all_users():
-    result = await get_all_users_from_db()  # A function you should add to interact with the database
-    if not result:
+async def get_all_users(
+    response: Response,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+):
+    try:
+        after_id = decode_cursor(cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    rows = await get_all_users_from_db(limit + 1, after_id)
+    if not rows and cursor is None:
         raise HTTPException(status_code=404, detail="No users found")
+    result, next_cursor = split_page(rows, limit, "user_id")
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    if FAST_JSON_RESPONSES:
+        return fast_list_response(result, User, response)
     return result
 
-# Endpoint to get all users with borrowcount
+# Endpoint to get users with their lifetime and active borrow counts one keyset page at a time
+# sort=lifetime or sort=active ranks users by that count, highest first
+# The cursor for the next page is returned in the X-Next-Cursor header
 @router.get("/users_with_borrow_count", response_model=List[UserWithBorrowCount])
-async def get_all_users_with_borrow_count_endpoint():
-    result = await get_all_users_with_borrow_count()
+async def get_all_users_with_borrow_count_endpoint(
+    response: Response,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    sort: str = Query("user_id", pattern="^(user_id|lifetime|active)$"),
+):
+    count_key = {"lifetime": "total_borrows", "active": "active_borrows"}.get(sort)
+    try:
+        after = decode_cursor(cursor) if count_key is None else decode_count_cursor(cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    rows = await get_all_users_with_borrow_count(limit + 1, after, sort)
+    result = rows[:limit]
+    if len(rows) > limit:
+        last = result[-1]
+        next_key = last["user_id"] if count_key is None else [last[count_key], last["user_id"]]
+        response.headers["X-Next-Cursor"] = encode_cursor(next_key)
+    if FAST_JSON_RESPONSES:
+        return fast_list_response(result, UserWithBorrowCount, response)
     return result
 
@@ -0,0 +1,155 @@
+"""Production entry point: serves the API from several worker processes.
+
+Run from the fastapi directory:
+
+    python serve.py [--workers 4] [--host 0.0.0.0] [--port 8000] [--graceful-timeout 30]
+    python serve.py --reload   # one auto-reloading process, for development
+
+The number of workers defaults to WEB_CONCURRENCY, or else to the CPUs this
+process may use (its CPU affinity, capped by a container CPU quota). All
+workers share one listening socket. Pending migrations are applied once, by
+the launcher, before the workers start; the workers then skip them. Each
+worker runs the app's lifespan handler, so it has connected its pools and
+warmed its caches before it takes a connection.
+
+Several workers share their metrics through METRICS_DIR, a fresh temporary
+directory unless it is set, so /metrics reports the whole server whichever
+worker answers the scrape.
+
+On SIGTERM or SIGINT each worker fails its readiness probe and closes its live
+streams, stops accepting connections, and waits up to --graceful-timeout
+seconds for in-flight requests before shutting down.
+"""
+import argparse
+import asyncio
+import glob
+import math
+import os
+import shutil
+import tempfile
+import uvicorn
+from uvicorn.supervisors import Multiprocess
+
+# Seconds a stopping worker waits for in-flight requests before cancelling them
+GRACEFUL_SHUTDOWN_SECONDS = float(os.environ.get("GRACEFUL_SHUTDOWN_SECONDS", 30))
+
+
+# CPUs allowed by the cgroup CPU quota (v2, then v1), or None when there is no quota
+def cgroup_cpu_limit():
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as cpu_max:
+            quota, period = cpu_max.read().split()
+        if quota != "max":
+            return int(quota) / int(period)
+        return None
+    except (OSError, ValueError):
+        pass
+    try:
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as quota_file, \
+                open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as period_file:
+            quota, period = int(quota_file.read()), int(period_file.read())
+        return quota / period if quota > 0 else None
+    except (OSError, ValueError):
+        return None
+
+
+def available_cpus() -> int:
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    limit = cgroup_cpu_limit()
+    if limit is not None:
+        cpus = min(cpus, max(1, math.ceil(limit)))
+    return cpus
+
+
+def default_workers() -> int:
+    if os.environ.get("WEB_CONCURRENCY"):
+        return int(os.environ["WEB_CONCURRENCY"])
+    return available_cpus()
+
+
+# Apply pending migrations before any worker starts, so the workers do not all race to apply them
+def migrate_before_workers():
+    import database as database_module
+    from migrations import migrate
+    if not database_module.DB_MIGRATE_ON_STARTUP:
+        return
+
+    async def run():
+        await database_module.database.connect()
+        try:
+            await migrate(database_module.database)
+        finally:
+            await database_module.database.disconnect()
+
+    asyncio.run(run())
+    # Worker processes import database.py afresh and read the setting from the environment;
+    # a single worker runs in this process and uses the module already imported
+    os.environ["DB_MIGRATE_ON_STARTUP"] = "0"
+    database_module.DB_MIGRATE_ON_STARTUP = False
+
+
+# Give the workers a directory to share their metrics through, emptied of earlier runs
+# Returns the directory if it was created here, so it can be removed on exit
+def prepare_metrics_dir():
+    metrics_dir = os.environ.get("METRICS_DIR")
+    if metrics_dir:
+        os.makedirs(metrics_dir, exist_ok=True)
+        for snapshot in glob.glob(os.path.join(metrics_dir, "*.json")):
+            os.remove(snapshot)
+        return None
+    os.environ["METRICS_DIR"] = tempfile.mkdtemp(prefix="library-metrics-")
+    return os.environ["METRICS_DIR"]
+
+
+class DrainingServer(uvicorn.Server):
+    """uvicorn server that starts draining the app as soon as it is asked to stop."""
+
+    def handle_exit(self, sig, frame):
+        # Imported here: only worker processes load the app
+        from lifecycle import begin_drain
+        begin_drain()
+        super().handle_exit(sig, frame)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default=os.environ.get("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", 8000)))
+    parser.add_argument("--workers", type=int, default=default_workers(), help="worker processes")
+    parser.add_argument("--graceful-timeout", type=float, default=GRACEFUL_SHUTDOWN_SECONDS,
+                        help="seconds to wait for in-flight requests on shutdown")
+    parser.add_argument("--reload", action="store_true", help="one process that restarts on code changes")
+    args = parser.parse_args()
+
+    if args.reload:
+        uvicorn.run("app:app", host=args.host, port=args.port, reload=True)
+        return
+
+    migrate_before_workers()
+
+    config = uvicorn.Config(
+        "app:app",
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        # A worker that cannot connect or warm up exits instead of serving errors
+        lifespan="on",
+        timeout_graceful_shutdown=args.graceful_timeout,
+    )
+    server = DrainingServer(config)
+    if config.workers > 1:
+        metrics_dir = prepare_metrics_dir()
+        try:
+            Multiprocess(config, target=server.run, sockets=[config.bind_socket()]).run()
+        finally:
+            if metrics_dir is not None:
+                shutil.rmtree(metrics_dir, ignore_errors=True)
+    else:
+        server.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,25 @@
+from database import allocate_bulk_borrows
+
+
+def item(book_id, quantity, user_id=1):
+    return {"user_id": user_id, "book_id": book_id, "borrow_quantity": quantity}
+
+
+def test_rejected_item_takes_no_stock():
+    statuses = allocate_bulk_borrows([item(7, 10), item(7, 1)], {7: 3}, {1})
+    assert statuses == ["insufficient_stock", "ok"]
+
+
+def test_items_are_granted_in_order_until_stock_runs_out():
+    statuses = allocate_bulk_borrows([item(7, 2), item(7, 2), item(7, 1)], {7: 3}, {1})
+    assert statuses == ["ok", "insufficient_stock", "ok"]
+
+
+def test_stock_is_tracked_per_book():
+    statuses = allocate_bulk_borrows([item(7, 3), item(8, 3), item(7, 1)], {7: 3, 8: 5}, {1})
+    assert statuses == ["ok", "ok", "insufficient_stock"]
+
+
+def test_unknown_books_and_users_and_bad_quantities_are_rejected():
+    statuses = allocate_bulk_borrows([item(9, 1), item(7, 1, user_id=2), item(7, 0), item(7, -1)], {7: 3}, {1})
+    assert statuses == ["not_found", "not_found", "invalid_quantity", "invalid_quantity"]
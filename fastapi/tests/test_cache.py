@@ -0,0 +1,55 @@
+import asyncio
+from cache import TTLCache
+
+
+def new_cache():
+    return TTLCache("test", 60, 100, 1024 * 1024)
+
+
+def test_invalidation_only_affects_loads_of_the_matching_key():
+    async def scenario():
+        cache = new_cache()
+        release = asyncio.Event()
+
+        async def load(value):
+            await release.wait()
+            return value
+
+        stale = asyncio.ensure_future(cache.get_or_load(("book", 1), lambda: load("old")))
+        other = asyncio.ensure_future(cache.get_or_load(("book", 2), lambda: load("two")))
+        await asyncio.sleep(0)
+        cache.invalidate(("book", 1))
+        # A miss after the invalidation starts its own load; one on another key joins the running load
+        fresh = asyncio.ensure_future(cache.get_or_load(("book", 1), lambda: load("new")))
+        joined = asyncio.ensure_future(cache.get_or_load(("book", 2), lambda: load("unused")))
+        await asyncio.sleep(0)
+        release.set()
+        assert await asyncio.gather(stale, fresh, other, joined) == ["old", "new", "two", "two"]
+        assert cache.get(("book", 1)) == (True, "new")
+        assert cache.get(("book", 2)) == (True, "two")
+        assert cache.stats()["coalesced"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_invalidate_where_skips_storing_matching_results_of_running_loads():
+    async def scenario():
+        cache = new_cache()
+        release = asyncio.Event()
+
+        async def load(value):
+            await release.wait()
+            return value
+
+        matching = asyncio.ensure_future(cache.get_or_load(("books", 1), lambda: load([{"book_id": 7}])))
+        unrelated = asyncio.ensure_future(cache.get_or_load(("books", 2), lambda: load([{"book_id": 8}])))
+        await asyncio.sleep(0)
+        cache.invalidate_where(
+            lambda key, rows: key[0] == "books" and (rows is None or any(row["book_id"] == 7 for row in rows))
+        )
+        release.set()
+        await asyncio.gather(matching, unrelated)
+        assert cache.get(("books", 1)) == (False, None)
+        assert cache.get(("books", 2)) == (True, [{"book_id": 8}])
+
+    asyncio.run(scenario())
@@ -10,6 +10,7 @@ import {
   IconButton,
 } from '@mui/material';
 import AddIcon from '@mui/icons-material/Add';
+import coverUrl from './coverUrl';
 
 const MainContent = ({ filteredBooks, addToCart }) => {
   return (
@@ -26,7 +27,7 @@ const MainContent = ({ filteredBooks, addToCart }) => {
                 <CardMedia
                   component="img"
                   height="200"
-                  image={book.book_pic || '/default_book_image.png'}
+                  image={coverUrl(book, 'medium')}
                   alt={book.book_name}
                   sx={{ objectFit: 'contain', padding: '10px' }}
                 />
@@ -0,0 +1,9 @@
+// URL of a pre-sized WebP cover ('thumb' is 200px wide, 'medium' 600px), falling back to the free-form book_pic
+const coverUrl = (book, size = 'thumb') => {
+  if (book.cover_key) {
+    return `/api/covers/${book.cover_key}-${size}-webp.webp`;
+  }
+  return book.book_pic || '/default_book_image.png';
+};
+
+export default coverUrl;
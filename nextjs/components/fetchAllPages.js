@@ -0,0 +1,15 @@
+import axios from 'axios';
+
+// Fetch every page of a paginated list endpoint by following the X-Next-Cursor header until the last page
+const fetchAllPages = async (url, params = {}) => {
+  const items = [];
+  let cursor;
+  do {
+    const response = await axios.get(url, { params: { limit: 1000, ...params, cursor } });
+    items.push(...response.data);
+    cursor = response.headers['x-next-cursor'];
+  } while (cursor);
+  return items;
+};
+
+export default fetchAllPages;
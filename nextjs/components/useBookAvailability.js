@@ -0,0 +1,57 @@
+import { useEffect, useRef } from 'react';
+
+// Keep the available and total quantities of a list of books up to date from the live availability stream.
+// onReset is called when changes may have been missed, so the list should be fetched again.
+const useBookAvailability = (setBooks, onReset) => {
+  const resetRef = useRef(onReset);
+  resetRef.current = onReset;
+
+  useEffect(() => {
+    let source;
+    let retryTimer;
+    let connectedBefore = false;
+
+    const connect = () => {
+      source = new EventSource('/api/availability/stream');
+      // Changes made while the stream was down were missed
+      source.onopen = () => {
+        if (connectedBefore && resetRef.current) resetRef.current();
+        connectedBefore = true;
+      };
+      // EventSource retries dropped streams itself but gives up on an error status,
+      // e.g. a 503 from a server that is shutting down
+      source.onerror = () => {
+        if (source.readyState === EventSource.CLOSED) {
+          retryTimer = setTimeout(connect, 5000);
+        }
+      };
+      source.onmessage = onMessage;
+    };
+
+    const onMessage = (event) => {
+      const message = JSON.parse(event.data);
+      if (message.type === 'reset') {
+        if (resetRef.current) resetRef.current();
+        return;
+      }
+      const changed = new Map(message.books.map(([bookId, available, quantity]) => [bookId, { available, quantity }]));
+      const deleted = new Set(message.deleted);
+      setBooks((books) => books
+        .filter((book) => !deleted.has(book.book_id))
+        .map((book) => {
+          const change = changed.get(book.book_id);
+          return change
+            ? { ...book, available_quantity: change.available, book_quantity: change.quantity }
+            : book;
+        }));
+    };
+
+    connect();
+    return () => {
+      clearTimeout(retryTimer);
+      source.close();
+    };
+  }, [setBooks]);
+};
+
+export default useBookAvailability;
@@ -9,6 +9,8 @@ import DeleteIcon from '@mui/icons-material/Delete';
 import AddIcon from '@mui/icons-material/Add';
 import RemoveIcon from '@mui/icons-material/Remove';
 import Sidebar from '../components/dashboard/Sidebar';
+import useBookAvailability from '../components/useBookAvailability';
+import fetchAllPages from '../components/fetchAllPages';
 
 const BookList = () => {
   const [books, setBooks] = useState([]);
@@ -24,9 +26,9 @@ const BookList = () => {
   useEffect(() => {
     const fetchData = async () => {
       try {
-        const booksResponse = await axios.get('/api/books');
+        const allBooks = await fetchAllPages('/api/books');
         const genresResponse = await axios.get('/api/genres');
-        setBooks(booksResponse.data);
+        setBooks(allBooks);
         setGenres(genresResponse.data);
       } catch (err) {
         setError('Failed to fetch books or genres');
@@ -38,6 +40,24 @@ const BookList = () => {
     fetchData();
   }, []);
 
+  // Apply stock changes pushed by the API instead of polling for them
+  useBookAvailability(setBooks, async () => {
+    setBooks(await fetchAllPages('/api/books'));
+  });
+
+  // Upload a cover image; the server stores pre-sized variants and returns their key
+  const handleCoverUpload = async (file) => {
+    if (!file) return;
+    try {
+      const form = new FormData();
+      form.append('file', file);
+      const response = await axios.post('/api/covers', form);
+      setNewBook((book) => ({ ...book, cover_key: response.data.cover_key }));
+    } catch (err) {
+      setError('Failed to upload cover');
+    }
+  };
+
   // Open the modal to add a new book
   const handleClickOpen = () => setOpen(true);
   const handleClose = () => setOpen(false);
@@ -46,8 +66,7 @@ const BookList = () => {
   const handleAddBook = async () => {
     try {
       await axios.post('/api/books/create', newBook);
-      const booksResponse = await axios.get('/api/books');
-      setBooks(booksResponse.data);
+      setBooks(await fetchAllPages('/api/books'));
       setNewBook({ book_name: '', book_quantity: 1, book_description: '', book_pic: '', genre_id: '' });
       setOpen(false);
     } catch (err) {
@@ -193,6 +212,11 @@ const handleDecreaseQuantity = async (book) => {
                 onChange={(e) => setNewBook({ ...newBook, book_pic: e.target.value })}
                 margin="dense"
               />
+              <Button variant="outlined" component="label" sx={{ marginTop: 1, marginBottom: 1 }}>
+                {newBook.cover_key ? 'Cover uploaded' : 'Upload Cover'}
+                <input type="file" accept="image/png,image/jpeg,image/webp,image/gif" hidden
+                  onChange={(e) => handleCoverUpload(e.target.files[0])} />
+              </Button>
               <TextField
                 label="Quantity"
                 type="number"
@@ -5,6 +5,7 @@ import {
   Paper, Button, IconButton
 } from '@mui/material';
 import Sidebar from '../components/dashboard/Sidebar'; // Assuming Sidebar exists
+import fetchAllPages from '../components/fetchAllPages';
 
 const Borrow = () => {
   const [borrows, setBorrows] = useState([]);
@@ -15,8 +16,7 @@ const Borrow = () => {
   useEffect(() => {
     const fetchBorrows = async () => {
       try {
-        const response = await axios.get('/api/borrows');
-        setBorrows(response.data);
+        setBorrows(await fetchAllPages('/api/borrows'));
       } catch (err) {
         setError('Failed to fetch borrow records');
       } finally {
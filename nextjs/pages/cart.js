@@ -4,6 +4,7 @@ import DeleteIcon from '@mui/icons-material/Delete';
 import AddIcon from '@mui/icons-material/Add';
 import RemoveIcon from '@mui/icons-material/Remove';
 import axios from 'axios';  // Ensure axios is imported for making API calls
+import coverUrl from '../components/coverUrl';
 
 const CartPage = ({ confirmBorrow }) => {
   const [cartItems, setCartItems] = useState([]);
@@ -109,7 +110,7 @@ const CartPage = ({ confirmBorrow }) => {
                 <CardMedia
                   component="img"
                   height="150"
-                  image={book.book_pic || '/default_book_image.png'}
+                  image={coverUrl(book)}
                   alt={book.book_name}
                   sx={{ objectFit: 'contain', padding: '10px' }}
                 />
@@ -4,6 +4,7 @@ import Sidebar from '../components/dashboard/Sidebar';
 import StatsCard from '../components/dashboard/StatsCard';
 import WeeklyBorrowingsChart from '../components/dashboard/WeeklyBorrowingsChart';
 import BooksByGenresChart from '../components/dashboard/BooksByGenresChart';
+import MostBorrowedBooks from '../components/dashboard/MostBorrowedBooks';
 import axios from 'axios';
 
 
@@ -15,6 +16,7 @@ export default function Dashboard() {
   const [totalBorrows, setTotalBorrows] = useState(0);
   const [totalMembers, setTotalMembers] = useState(0);
   const [weeklyBorrowingsData, setWeeklyBorrowingsData] = useState(null);
+  const [mostBorrowedBooks, setMostBorrowedBooks] = useState([]);
 
   useEffect(() => {
     const fetchBooksByGenresCount = async () => {
@@ -44,27 +46,32 @@ export default function Dashboard() {
 
     const fetchSummaryData = async () => {
       try {
-        const [uniqueBooksRes, totalBooksRes, availableBooksRes, borrowsRes, membersRes] = await Promise.all([
-          axios.get('/api/books/unique_count'),
-          axios.get('/api/books/total-count'),
-          axios.get('/api/books/available-count'),
-          axios.get('/api/borrows/count'),
-          axios.get('/api/users/count')
-        ]);
+        const response = await axios.get('/api/dashboard/summary');
+        const summary = response.data;
 
-        setTotalUniqueBooks(uniqueBooksRes.data.total_unique_books);
-        setTotalBooks(totalBooksRes.data.total_books);
-        setAvailableBooks(availableBooksRes.data.available_books);
-        setTotalBorrows(borrowsRes.data.total_borrows);
-        setTotalMembers(membersRes.data.total_members);
+        setTotalUniqueBooks(summary.total_unique_books);
+        setTotalBooks(summary.total_books);
+        setAvailableBooks(summary.available_books);
+        setTotalBorrows(summary.total_borrows);
+        setTotalMembers(summary.total_members);
       } catch (error) {
         console.error('Error fetching summary data:', error);
       }
     };
 
+    const fetchMostBorrowedBooks = async () => {
+      try {
+        const response = await axios.get('/api/books/most-borrowed', { params: { window: '30d', limit: 5 } });
+        setMostBorrowedBooks(response.data.map(book => ({ title: book.book_name })));
+      } catch (error) {
+        console.error('Error fetching most borrowed books:', error);
+      }
+    };
+
     fetchBooksByGenresCount();
     fetchWeeklyBorrowingsData();
     fetchSummaryData();
+    fetchMostBorrowedBooks();
   }, []);
 
   return (
@@ -97,6 +104,10 @@ export default function Dashboard() {
           {weeklyBorrowingsData && <WeeklyBorrowingsChart data={weeklyBorrowingsData} />}
           </Grid>
 
+          <Grid item xs={12} md={4}>
+            <MostBorrowedBooks books={mostBorrowedBooks} />
+          </Grid>
+
           <Grid item xs={12} md={10}>
             {booksByGenresData && <BooksByGenresChart data={booksByGenresData} />}
           </Grid>
@@ -3,6 +3,8 @@ import { Grid } from '@mui/material';
 import axios from 'axios';
 import Sidebar from '../components/HomeSidebar';
 import MainContent from '../components/MainContent';
+import useBookAvailability from '../components/useBookAvailability';
+import fetchAllPages from '../components/fetchAllPages';
 
 const HomePage = () => {
   const [books, setBooks] = useState([]); // State to store books data
@@ -16,8 +18,7 @@ const HomePage = () => {
   useEffect(() => {
     const fetchBooks = async () => {
       try {
-        const response = await axios.get('/api/books'); // Adjust this URL as per your setup
-        setBooks(response.data); // Store the fetched books
+        setBooks(await fetchAllPages('/api/books')); // Store the fetched books, following every page
       } catch (error) {
         console.error('Error fetching books:', error);
       }
@@ -26,6 +27,11 @@ const HomePage = () => {
     fetchBooks();
   }, []);
 
+  // Apply stock changes pushed by the API instead of polling for them
+  useBookAvailability(setBooks, async () => {
+    setBooks(await fetchAllPages('/api/books'));
+  });
+
   // Fetch genres from FastAPI backend
   useEffect(() => {
     const fetchGenres = async () => {
@@ -37,19 +37,14 @@ export default function Report() {
 
     const fetchSummaryData = async () => {
       try {
-        const [uniqueBooksRes, totalBooksRes, availableBooksRes, borrowsRes, membersRes] = await Promise.all([
-          axios.get('/api/books/unique_count'),
-          axios.get('/api/books/total-count'),
-          axios.get('/api/books/available-count'),
-          axios.get('/api/borrows/count'),
-          axios.get('/api/users/count'),
-        ]);
+        const response = await axios.get('/api/dashboard/summary');
+        const summary = response.data;
 
-        setTotalUniqueBooks(uniqueBooksRes.data.total_unique_books);
-        setTotalBooks(totalBooksRes.data.total_books);
-        setAvailableBooks(availableBooksRes.data.available_books);
-        setTotalBorrows(borrowsRes.data.total_borrows);
-        setTotalMembers(membersRes.data.total_members);
+        setTotalUniqueBooks(summary.total_unique_books);
+        setTotalBooks(summary.total_books);
+        setAvailableBooks(summary.available_books);
+        setTotalBorrows(summary.total_borrows);
+        setTotalMembers(summary.total_members);
       } catch (error) {
         console.error('Error fetching summary data:', error);
       }
@@ -6,6 +6,7 @@ import {
 } from '@mui/material';
 import DeleteIcon from '@mui/icons-material/Delete';
 import Sidebar from '../components/dashboard/Sidebar'; // Assuming Sidebar exists
+import fetchAllPages from '../components/fetchAllPages';
 
 const Users = () => {
   const [users, setUsers] = useState([]);
@@ -20,8 +21,7 @@ const Users = () => {
   useEffect(() => {
     const fetchUsers = async () => {
       try {
-        const response = await axios.get('/api/users_with_borrow_count');
-        setUsers(response.data);
+        setUsers(await fetchAllPages('/api/users_with_borrow_count'));
       } catch (err) {
         setError('Failed to fetch users');
       } finally {